@@ -51,6 +51,29 @@ if __name__ == "__main__":
     # nafta_df = NAFTA.restrictions_table(VA=True)
 
     # Generate dataset
-    # Instead of dta, you can also use csv or xlsx; just specify it in the function
-    # Note: generating xlsx file is much slower in my computer
+    # Instead of dta, you can also use csv, xlsx, feather or parquet; just specify it in the function
+    # Note: dta and xlsx files are streamed by dedicated writers (see dataset.py), as fast as csv
+    # Note: feather and parquet need pyarrow; load them back with dataset.load_dataset()
     # NAFTA.generate_dataset('csv', VA=True)
+
+    # Uncomment this to store the FTA in a local SQLite corpus (see corpus.py), queried across FTAs
+    # from corpus import Corpus
+    # with Corpus('../corpus.db') as corpus:
+    #     corpus.add(NAFTA)
+    #     print(corpus.restricting('7208', '87'))
+
+    # Uncomment this to pick the HSMap of a new FTA automatically (see versions.py)
+    # from versions import detect_hs_map
+    # NAFTA = RoO('NAFTA', nafta, detect_hs_map(nafta))
+
+    # Uncomment this to apply cumulation within a zone of linked FTAs (same HS version; see cumulation.py):
+    # goods exported under the first FTA, with materials originating in any member counted as originating
+    # from cumulation import cumulate
+    # zone = cumulate('CAFTA+PAN', [RoO('CAFTA', cafta, hs_map_2002), RoO('PAN_USA', pan, hs_map_2002)],
+    #                 originating={'PAN_USA': ['520100', '540220']})
+    # zone.generate_dataset('csv', VA=True)
+
+    # Uncomment this to export a data set larger than memory (budget in bytes; see external.py)
+    # NAFTA.generate_dataset('csv', VA=True, memory_budget=256 * 2 ** 20)
+    # import external
+    # external.export((RoO(name, texts[name], hs_map) for name in texts), '../corpus.csv', VA=True)
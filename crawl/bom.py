@@ -0,0 +1,110 @@
+"""
+bom.py
+
+Contains an evaluator checking many bills of materials (BOMs) against the
+restrictions of an FTA at once.
+
+A BOM is an output product (HS code) together with its non-originating materials
+(input HS codes and their shares of the value of the output). Every material is
+looked up in RoO.restrictions with one binary search over all BOMs together:
+  restrictiveness 1: the material does not undergo the required change of tariff
+                     classification (CTC), so the output fails
+  restrictiveness below 1: the material is allowed provided the regional value
+                     content (RVC) of the output reaches that VA percentage
+  restrictiveness 0 (or no restriction): the material is allowed
+A VA requirement complementing the CTC of the rule of the output product (e.g. 'A
+change from any other heading, provided there is a regional value content of not
+less than 50 percent') applies whatever the materials, and is read from the raw RVC
+alternatives of the rule (see RoO.build_restrictions()).
+"""
+
+import numpy as np
+import pandas as pd
+
+## -----------------------------------------------------------------------------
+## Functions
+## -----------------------------------------------------------------------------
+
+def complement_rvc(rvc, positions):
+    """Return the VA requirement (fraction from 0 to 0.99, the lowest of the RVC
+    alternatives, as Pattern.calculate_rvc()) of the rule setting the VA flags of every HS
+    position of `positions` (0 if none), from the raw RVC alternatives `rvc` of an FTA.
+    """
+    rules = rvc['output_rules'][positions]
+    alternatives = rvc['alternatives'][np.maximum(rules, 0)].astype(np.float64)
+    alternatives[alternatives < 0] = np.inf
+    lowest = alternatives.min(axis=1)
+    return np.where((rules >= 0) & np.isfinite(lowest), np.round(lowest / 100, 2), 0)
+
+
+def evaluate_boms(roo, outputs, materials):
+    """Return a DataFrame (one row per BOM) telling whether each BOM meets the rules of
+    origin of `roo`.
+
+    Inputs:
+      `roo`: instance of RoO
+      `outputs`: sequence of six-digit HS codes of the output product of each BOM
+      `materials`: DataFrame (or dictionary of arrays) of non-originating materials, with
+                   columns `bom` (index into `outputs`), `input_str` (six-digit HS code)
+                   and `share` (share of the value of the output, from 0 to 1)
+
+    Output columns:
+      `output_str`: HS code of the output product
+      `has_rule`: whether the FTA has a rule for the output product
+      `passed`: whether no material violates a CTC restriction and the RVC (one minus
+                the total share of non-originating materials) reaches every VA requirement;
+                NA if the FTA has no rule for the output product, which it does not cover
+      `violating_inputs`: tuple of HS codes of the materials violating a CTC restriction
+      `rvc`: regional value content
+      `rvc_required`: highest VA requirement imposed on the materials or complementing
+                the CTC of the rule of the output product (0 if none)
+      `VA_Complement`, `VA_Alternative`: flags of the rule of the output product
+
+    `passed` is unknown (NA) for outputs with a complementing VA requirement if the raw
+    RVC alternatives of `roo` are not available (e.g. RoO.assemble() without `rvc`).
+    """
+    hs_map = roo.hs_map
+    output_positions = hs_map.lookup(outputs)
+    boms = np.asarray(materials['bom'], dtype=np.int64)
+    inputs = hs_map.lookup(materials['input_str'])
+    shares = np.asarray(materials['share'], dtype=np.float64)
+    if len(boms) and (boms.min() < 0 or boms.max() >= len(outputs)):
+        print('BOM index out of range! Expected 0 to', len(outputs) - 1)
+        raise ValueError
+
+    values = roo.restrictions.lookup(inputs, output_positions[boms]).astype(np.float64)
+    ctc = values == 1
+    va = (values > 0) & (values < 1)
+
+    k = len(outputs)
+    rvc = 1 - np.bincount(boms, weights=shares, minlength=k)
+    rvc_required = np.zeros(k)
+    np.maximum.at(rvc_required, boms[va], np.round(values[va], 2))
+    violations = np.bincount(boms[ctc], minlength=k)
+
+    flags = roo.va_flags[output_positions]
+    complement, unknown = flags[:, 0].astype(bool), np.zeros(k, dtype=bool)
+    if roo.rvc is not None:
+        rvc_required[complement] = np.maximum(rvc_required[complement],
+                                              complement_rvc(roo.rvc, output_positions[complement]))
+    else:
+        unknown = complement
+    passed = pd.array((violations == 0) & (rvc >= rvc_required - 1e-9), dtype='boolean')
+    passed[unknown & (violations == 0)] = pd.NA
+    has_rule = roo.all_rules.rule_ids[output_positions] >= 0
+    passed[~has_rule] = pd.NA
+
+    # Group violating materials by BOM (stable, so materials keep their given order)
+    order = np.argsort(boms[ctc], kind='stable')
+    violating = np.split(hs_map.codes[inputs[ctc][order]], np.cumsum(violations)[:-1]) if k else []
+
+    return pd.DataFrame({
+        'output_str': hs_map.codes[output_positions],
+        'has_rule': has_rule,
+        'passed': passed,
+        'violating_inputs': [tuple(codes.tolist()) for codes in violating],
+        'rvc': rvc,
+        'rvc_required': rvc_required,
+        'VA_Complement': complement,
+        'VA_Alternative': flags[:, 1].astype(bool)
+    })
@@ -0,0 +1,310 @@
+"""
+compare.py
+
+Contains functions comparing several FTAs (instances of RoO built on the same
+version of HSMap) by how much their restrictions overlap.
+
+Each FTA is treated as a sparse boolean (input x output) matrix of restricted pairs,
+i.e. the nonzero entries of RoO.restrictions. All FTAs are stacked into a single
+sparse incidence structure, where every restricted pair records the set of FTAs
+imposing it as a bitmask; pairs sharing the same set are then counted together, so
+the cost is one sort over all restricted pairs regardless of the number of FTAs.
+
+Also contains functions listing the differences between two FTAs (e.g. an FTA and
+its renegotiated successor), which may be built on different HSMap versions.
+"""
+
+import numpy as np
+import pandas as pd
+
+from store import restrictiveness
+
+## -----------------------------------------------------------------------------
+## Constants
+## -----------------------------------------------------------------------------
+
+METRICS = ['jaccard', 'overlap', 'intersection', 'difference']
+
+## -----------------------------------------------------------------------------
+## Functions
+## -----------------------------------------------------------------------------
+
+def common_hs_map(roos):
+    """Return the HSMap shared by every RoO in `roos`, or raise ValueError if they do not
+    use the same version of HS Nomenclature.
+    """
+    versions = set(str(roo.hs_map.version) for roo in roos)
+    if len(versions) != 1:
+        print('FTAs must use the same HSMap version; found:', sorted(versions))
+        raise ValueError
+    return roos[0].hs_map
+
+
+def restricted_pairs(roo):
+    """Return a sorted int64 array of keys (input * len(hs_map) + output) of every
+    restricted (input, output) pair of a RoO.
+    """
+    inputs, outputs, values = roo.restrictions.coo()
+    nonzero = values != 0
+    return inputs[nonzero].astype(np.int64) * len(roo.hs_map) + outputs[nonzero]
+
+
+def co_occurrence(roos, by_chapter=False):
+    """Return a (len(roos) x len(roos)) integer array counting the restricted pairs
+    shared by every two FTAs (the diagonal holds the number of restricted pairs of
+    each FTA).
+
+    If `by_chapter` is True, return a dictionary mapping each HS chapter (of the output
+    product) to such an array instead.
+    """
+    hs_map = common_hs_map(roos)
+    n, k = len(hs_map), len(roos)
+    all_keys = [restricted_pairs(roo) for roo in roos]
+    keys = np.concatenate(all_keys)
+    owners = np.repeat(np.arange(k, dtype=np.uint64), [len(pair_keys) for pair_keys in all_keys])
+    order = np.argsort(keys, kind='stable')
+    keys, owners = keys[order], owners[order]
+
+    # One row per unique restricted pair: bitmask of FTAs imposing it (+ output chapter)
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    words = (k + 63) // 64
+    masks = np.zeros((len(starts), words + 1), dtype=np.uint64)
+    for word in range(words):
+        bits = np.where(owners // 64 == word, np.left_shift(np.uint64(1), owners % 64), np.uint64(0))
+        if len(starts):
+            masks[:, word] = np.bitwise_or.reduceat(bits, starts)
+    if by_chapter:
+        masks[:, words] = hs_map.get_prefixes(2)[keys[starts] % n]
+
+    # Pairs restricted by the same set of FTAs contribute the same outer product
+    combos, counts = np.unique(masks, axis=0, return_counts=True)
+    shifts = np.arange(k, dtype=np.uint64) % 64
+    members = (combos[:, np.arange(k) // 64] >> shifts) & np.uint64(1)
+    members = members.astype(np.int64)
+
+    if not by_chapter:
+        return (members * counts[:, None]).T @ members
+    result = {}
+    for chapter in np.unique(combos[:, words]):
+        selected = combos[:, words] == chapter
+        result['{:02d}'.format(int(chapter))] = (members[selected] * counts[selected, None]).T @ members[selected]
+    return result
+
+
+def apply_metric(counts, metric):
+    """Turn a co-occurrence array (see co_occurrence()) into a similarity or difference
+    array according to `metric`:
+      'jaccard': shared pairs / pairs restricted by either FTA
+      'overlap': shared pairs / pairs restricted by the smaller FTA
+      'intersection': number of shared pairs
+      'difference': number of pairs restricted by the row FTA but not the column FTA
+    """
+    sizes = np.diag(counts)
+    if metric == 'intersection':
+        return counts
+    elif metric == 'difference':
+        return sizes[:, None] - counts
+    elif metric == 'jaccard':
+        denominator = sizes[:, None] + sizes[None, :] - counts
+    elif metric == 'overlap':
+        denominator = np.minimum(sizes[:, None], sizes[None, :])
+    else:
+        print('Metric not recognized! Available options:', METRICS)
+        raise ValueError
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(denominator > 0, counts / np.maximum(denominator, 1), np.nan)
+
+
+def similarity_matrix(roos, metric='jaccard'):
+    """Return a DataFrame (FTA x FTA) comparing the restricted (input, output) pairs of
+    every two FTAs; see apply_metric() for available metrics.
+
+    Inputs:
+      `roos`: list of instances of RoO built on the same HSMap version
+      `metric`: string representing the metric
+    """
+    names = [roo.name for roo in roos]
+    return pd.DataFrame(apply_metric(co_occurrence(roos), metric), index=names, columns=names)
+
+
+def chapter_overlap(roos, metric='jaccard'):
+    """Return a DataFrame comparing every two FTAs within each HS chapter (of the output
+    product), indexed by (chapter, FTA) with FTAs as columns; e.g. `df.loc['87']` is the
+    similarity matrix of chapter 87.
+    """
+    names = [roo.name for roo in roos]
+    frames = {chapter: pd.DataFrame(apply_metric(counts, metric), index=names, columns=names)
+              for chapter, counts in co_occurrence(roos, by_chapter=True).items()}
+    return pd.concat(frames, names=['chapter', 'FTA'])
+
+
+def va_thresholds(roo):
+    """Return a float array of the VA requirement (lowest restrictiveness below 1) imposed
+    on every (output) HS position of a RoO; NaN if there is none.
+    """
+    _, outputs, values = roo.restrictions.coo()
+    va = (values > 0) & (values < 1)
+    thresholds = np.full(len(roo.hs_map), np.inf)
+    np.minimum.at(thresholds, outputs[va], restrictiveness(values[va]))
+    thresholds[np.isinf(thresholds)] = np.nan
+    return thresholds
+
+
+def va_difference_matrix(roos):
+    """Return a DataFrame (FTA x FTA) of the mean absolute difference between VA requirements
+    of every two FTAs, over output HS codes on which both FTAs impose a VA requirement.
+    """
+    common_hs_map(roos)
+    names = [roo.name for roo in roos]
+    thresholds = np.vstack([va_thresholds(roo) for roo in roos])
+    differences = np.abs(thresholds[:, None, :] - thresholds[None, :, :])
+    both = ~np.isnan(differences)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result = np.where(both, differences, 0).sum(axis=2) / both.sum(axis=2)
+    return pd.DataFrame(result, index=names, columns=names)
+
+
+def code_space(roos):
+    """Return a sorted array of every HS code of the HSMaps of `roos`, and, for each RoO,
+    an array mapping its HS positions into that array; FTAs built on different HSMap
+    versions (e.g. NAFTA and USMCA) can then be compared code by code.
+    """
+    codes = np.unique(np.concatenate([roo.hs_map.codes for roo in roos]))
+    return codes, [np.searchsorted(codes, roo.hs_map.codes) for roo in roos]
+
+
+def sorted_restrictions(roo, position_map, n):
+    """Return the keys (output * n + input, in the common code space) and restrictiveness
+    of every restricted pair of a RoO, sorted by output then input.
+    """
+    inputs, outputs, values = roo.restrictions.coo()
+    nonzero = values != 0
+    keys = position_map[outputs[nonzero]].astype(np.int64) * n + position_map[inputs[nonzero]]
+    order = np.argsort(keys, kind='stable')
+    return keys[order], restrictiveness(values[nonzero][order])
+
+
+def find_sorted(keys, targets):
+    """Return (found, indices): whether each of sorted `targets` is in sorted `keys`, and
+    its index in `keys` (only meaningful where found).
+    """
+    indices = np.searchsorted(keys, targets)
+    found = indices < len(keys)
+    found[found] = keys[indices[found]] == targets[found]
+    return found, indices
+
+
+def diff_window(old_keys, old_values, new_keys, new_values):
+    """Return arrays (keys, change, before, after) of the restrictions that differ between
+    two sorted sides (see sorted_restrictions()) covering the same range of keys, sorted
+    by key; see diff_chunks().
+    """
+    in_new, indices = find_sorted(new_keys, old_keys)
+    in_old, _ = find_sorted(old_keys, new_keys)
+    changed = in_new.copy()
+    changed[in_new] = old_values[in_new] != new_values[indices[in_new]]
+
+    keys = np.concatenate([old_keys[~in_new], new_keys[~in_old], old_keys[changed]])
+    change = np.repeat(np.array(['removed', 'added', 'changed']),
+                       [np.count_nonzero(~in_new), np.count_nonzero(~in_old), np.count_nonzero(changed)])
+    before = np.concatenate([old_values[~in_new], np.full(np.count_nonzero(~in_old), np.nan), old_values[changed]])
+    after = np.concatenate([np.full(np.count_nonzero(~in_new), np.nan), new_values[~in_old],
+                            new_values[indices[changed]]])
+    order = np.argsort(keys, kind='stable')
+    return keys[order], change[order], before[order], after[order]
+
+
+def diff_chunks(old, new, chunksize=100000):
+    """Yield the restrictions that differ between two FTAs (e.g. NAFTA and USMCA, or a draft
+    and its final text), sorted by output then input, in chunks of at most `chunksize` rows;
+    always yield at least one (possibly empty) chunk.
+
+    Each chunk is a dictionary of arrays:
+      `change`: 'added' (only restricted in `new`), 'removed' (only restricted in `old`) or
+                'changed' (restricted in both, with a different VA_Percentage)
+      `output_str`, `input_str`: HS codes
+      `old_VA_Percentage`, `new_VA_Percentage`: restrictiveness (NaN if not restricted)
+
+    Both sides are sorted once, then merged window by window: every window covers the
+    same range of keys on both sides, holding at most `chunksize` restrictions of each,
+    and its differences are yielded before the next window is merged. Memory beyond the
+    two sides is thus bounded by `chunksize`, whatever the size of the delta; the two FTAs
+    may use different HSMap versions.
+    """
+    codes, (old_map, new_map) = code_space([old, new])
+    n = len(codes)
+    old_keys, old_values = sorted_restrictions(old, old_map, n)
+    new_keys, new_values = sorted_restrictions(new, new_map, n)
+
+    def chunk(keys, change, before, after):
+        return {
+            'change': change,
+            'output_str': codes[keys // n],
+            'input_str': codes[keys % n],
+            'old_VA_Percentage': before,
+            'new_VA_Percentage': after
+        }
+
+    old_start, new_start, empty = 0, 0, True
+    while old_start < len(old_keys) or new_start < len(new_keys):
+        # The window ends before the (chunksize + 1)-th key of either side
+        bounds = [keys[start + chunksize] for keys, start in [(old_keys, old_start), (new_keys, new_start)]
+                  if start + chunksize < len(keys)]
+        old_stop, new_stop = len(old_keys), len(new_keys)
+        if bounds:
+            old_stop = int(np.searchsorted(old_keys, min(bounds)))
+            new_stop = int(np.searchsorted(new_keys, min(bounds)))
+        delta = diff_window(old_keys[old_start:old_stop], old_values[old_start:old_stop],
+                            new_keys[new_start:new_stop], new_values[new_start:new_stop])
+        for start in range(0, len(delta[0]), chunksize):
+            yield chunk(*[array[start:start + chunksize] for array in delta])
+            empty = False
+        old_start, new_start = old_stop, new_stop
+    if empty:
+        yield chunk(np.empty(0, dtype=np.int64), np.empty(0, dtype='U7'), np.empty(0), np.empty(0))
+
+
+def diff_table(old, new):
+    """Return a DataFrame of the restrictions that differ between two FTAs (see diff_chunks())."""
+    return pd.concat([pd.DataFrame(chunk) for chunk in diff_chunks(old, new)], ignore_index=True)
+
+
+def write_diff(old, new, filepath):
+    """Write the restrictions that differ between two FTAs (see diff_chunks()) to a csv file,
+    one chunk at a time.
+    """
+    with open(filepath, 'w', newline='') as f:
+        for i, chunk in enumerate(diff_chunks(old, new)):
+            pd.DataFrame(chunk).to_csv(f, header=(i == 0), index=False)
+
+
+def flag_changes(old, new):
+    """Return a DataFrame of output HS codes whose VA_Complement or VA_Alternative flag differs
+    between two FTAs (a code missing from one HSMap version counts as unflagged there).
+    """
+    codes, (old_map, new_map) = code_space([old, new])
+    flags = np.zeros((2, len(codes), 2), dtype=np.uint8)
+    flags[0, old_map] = old.va_flags
+    flags[1, new_map] = new.va_flags
+    changed = np.flatnonzero((flags[0] != flags[1]).any(axis=1))
+    return pd.DataFrame({
+        'output_str': codes[changed],
+        'old_VA_Complement': flags[0, changed, 0], 'new_VA_Complement': flags[1, changed, 0],
+        'old_VA_Alternative': flags[0, changed, 1], 'new_VA_Alternative': flags[1, changed, 1]
+    })
+
+
+def chapter_changes(old, new):
+    """Return a DataFrame summarizing, per HS chapter of the output product, the number of
+    restrictions added, removed and changed (see diff_chunks()) and the number of output
+    HS codes whose VA flags changed (see flag_changes()).
+    """
+    counts = {name: np.zeros(100, dtype=np.int64) for name in ['added', 'removed', 'changed', 'flags_changed']}
+    for chunk in diff_chunks(old, new):
+        chapters = chunk['output_str'].astype('U2').astype(np.int64)
+        for name in ['added', 'removed', 'changed']:
+            counts[name] += np.bincount(chapters[chunk['change'] == name], minlength=100)
+    counts['flags_changed'] += np.bincount(
+        flag_changes(old, new)['output_str'].values.astype('U2').astype(np.int64), minlength=100)
+    summary = pd.DataFrame(counts, index=pd.Index(['{:02d}'.format(i) for i in range(100)], name='chapter'))
+    return summary[summary.any(axis=1)]
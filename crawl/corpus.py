@@ -0,0 +1,203 @@
+"""
+corpus.py
+
+Contains a local corpus store holding the restrictions of many FTAs in a single
+SQLite database, so that questions across FTAs are answered with indexed queries
+instead of loading one data set per FTA.
+
+Schema:
+  agreements(id, name, hs_version)
+  restrictions(agreement, output, input, va_percentage, va_complement, va_alternative)
+
+HS codes are stored as integers (e.g. 720851), hence every chapter, heading or
+subheading is a contiguous integer range, served by the indexes on
+(agreement, output) and (agreement, input).
+
+Statistics letting the query planner pick the right index are not gathered on every
+add (ANALYZE scans the whole database): call analyze() once a batch of FTAs is added,
+and close() runs 'PRAGMA optimize', which re-analyzes only the tables that need it.
+"""
+
+import sqlite3
+
+import numpy as np
+
+## -----------------------------------------------------------------------------
+## Constants
+## -----------------------------------------------------------------------------
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS agreements (
+    id INTEGER PRIMARY KEY,
+    name TEXT UNIQUE NOT NULL,
+    hs_version TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS restrictions (
+    agreement INTEGER NOT NULL REFERENCES agreements(id),
+    output INTEGER NOT NULL,
+    input INTEGER NOT NULL,
+    va_percentage REAL NOT NULL,
+    va_complement INTEGER NOT NULL,
+    va_alternative INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS restrictions_output ON restrictions (agreement, output);
+CREATE INDEX IF NOT EXISTS restrictions_input ON restrictions (agreement, input);
+"""
+
+COLUMNS = ['agreement', 'output', 'input', 'va_percentage', 'va_complement', 'va_alternative']
+
+## -----------------------------------------------------------------------------
+## Helper Functions
+## -----------------------------------------------------------------------------
+
+def code_range(hs_code):
+    """Return the integer range [low, high] of six-digit HS codes within a two- to six-digit
+    HS code (dots allowed), e.g. '72.08' -> (720800, 720899).
+    """
+    hs_code = hs_code.replace('.', '')
+    if not hs_code.isdigit() or len(hs_code) not in (2, 4, 6):
+        print('HS code not recognized! Expected two to six digits, got:', hs_code)
+        raise ValueError
+    padding = 6 - len(hs_code)
+    return int(hs_code) * 10 ** padding, (int(hs_code) + 1) * 10 ** padding - 1
+
+## -----------------------------------------------------------------------------
+## Class Definition
+## -----------------------------------------------------------------------------
+
+class Corpus:
+    """Represent a local SQLite database of the restrictions of many FTAs.
+
+    Methods:
+      add():
+        Insert (or replace) the restrictions of a built FTA.
+      analyze():
+        Gather the statistics of the query planner, e.g. after adding many FTAs.
+      remove():
+        Delete an FTA and its restrictions.
+      agreements():
+        Return the names of stored FTAs.
+      query():
+        Return the restrictions matching given agreements, input and output HS codes.
+      restricting():
+        Return the names of FTAs restricting given input for given output HS codes.
+    """
+    def __init__(self, filepath):
+        """Initialize an instance of Corpus, creating the database if needed.
+
+        Inputs:
+          `filepath`: string of the database file (':memory:' for a temporary one)
+        """
+        self.connection = sqlite3.connect(filepath)
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        """Update the statistics of the query planner where needed, then close the
+        connection to the database.
+        """
+        self.connection.execute('PRAGMA optimize')
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def add(self, roo, chunksize=100000):
+        """Insert the restrictions of `roo` (an instance of RoO), replacing those previously
+        stored under the same name; rows are streamed from RoO.dataset_chunks() and inserted
+        in bulk, within a single transaction.
+        """
+        int_codes = roo.hs_map.get_prefixes(6)
+        with self.connection:
+            self.delete(roo.name)
+            agreement = self.connection.execute(
+                'INSERT INTO agreements (name, hs_version) VALUES (?, ?)',
+                (roo.name, str(roo.hs_map.version))).lastrowid
+            for chunk in roo.dataset_chunks(VA=True, chunksize=chunksize):
+                rows = zip(np.full(len(chunk['output_str']), agreement).tolist(),
+                           int_codes[chunk['output_str']].tolist(),
+                           int_codes[chunk['input_str']].tolist(),
+                           chunk['VA_Percentage'].tolist(),
+                           chunk['VA_Complement'].tolist(),
+                           chunk['VA_Alternative'].tolist())
+                self.connection.executemany('INSERT INTO restrictions VALUES (?, ?, ?, ?, ?, ?)', rows)
+
+    def analyze(self):
+        """Gather the statistics letting the query planner pick the right index for each
+        query; run it once after adding a batch of FTAs rather than after every add.
+        """
+        self.connection.execute('ANALYZE')
+
+    def delete(self, name):
+        """Delete an FTA (and its restrictions) by name, if stored, within the current
+        transaction (i.e. without committing; see add() and remove()).
+        """
+        row = self.connection.execute('SELECT id FROM agreements WHERE name = ?', (name,)).fetchone()
+        if row is not None:
+            self.connection.execute('DELETE FROM restrictions WHERE agreement = ?', row)
+            self.connection.execute('DELETE FROM agreements WHERE id = ?', row)
+
+    def remove(self, name):
+        """Delete an FTA (and its restrictions) by name, if stored."""
+        with self.connection:
+            self.delete(name)
+
+    def agreements(self):
+        """Return a dictionary mapping the name of every stored FTA to its HS version."""
+        return dict(self.connection.execute('SELECT name, hs_version FROM agreements ORDER BY name'))
+
+    def agreement_ids(self, names=None):
+        """Return a dictionary mapping agreement id to name (of `names` if given, else of all)."""
+        ids = dict(self.connection.execute('SELECT id, name FROM agreements'))
+        if names is None:
+            return ids
+        unknown = set(names) - set(ids.values())
+        if unknown:
+            print('Agreement not found!', sorted(unknown))
+            raise KeyError
+        return {i: name for i, name in ids.items() if name in names}
+
+    def query(self, input_code='', output_code='', agreements=None):
+        """Return a list of restrictions (agreement name, output, input, VA percentage,
+        VA complement, VA alternative), with HS codes as integers, sorted by agreement,
+        output then input.
+
+        Inputs:
+          `input_code`, `output_code`: strings of two- to six-digit HS code (chapter, heading
+                                       or subheading) to filter on; empty for no filter
+          `agreements`: list of names of FTAs to filter on; None for all
+        """
+        ids = self.agreement_ids(agreements)
+        if not ids:
+            return []
+        # Filtering on agreement (even all of them) keeps the (agreement, ...) indexes usable
+        conditions = ['agreement IN ({})'.format(', '.join('?' * len(ids)))]
+        parameters = list(ids)
+        for column, hs_code in [('input', input_code), ('output', output_code)]:
+            if hs_code:
+                conditions.append('{} BETWEEN ? AND ?'.format(column))
+                parameters.extend(code_range(hs_code))
+        rows = self.connection.execute(
+            'SELECT {} FROM restrictions WHERE {} ORDER BY agreement, output, input'.format(
+                ', '.join(COLUMNS), ' AND '.join(conditions)), parameters)
+        return [(ids[row[0]],) + row[1:] for row in rows]
+
+    def restricting(self, input_code, output_code=''):
+        """Return a sorted list of names of FTAs restricting any input within `input_code`
+        for any output within `output_code` (e.g. every FTA restricting input '7208' for
+        outputs in chapter '87').
+        """
+        ids = self.agreement_ids()
+        found = []
+        for agreement in sorted(ids):
+            conditions = 'agreement = ? AND input BETWEEN ? AND ?'
+            parameters = [agreement, *code_range(input_code)]
+            if output_code:
+                conditions += ' AND output BETWEEN ? AND ?'
+                parameters.extend(code_range(output_code))
+            if self.connection.execute('SELECT 1 FROM restrictions WHERE {} LIMIT 1'.format(conditions),
+                                       parameters).fetchone():
+                found.append(ids[agreement])
+        return sorted(found)
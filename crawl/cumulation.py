@@ -0,0 +1,115 @@
+"""
+cumulation.py
+
+Contains an engine applying diagonal (or bilateral) cumulation to the restrictions
+of an FTA within a cumulation zone of linked FTAs (built on the same version of
+HSMap), returned as a RoO (see RoO.assemble()) supporting the usual export and
+query methods.
+
+Cumulation does not change which rule applies: a good exported under an FTA (the
+base FTA of the zone) must still meet the rule of that FTA for its HS code, with
+its restrictiveness and VA flags. It widens which materials count as originating:
+a material originating in any member of the zone counts as originating under the
+base FTA, hence neither violates a CTC restriction nor counts against a VA
+requirement. A material originates in a member if it is sourced as originating
+from that member (given per member, e.g. from trade data) and the FTA of that
+member has a rule for it.
+
+The restrictions of the base FTA (and of its tariff items) whose input HS code is
+originating in the zone are dropped with one mask over the stored pairs; nothing
+else is recomputed.
+"""
+
+import numpy as np
+
+from compare import common_hs_map
+from roo import RoO
+from store import RestrictionStore, TariffOverlay
+
+## -----------------------------------------------------------------------------
+## Functions
+## -----------------------------------------------------------------------------
+
+def originating_mask(roos, originating):
+    """Return a bitset (boolean array over HS positions) of the materials originating in
+    any member FTA of `roos`.
+
+    Inputs:
+      `originating`: dictionary mapping FTA name to the six-digit HS codes of the materials
+                     sourced as originating from that member; members left out source none
+    """
+    hs_map = common_hs_map(roos)
+    names = [roo.name for roo in roos]
+    unknown = [name for name in originating if name not in names]
+    if unknown:
+        print('Originating materials given for FTAs outside the zone:', unknown)
+        raise KeyError
+    mask = hs_map.get_mask()
+    for roo in roos:
+        hs_codes = originating.get(roo.name, [])
+        if len(hs_codes):
+            positions = hs_map.lookup(hs_codes)
+            # Only materials the member has a rule for can originate there
+            mask[positions[roo.all_rules.rule_ids[positions] >= 0]] = True
+    return mask
+
+
+def drop_rows(indptr, keep):
+    """Return the `indptr` of a CSR array once only the entries where `keep` is True are kept."""
+    kept = np.r_[0, np.cumsum(keep, dtype=np.int64)]
+    return kept[indptr]
+
+
+def cumulate(name, roos, originating, base=None):
+    """Return a RoO named `name` holding the restrictions of the base FTA under cumulation
+    within the zone of the member FTAs `roos` (see the module docstring).
+
+    Inputs:
+      `originating`: dictionary mapping FTA name (a member of `roos`) to the six-digit HS
+                     codes of the materials sourced as originating from that member
+      `base`: name of the FTA the goods are exported under (default: the first of `roos`)
+    """
+    base = roos[0] if base is None else next((roo for roo in roos if roo.name == base), None)
+    if base is None:
+        print('Base FTA not found in the zone!')
+        raise KeyError
+    hs_map = common_hs_map(roos)
+    cumulated = originating_mask(roos, originating)
+
+    # Stored pairs: rows are inputs
+    store = base.restrictions
+    rows = np.repeat(np.arange(len(hs_map)), np.diff(store.indptr))
+    keep = ~cumulated[rows]
+    restrictions = RestrictionStore(hs_map, drop_rows(store.indptr, keep), store.indices[keep], store.data[keep])
+
+    rvc = None
+    if base.rvc is not None:
+        rvc = dict(base.rvc, entry_rules=base.rvc['entry_rules'][keep])
+
+    items = base.tariff_items
+    item_keep = ~cumulated[items.inputs]
+    tariff_items = TariffOverlay(hs_map, items.keys, items.rules, items.types, drop_rows(items.indptr, item_keep),
+                                 items.inputs[item_keep], items.data[item_keep], items.va_flags)
+
+    return RoO.assemble(name, hs_map, base.unique_rules, base.all_rules, base.classified, base.va_flags,
+                        restrictions, rvc, base.tariff_rules, tariff_items)
+
+
+def build_zones(zones, roos):
+    """Return a dictionary mapping zone name to its cumulated RoO (see cumulate()).
+
+    Inputs:
+      `zones`: list of zone definitions, i.e. dictionaries with keys `name`, `agreements`
+               (list of FTA names, the base FTA first) and `originating` (dictionary mapping
+               FTA name to HS codes of originating materials)
+      `roos`: dictionary mapping FTA name to RoO
+    """
+    result = {}
+    for zone in zones:
+        missing = [name for name in zone['agreements'] if name not in roos]
+        if missing:
+            print('Agreements of zone {} not found:'.format(zone['name']), missing)
+            raise KeyError
+        result[zone['name']] = cumulate(zone['name'], [roos[name] for name in zone['agreements']],
+                                        zone['originating'])
+    return result
@@ -0,0 +1,296 @@
+"""
+dataset.py
+
+Contains writers and loaders of the input-output restrictions data set produced by
+RoO.generate_dataset(), for file types that pandas does not handle efficiently.
+
+Arrow IPC (feather) and Parquet need `pyarrow` ('pip install pyarrow'); it is only
+imported when one of these file types is used.
+
+Stata (.dta) and Excel (.xlsx) files are written by dedicated writers streaming the
+data set in chunks (see RoO.dataset_chunks()), instead of through a DataFrame.
+"""
+
+import datetime
+import io
+import itertools
+import struct
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+## -----------------------------------------------------------------------------
+## Constants
+## -----------------------------------------------------------------------------
+
+# Columns holding HS codes; stored dictionary-encoded (i.e. as pandas categoricals)
+HS_COLUMNS = ['output_str', 'input_str']
+
+ARROW_TYPES = ['feather', 'arrow']
+
+# Stata (format 118, i.e. Stata 14 and later) variable types and display formats
+STATA_TYPES = {
+    np.dtype(np.int8): (65530, '%8.0g'),
+    np.dtype(np.int16): (65529, '%8.0g'),
+    np.dtype(np.int32): (65528, '%12.0g'),
+    np.dtype(np.float32): (65527, '%9.0g'),
+    np.dtype(np.float64): (65526, '%10.0g')
+}
+STATA_HS_LABEL = 'hs_code'
+
+# Minimal SpreadsheetML (.xlsx) package; see write_xlsx()
+EXCEL_MAX_ROWS = 1048576
+XLSX_NUMBER = '<c><v>%s</v></c>'
+XLSX_STRING = '<c t="inlineStr"><is><t>{}</t></is></c>'
+XLSX_SHEET_START = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                    '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>')
+XLSX_SHEET_END = '</sheetData></worksheet>'
+XLSX_CONTENT_TYPES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/xl/workbook.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+    '<Override PartName="/xl/styles.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+    '{}</Types>')
+XLSX_CONTENT_TYPE_SHEET = ('<Override PartName="/xl/worksheets/sheet{}.xml" '
+                           'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>')
+XLSX_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+    'Target="xl/workbook.xml"/></Relationships>')
+XLSX_WORKBOOK = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+    'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships"><sheets>{}</sheets></workbook>')
+XLSX_WORKBOOK_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">{}'
+    '<Relationship Id="rId{}" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" '
+    'Target="styles.xml"/></Relationships>')
+XLSX_WORKBOOK_REL_SHEET = ('<Relationship Id="rId{0}" '
+                           'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+                           'Target="worksheets/sheet{0}.xml"/>')
+XLSX_STYLES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+    '<fonts count="1"><font><sz val="11"/><name val="Calibri"/></font></fonts>'
+    '<fills count="1"><fill><patternFill patternType="none"/></fill></fills>'
+    '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+    '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+    '<cellXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/></cellXfs>'
+    '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>'
+    '</styleSheet>')
+
+## -----------------------------------------------------------------------------
+## Functions
+## -----------------------------------------------------------------------------
+
+def import_pyarrow():
+    """Return the `pyarrow` module, or raise ImportError explaining how to get it."""
+    try:
+        import pyarrow
+    except ImportError:
+        print('Arrow and Parquet files need pyarrow; type \'pip install pyarrow\' on the terminal.')
+        raise
+    return pyarrow
+
+
+def to_arrow_table(df):
+    """Convert the data set into a pyarrow Table, with dictionary-encoded HS code columns."""
+    pa = import_pyarrow()
+    df = df.astype({column: 'category' for column in HS_COLUMNS if column in df.columns})
+    return pa.Table.from_pandas(df, preserve_index=False)
+
+
+def write_arrow(df, filepath):
+    """Write the data set as an uncompressed Arrow IPC (feather v2) file, so that
+    load_dataset() can memory-map it.
+    """
+    pa = import_pyarrow()
+    table = to_arrow_table(df)
+    with pa.OSFile(filepath, 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+
+def write_parquet(df, filepath):
+    """Write the data set as a Parquet file, with dictionary-encoded HS code columns."""
+    import_pyarrow()
+    import pyarrow.parquet as pq
+    pq.write_table(to_arrow_table(df), filepath, use_dictionary=HS_COLUMNS)
+
+
+def write_dta(chunks, filepath, hs_map, nobs, label=''):
+    """Write the data set as a Stata (format 118) .dta file, one chunk at a time.
+
+    HS code columns are stored as integers (e.g. 10111), with a value label mapping them
+    back to their six-digit strings (e.g. '010111'); other columns keep their dtype.
+
+    Inputs:
+      `chunks`: iterable (of at least one) dictionaries of equally long arrays (see
+                RoO.dataset_chunks()), with HS code columns given as positions of `hs_map`
+      `filepath`: string of file directory
+      `hs_map`: instance of HSMap the HS positions refer to
+      `nobs`: total number of rows
+      `label`: optional data label
+    """
+    hs_values = hs_map.get_prefixes(6).astype(np.int32)
+    offsets = {}
+
+    def tag(f, name, content=b''):
+        offsets[name] = f.tell()
+        f.write(b'<' + name.encode() + b'>' + content + b'</' + name.encode() + b'>')
+
+    def fixed(text, width):
+        return text.encode('utf-8')[:width - 1].ljust(width, b'\0')
+
+    with open(filepath, 'wb') as f:
+        # Column names and types are taken from the first chunk
+        chunks = iter(chunks)
+        first = next(chunks)
+        columns = list(first)
+        dtypes = [np.dtype(np.int32) if column in HS_COLUMNS else first[column].dtype for column in columns]
+        row = np.dtype([(column, dtype.newbyteorder('<')) for column, dtype in zip(columns, dtypes)])
+
+        timestamp = datetime.datetime.now().strftime('%d %b %Y %H:%M').encode()
+        label = label.encode('utf-8')[:80]
+        f.write(b'<stata_dta><header><release>118</release><byteorder>LSF</byteorder>'
+                + b'<K>' + struct.pack('<H', len(columns)) + b'</K>'
+                + b'<N>' + struct.pack('<Q', nobs) + b'</N>'
+                + b'<label>' + struct.pack('<H', len(label)) + label + b'</label>'
+                + b'<timestamp>' + struct.pack('<B', len(timestamp)) + timestamp + b'</timestamp></header>')
+        tag(f, 'map', b'\0' * 8 * 14)
+        tag(f, 'variable_types', b''.join(struct.pack('<H', STATA_TYPES[dtype][0]) for dtype in dtypes))
+        tag(f, 'varnames', b''.join(fixed(column, 129) for column in columns))
+        tag(f, 'sortlist', b'\0' * 2 * (len(columns) + 1))
+        tag(f, 'formats', b''.join(fixed(STATA_TYPES[dtype][1], 57) for dtype in dtypes))
+        tag(f, 'value_label_names', b''.join(fixed(STATA_HS_LABEL if column in HS_COLUMNS else '', 129)
+                                             for column in columns))
+        tag(f, 'variable_labels', b''.join(fixed('', 321) for column in columns))
+        tag(f, 'characteristics')
+
+        offsets['data'] = f.tell()
+        f.write(b'<data>')
+        written = 0
+        for chunk in itertools.chain([first], chunks):
+            records = np.empty(len(chunk[columns[0]]), dtype=row)
+            for column in columns:
+                records[column] = hs_values[chunk[column]] if column in HS_COLUMNS else chunk[column]
+            f.write(records.tobytes())
+            written += len(records)
+        f.write(b'</data>')
+        if written != nobs:
+            print('Number of rows written ({}) does not match nobs ({})!'.format(written, nobs))
+            raise ValueError
+
+        tag(f, 'strls')
+
+        # Value label table: n, txtlen, off[n], val[n], txt
+        texts = [hs_code.encode() + b'\0' for hs_code in hs_map.database]
+        text_offsets = np.cumsum([0] + [len(text) for text in texts[:-1]]).astype('<i4')
+        table = (struct.pack('<ii', len(texts), sum(len(text) for text in texts)) + text_offsets.tobytes()
+                 + hs_values.astype('<i4').tobytes() + b''.join(texts))
+        tag(f, 'value_labels', b'<lbl>' + struct.pack('<i', len(table)) + fixed(STATA_HS_LABEL, 129)
+            + b'\0' * 3 + table + b'</lbl>')
+
+        offsets['/stata_dta'] = f.tell()
+        f.write(b'</stata_dta>')
+        offsets['eof'] = f.tell()
+
+        names = ['map', 'variable_types', 'varnames', 'sortlist', 'formats', 'value_label_names',
+                 'variable_labels', 'characteristics', 'data', 'strls', 'value_labels', '/stata_dta', 'eof']
+        f.seek(offsets['map'] + len(b'<map>'))
+        f.write(struct.pack('<14Q', 0, *[offsets[name] for name in names]))
+
+
+def write_xlsx(chunks, filepath, hs_map, sheet_name='Sheet1'):
+    """Write the data set as an Excel .xlsx file, one chunk at a time: the worksheet XML
+    is streamed straight into the (zip) package, so memory use does not grow with the
+    number of rows. HS codes are written as (six-digit) strings.
+
+    Rows beyond Excel's limit continue on further sheets ('Sheet1_2', ...), each with
+    its own header.
+
+    Inputs: see write_dta()
+    """
+    def header(columns):
+        return ('<row r="1">' + ''.join(XLSX_STRING.format(column) for column in columns) + '</row>')
+
+    with zipfile.ZipFile(filepath, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=1) as package:
+        sheets, sheet, row = [], None, EXCEL_MAX_ROWS
+        for chunk in chunks:
+            columns = list(chunk)
+            template = '<row r="%d">' + ''.join(XLSX_STRING.format('%s') if column in HS_COLUMNS else XLSX_NUMBER
+                                                for column in columns) + '</row>'
+            values = [hs_map.codes[chunk[column]].tolist() if column in HS_COLUMNS else chunk[column].tolist()
+                      for column in columns]
+            start = 0
+            while start < len(values[0]) or sheet is None:
+                if row == EXCEL_MAX_ROWS:
+                    if sheet is not None:
+                        sheet.write(XLSX_SHEET_END)
+                        sheet.close()
+                    sheets.append(sheet_name if not sheets else '{}_{}'.format(sheet_name, len(sheets) + 1))
+                    sheet = io.TextIOWrapper(package.open('xl/worksheets/sheet{}.xml'.format(len(sheets)), 'w',
+                                                         force_zip64=True), encoding='utf-8')
+                    sheet.write(XLSX_SHEET_START + header(columns))
+                    row = 1
+                stop = min(len(values[0]), start + EXCEL_MAX_ROWS - row)
+                rows = zip(range(row + 1, row + 1 + stop - start), *[column[start:stop] for column in values])
+                sheet.write(''.join(template % record for record in rows))
+                row += stop - start
+                start = stop
+        sheet.write(XLSX_SHEET_END)
+        sheet.close()
+
+        package.writestr('[Content_Types].xml', XLSX_CONTENT_TYPES.format(''.join(
+            XLSX_CONTENT_TYPE_SHEET.format(i + 1) for i in range(len(sheets)))))
+        package.writestr('_rels/.rels', XLSX_RELS)
+        package.writestr('xl/workbook.xml', XLSX_WORKBOOK.format(''.join(
+            '<sheet name="{}" sheetId="{}" r:id="rId{}"/>'.format(name, i + 1, i + 1) for i, name in enumerate(sheets))))
+        package.writestr('xl/_rels/workbook.xml.rels', XLSX_WORKBOOK_RELS.format(''.join(
+            XLSX_WORKBOOK_REL_SHEET.format(i + 1) for i in range(len(sheets))), len(sheets) + 1))
+        package.writestr('xl/styles.xml', XLSX_STYLES)
+
+
+def load_dataset(filepath, columns=None):
+    """Load a data set written by RoO.generate_dataset() into a DataFrame.
+
+    Arrow IPC (.feather/.arrow) files are memory-mapped: numeric columns are handed
+    to pandas without copying, and HS code columns become categoricals sharing a
+    single dictionary. Parquet files are read through a memory map, and other file
+    types fall back to pandas.
+
+    Inputs:
+      `filepath`: string of file directory
+      `columns`: optional list of columns to load
+    """
+    filetype = filepath.rsplit('.', 1)[-1]
+    if filetype in ARROW_TYPES:
+        pa = import_pyarrow()
+        with pa.memory_map(filepath, 'r') as source:
+            table = pa.ipc.open_file(source).read_all()
+        if columns is not None:
+            table = table.select(columns)
+    elif filetype == 'parquet':
+        import_pyarrow()
+        import pyarrow.parquet as pq
+        table = pq.read_table(filepath, columns=columns, memory_map=True)
+    elif filetype == 'csv':
+        return pd.read_csv(filepath, usecols=columns, dtype={column: str for column in HS_COLUMNS})
+    elif filetype == 'dta':
+        return pd.read_stata(filepath, columns=columns)
+    elif filetype == 'xlsx':
+        return pd.read_excel(filepath, usecols=columns, dtype={column: str for column in HS_COLUMNS})
+    else:
+        print('Filetype not recognized!')
+        raise ValueError
+
+    # split_blocks avoids consolidating (hence copying) columns into 2D blocks
+    return table.to_pandas(split_blocks=True)
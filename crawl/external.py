@@ -0,0 +1,247 @@
+"""
+external.py
+
+Contains an out-of-core export of the input-output restrictions data set, of a
+single FTA or of a whole corpus of them, within a memory budget, as a .csv,
+feather (Arrow IPC) or .parquet file.
+
+The rows of every FTA are read block by block from its restriction store, packed
+into fixed-size records whose integer key (agreement, output HS code, input HS
+code) sorts them as the final data set, and gathered into runs of at most the
+budget; every run is sorted and spilled to a temporary file. The runs are then
+merged (k-way) block by block: all buffered rows up to the smallest last key of
+the buffers are final, hence sorted and written at once, and the buffers are
+refilled from their runs. Merged rows are formatted (as a DataFrame) and written in
+sub-blocks, since a formatted row costs far more memory than a record.
+
+Half of the budget goes to the records (runs, merge buffers), half to reading the
+store and formatting rows, each sized from its cost per row; peak memory is thus
+bounded by the budget (plus the store of the FTA being read), whatever the size of
+the data set.
+
+HS codes are keyed by their integer value, so that FTAs using different versions
+of HSMap can be merged into one data set. In feather and parquet files, HS codes
+(and agreement names) are dictionary-encoded, against one dictionary of every HS
+code of the HSMaps of the FTAs, fixed before the first row is written.
+"""
+
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from store import restrictiveness
+
+## -----------------------------------------------------------------------------
+## Constants
+## -----------------------------------------------------------------------------
+
+DEFAULT_BUDGET = 256 * 2 ** 20
+
+# Key: agreement << 40 | output << 20 | input (HS codes as integers, below 2^20)
+CODE_BITS = 20
+AGREEMENT_SHIFT = 2 * CODE_BITS
+CODE_MASK = (1 << CODE_BITS) - 1
+
+RECORD = np.dtype([('key', np.int64), ('VA_Percentage', np.float32),
+                   ('VA_Complement', np.int8), ('VA_Alternative', np.int8)])
+
+# Bytes of memory used per buffered record (the record, sorting indices and copies)
+BYTES_PER_RECORD = 3 * RECORD.itemsize
+# Bytes of memory used per (input, output) pair read from the store (see records())
+BYTES_PER_PAIR = 80
+# Bytes of memory used per row formatted and written (DataFrame, strings, csv buffer or
+# Arrow table)
+BYTES_PER_ROW = 800
+
+# Fewest records buffered per run while merging
+MIN_BLOCK = 256
+
+FILETYPES = ['csv', 'feather', 'arrow', 'parquet']
+
+## -----------------------------------------------------------------------------
+## Functions
+## -----------------------------------------------------------------------------
+
+def records(roo, agreement, block):
+    """Yield arrays of RECORD of the restrictions of `roo` (nonzero only), as agreement
+    number `agreement`, reading about `block` pairs of its store at a time.
+    """
+    store = roo.restrictions
+    codes = roo.hs_map.codes.astype(np.int64)
+    indptr = store.indptr
+    start = 0
+    while start < len(indptr) - 1:
+        # Input positions [start, stop) holding about `block` pairs
+        stop = max(int(np.searchsorted(indptr, indptr[start] + block, side='right')) - 1, start + 1)
+        stop = min(stop, len(indptr) - 1)
+        span = slice(indptr[start], indptr[stop])
+        inputs = np.repeat(np.arange(start, stop), np.diff(indptr[start:stop + 1]))
+        outputs, values = store.indices[span], store.data[span]
+        nonzero = values != 0
+        inputs, outputs, values = inputs[nonzero], outputs[nonzero], values[nonzero]
+        chunk = np.empty(len(values), dtype=RECORD)
+        chunk['key'] = (agreement << AGREEMENT_SHIFT) | (codes[outputs] << CODE_BITS) | codes[inputs]
+        chunk['VA_Percentage'] = values
+        chunk['VA_Complement'] = roo.va_flags[outputs, 0]
+        chunk['VA_Alternative'] = roo.va_flags[outputs, 1]
+        yield chunk
+        start = stop
+
+
+def spill_runs(roos, budget, directory):
+    """Write the records of every FTA of `roos` (an iterable, e.g. a generator building
+    them one at a time) into sorted runs in `directory`, each of at most `budget` bytes
+    of memory. Return (list of run file paths, list of FTA names, sorted array of every HS
+    code of their HSMaps).
+    """
+    run_records = max(budget // (2 * BYTES_PER_RECORD), MIN_BLOCK)
+    read_block = max(budget // (2 * BYTES_PER_PAIR), MIN_BLOCK)
+    runs, names, buffered, size = [], [], [], 0
+    codes = np.empty(0, dtype='U6')
+
+    def spill():
+        run = np.concatenate(buffered)
+        run = run[np.argsort(run['key'], kind='stable')]
+        path = os.path.join(directory, 'run{}.bin'.format(len(runs)))
+        run.tofile(path)
+        runs.append(path)
+
+    for agreement, roo in enumerate(roos):
+        names.append(roo.name)
+        codes = np.union1d(codes, roo.hs_map.codes.astype('U6'))
+        for chunk in records(roo, agreement, read_block):
+            while len(chunk):
+                taken = chunk[:run_records - size]
+                buffered.append(taken)
+                size += len(taken)
+                chunk = chunk[len(taken):]
+                if size == run_records:
+                    spill()
+                    buffered, size = [], 0
+    if size:
+        spill()
+    return runs, names, codes
+
+
+def merge_runs(runs, budget):
+    """Yield arrays of RECORD, sorted by key across all blocks, merging the sorted runs
+    (file paths) with at most `budget` bytes of memory.
+    """
+    block = max(budget // (2 * BYTES_PER_RECORD * (len(runs) + 1)), MIN_BLOCK)
+    files = [open(path, 'rb') for path in runs]
+    try:
+        buffers = [np.fromfile(f, dtype=RECORD, count=block) for f in files]
+        while True:
+            live = [i for i, buffer in enumerate(buffers) if len(buffer)]
+            if not live:
+                return
+            # Rows up to the smallest last key of the buffers are final
+            frontier = min(buffers[i]['key'][-1] for i in live)
+            taken = []
+            for i in live:
+                cut = np.searchsorted(buffers[i]['key'], frontier, side='right')
+                taken.append(buffers[i][:cut])
+                buffers[i] = buffers[i][cut:]
+                if not len(buffers[i]):
+                    buffers[i] = np.fromfile(files[i], dtype=RECORD, count=block)
+            merged = np.concatenate(taken)
+            yield merged[np.argsort(merged['key'], kind='stable')]
+    finally:
+        for f in files:
+            f.close()
+
+
+def code_strings(codes):
+    """Return an object array of six-digit HS code strings from an integer array."""
+    if not len(codes):
+        return np.empty(0, dtype=object)
+    return np.char.zfill(codes.astype('U6'), 6).astype(object)
+
+
+def record_frame(chunk, names=None, VA=False):
+    """Return a DataFrame of the data set (see RoO.restrictions_table()) from an array of
+    RECORD; with an 'agreement' column first if `names` (FTA names) is given.
+    """
+    keys = chunk['key']
+    data = {}
+    if names is not None:
+        data['agreement'] = np.asarray(names, dtype=object)[keys >> AGREEMENT_SHIFT]
+    data.update({
+        'VAAR_dummy': np.ones(len(chunk), dtype=np.int64),
+        'output_str': code_strings((keys >> CODE_BITS) & CODE_MASK),
+        'input_str': code_strings(keys & CODE_MASK),
+        'VA_Percentage': restrictiveness(chunk['VA_Percentage'])
+    })
+    if VA:
+        data.update({'VA_Complement': chunk['VA_Complement'].astype(np.int64),
+                     'VA_Alternative': chunk['VA_Alternative'].astype(np.int64)})
+    return pd.DataFrame.from_dict(data)
+
+
+def arrow_table(df, dictionaries):
+    """Return a pyarrow Table of a DataFrame of the data set (see record_frame()), with the
+    columns of `dictionaries` (dictionary mapping column to sorted array of its values)
+    dictionary-encoded against those arrays, so that every block shares the dictionaries.
+    """
+    import dataset
+    pa = dataset.import_pyarrow()
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    for column, dictionary in dictionaries.items():
+        indices = np.searchsorted(dictionary, df[column].to_numpy(dtype=dictionary.dtype)).astype(np.int32)
+        table = table.set_column(table.schema.get_field_index(column), column,
+                                 pa.DictionaryArray.from_arrays(indices, pa.array(dictionary.tolist())))
+    return table
+
+
+def export(roos, filepath, filetype='csv', VA=False, budget=DEFAULT_BUDGET, temp_directory=None):
+    """Write the data set of an FTA (instance of RoO) or of many (iterable of RoO, with an
+    'agreement' column first), sorted by (agreement,) output then input, as a .csv,
+    feather (Arrow IPC) or .parquet file, using at most `budget` bytes of memory besides
+    the FTAs (budgets below about 1 MiB are exceeded by fixed costs and the MIN_BLOCK
+    floors).
+
+    Inputs:
+      `temp_directory`: where the sorted runs are spilled (default: system temp directory)
+    Output:
+      number of rows written
+    """
+    if filetype not in FILETYPES:
+        print('Filetype not recognized! Available options:', FILETYPES)
+        raise ValueError
+    single = hasattr(roos, 'restrictions')
+    with tempfile.TemporaryDirectory(dir=temp_directory) as directory:
+        runs, names, codes = spill_runs([roos] if single else roos, budget, directory)
+        dictionaries = {'output_str': codes, 'input_str': codes}
+        if single:
+            names = None
+        else:
+            dictionaries['agreement'] = np.array(sorted(set(names)))
+        nrows, writer, sink = 0, None, None
+        rows = max(budget // (2 * BYTES_PER_ROW), MIN_BLOCK)
+        blocks = merge_runs(runs, budget) if runs else [np.empty(0, dtype=RECORD)]
+        try:
+            for chunk in (block[start:start + rows] for block in blocks for start in range(0, max(len(block), 1), rows)):
+                df = record_frame(chunk, names, VA)
+                if filetype == 'csv':
+                    df.to_csv(filepath, mode='w' if writer is None else 'a', header=writer is None, index=False)
+                    writer = True
+                else:
+                    import dataset
+                    pa = dataset.import_pyarrow()
+                    table = arrow_table(df, dictionaries)
+                    if writer is None and filetype == 'parquet':
+                        import pyarrow.parquet as pq
+                        writer = pq.ParquetWriter(filepath, table.schema, use_dictionary=list(dictionaries))
+                    elif writer is None:
+                        sink = pa.OSFile(filepath, 'wb')
+                        writer = pa.ipc.new_file(sink, table.schema)
+                    writer.write_table(table)
+                nrows += len(df)
+        finally:
+            if filetype != 'csv' and writer is not None:
+                writer.close()
+            if sink is not None:
+                sink.close()
+    return nrows
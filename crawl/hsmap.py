@@ -4,20 +4,121 @@ Author: Dean Fanggohans
 Last update: 12:20 EST, November 24, 2019
 """
 
-import pandas as pd
+import csv
+from collections.abc import Mapping, Sequence
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+## -----------------------------------------------------------------------------
+## Constants
+## -----------------------------------------------------------------------------
+
+# Layout of a shared HSMap (see HSMap.publish()): a header of int64 (number of HS codes,
+# number of prefixes, length of version) followed by the version, then the arrays below
+SHARED_HEADER = 128
+SHARED_CODE = 'U6'
 
 ## -----------------------------------------------------------------------------
 ## Class Definition
 ## -----------------------------------------------------------------------------
 
+class PositionIndex(Mapping):
+    """Read-only mapping from HS code to its position within a sorted array of HS codes,
+    found with a binary search; used in place of a dictionary by shared HSMaps.
+    """
+    __slots__ = ('keys',)
+
+    def __init__(self, keys):
+        self.keys = keys
+
+    def find(self, key):
+        i = int(np.searchsorted(self.keys, key))
+        if i == len(self.keys) or self.keys[i] != key:
+            raise KeyError(key)
+        return i
+
+    def __getitem__(self, key):
+        return self.find(key)
+
+    def __iter__(self):
+        return iter(self.keys.tolist())
+
+    def __len__(self):
+        return len(self.keys)
+
+
+class CodeList(Sequence):
+    """Read-only list of HS codes backed by an array of HS codes, whose items and slices
+    are converted to strings on access; used in place of `database` by shared HSMaps, so
+    that the codes are not copied into every process.
+    """
+    __slots__ = ('codes',)
+
+    def __init__(self, codes):
+        self.codes = codes
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return self.codes[key].tolist()
+        return str(self.codes[key])
+
+    def __iter__(self):
+        return iter(self.codes.tolist())
+
+    def __len__(self):
+        return len(self.codes)
+
+
+class SharedBlock(shared_memory.SharedMemory):
+    """Block of shared memory published by HSMap.publish(). Processes attaching it may
+    unregister it from a resource tracker shared with the publishing process (see
+    HSMap.attach()); unlink() registers it again first, so that the tracker is not asked
+    to forget a block it no longer knows.
+    """
+    def unlink(self):
+        resource_tracker.register(self._name, 'shared_memory')
+        super().unlink()
+
+
+class RangeIndex(PositionIndex):
+    """Read-only mapping from HS code prefix to the (start, stop) positions of the HS codes
+    within it, backed by sorted arrays; used in place of `full_map` by shared HSMaps.
+    """
+    __slots__ = ('starts', 'stops')
+
+    def __init__(self, keys, starts, stops):
+        super().__init__(keys)
+        self.starts = starts
+        self.stops = stops
+
+    def __getitem__(self, key):
+        i = self.find(key)
+        return int(self.starts[i]), int(self.stops[i])
+
+
 class HSMap:
     """Represent a version of Harmonized System (HS) Product Nomenclature table
     (up to six-digit level).
 
     Methods:
+      get_positions():
+        Return the (start, stop) positions of given (possibly range of) two- to six-digit HS code(s).
       get_hs_codes():
         Return a list of all HS codes under given (possibly range of) two- to six-digit HS code(s).
+      get_mask():
+        Return a bitset (boolean array over positions) of given (possibly range of) HS code(s).
+      get_levels():
+        Return the position ranges of every chapter, heading or subheading.
+      lookup():
+        Return the positions of many six-digit HS codes at once.
+      publish():
+        Copy the HSMap into shared memory, to be attached by other processes.
+      attach():
+        Return an HSMap backed by shared memory published by another process.
     """
+    __slots__ = ('version', 'database', 'codes', 'positions', 'full_map', 'clause_cache', 'shared')
+
     def __init__(self, version, filename):
         """Initialize an instance of HSMap.
 
@@ -26,33 +127,61 @@ class HSMap:
           `filename`: string of file directory containing the .csv file of the HS Nomenclature
         """
         self.version = version
-        df = pd.read_csv(filename)
-        # self.database = df.loc[df['Tier'] == 3, 'ProductCode'].tolist()
-        self.database = df.loc[(df['isLeaf'] == 1) & ~(df['Code'].str.startswith('99')), 'Code'].tolist()
+        # Read with csv rather than pandas, which is much slower to import
+        with open(filename, newline='', encoding='utf-8') as f:
+            rows = csv.DictReader(f)
+            self.database = [row['Code'] for row in rows if row['isLeaf'] == '1' and not row['Code'].startswith('99')]
+        self.codes = np.array(self.database)
+        self.positions = {hs_code: i for i, hs_code in enumerate(self.database)}
         self.full_map = self.expand_map()
+        # Memoized resolution of rule clauses into HS codes (see Pattern.resolve_clause())
+        self.clause_cache = {}
+        self.shared = None
 
     def __len__(self):
         return len(self.database)
 
     # CREATE A DICTIONARY FOR FASTER ACCESS TO ALL HS CODES
     def expand_map(self):
-        """Given two- to six-digit of HS code (chapter, heading, or subheading),
-        return a list containing all 6-digit HS codes within it.
+        """Return a dictionary mapping every two- to six-digit HS code (chapter, heading,
+        or subheading) to the (start, stop) positions of the 6-digit HS codes within it.
 
         Side note: Could have implemented this as a recursive data structure,
                    but would be slower.
-                   Just want the benefit of hash table (dict) fast look-up.
+                   Just want the benefit of hash table (dict) fast look-up; storing
+                   positions instead of lists avoids copying every code three times.
 
         This implementation assumes given database (which comes from .csv file)
         is already sorted.
         """
         full_map = {}
-        for hs_code in self.database:
-            full_map.setdefault(hs_code[:2], []).append(hs_code)
-            full_map.setdefault(hs_code[:4], []).append(hs_code)
-            full_map.setdefault(hs_code, []).append(hs_code)
+        for i, hs_code in enumerate(self.database):
+            for prefix in (hs_code[:2], hs_code[:4], hs_code):
+                start, _ = full_map.get(prefix, (i, i))
+                full_map[prefix] = (start, i + 1)
         return full_map
 
+    def get_positions(self, hs_code1, hs_code2=''):
+        """Given a range of (or even single) HS codes, return a pair (start, stop) such that
+        `self.database[start:stop]` contains all HS codes in-between.
+
+        Inputs:
+          `hs_code1`, `hs_code2`: strings representing HS code
+        """
+        # Clean HS codes
+        hs_code1 = hs_code1.replace('.', '')
+        hs_code2 = hs_code2.replace('.', '')
+
+        try:
+            start, stop = self.full_map[hs_code1]
+            if hs_code2:
+                stop = self.full_map[hs_code2][1]
+        except KeyError:
+            print("HS code not found!")
+            print('Previous search: ' + (hs_code1 + '-' + hs_code2 if hs_code2 else hs_code1), end='\n\n')
+            raise KeyError
+        return start, stop
+
     # FUNCTION FOR EXTRACTING HS CODES
     def get_hs_codes(self, hs_code1, hs_code2=''):
         """Given a range of (or even single) HS codes, return a list of all HS codes in-between.
@@ -64,27 +193,114 @@ class HSMap:
           A list of all HS codes between `hs_code1` and `hs_code2` (inclusive), or just all HS codes
           contained within `hs_code1` if `hs_code2` is not given.
         """
-        # Clean HS codes
-        hs_code1 = hs_code1.replace('.', '')
-        hs_code2 = hs_code2.replace('.', '')
+        start, stop = self.get_positions(hs_code1, hs_code2)
+        return self.database[start:stop]
+
+    def get_prefixes(self, digits):
+        """Return an integer array of the chapter (digits=2), heading (4) or subheading (6)
+        number of every HS code, in the same order as the database.
+        """
+        return self.codes.astype('U{}'.format(digits)).astype(np.int64)
+
+    def get_levels(self, digits):
+        """Return arrays (labels, starts, stops) of every chapter (digits=2), heading (4) or
+        subheading (6), such that `self.database[starts[i]:stops[i]]` are the HS codes
+        within `labels[i]`.
+        """
+        prefixes = self.codes.astype('U{}'.format(digits))
+        starts = np.flatnonzero(np.r_[True, prefixes[1:] != prefixes[:-1]])
+        stops = np.r_[starts[1:], len(prefixes)]
+        return prefixes[starts], starts, stops
+
+    def get_mask(self, hs_code1='', hs_code2=''):
+        """Return a boolean array (bitset) over the positions of the database, set for all
+        HS codes between `hs_code1` and `hs_code2` (see get_hs_codes()); empty if no HS code
+        is given.
+        """
+        mask = np.zeros(len(self.database), dtype=bool)
+        if hs_code1:
+            start, stop = self.get_positions(hs_code1, hs_code2)
+            mask[start:stop] = True
+        return mask
+
+    def lookup(self, hs_codes):
+        """Return an integer array of the positions of six-digit `hs_codes` (dots allowed),
+        found with a binary search over the (sorted) codes rather than one dictionary look-up
+        per code.
+        """
+        hs_codes = np.asarray(hs_codes, dtype=str)
+        if len(hs_codes):
+            hs_codes = np.char.replace(hs_codes, '.', '')
+        positions = np.searchsorted(self.codes, hs_codes)
+        found = positions < len(self.codes)
+        found[found] = self.codes[positions[found]] == hs_codes[found]
+        if not found.all():
+            print("HS code not found!")
+            print('Unknown HS codes: ' + ', '.join(np.unique(hs_codes[~found])[:10].tolist()), end='\n\n')
+            raise KeyError
+        return positions
+
+    def publish(self, name=None):
+        """Copy the HS codes, and the (start, stop) positions of every chapter, heading and
+        subheading, into a new block of shared memory; return the SharedBlock, whose `name`
+        is passed to HSMap.attach() in other processes.
+
+        The caller owns the block: keep it alive while workers use it, then call `close()`
+        and `unlink()` on it.
+        """
+        labels = np.array(sorted(self.full_map), dtype=SHARED_CODE)
+        bounds = np.array([self.full_map[label] for label in labels.tolist()], dtype=np.int64).reshape(-1, 2)
+        version = str(self.version).encode('utf-8')
+        if len(version) > SHARED_HEADER - 24:
+            print('HSMap version too long to be shared:', self.version)
+            raise ValueError
+
+        n, m = len(self.codes), len(labels)
+        block = SharedBlock(name=name, create=True, size=SHARED_HEADER + (n + m) * 24 + m * 16)
+        header = np.ndarray(3, dtype=np.int64, buffer=block.buf)
+        header[:] = n, m, len(version)
+        block.buf[24:24 + len(version)] = version
+        for array, target in zip([self.codes.astype(SHARED_CODE), labels, bounds[:, 0], bounds[:, 1]],
+                                 HSMap.shared_arrays(block, n, m)):
+            target[:] = array
+        return block
+
+    @staticmethod
+    def shared_arrays(block, n, m):
+        """Return views (codes, labels, starts, stops) over a block of shared memory."""
+        offset = SHARED_HEADER
+        arrays = []
+        for dtype, size in [(SHARED_CODE, n), (SHARED_CODE, m), (np.int64, m), (np.int64, m)]:
+            arrays.append(np.ndarray(size, dtype=dtype, buffer=block.buf, offset=offset))
+            offset += arrays[-1].nbytes
+        return arrays
+
+    @classmethod
+    def attach(cls, name):
+        """Return an HSMap backed by the shared memory block `name` (see publish()),
+        without reading any .csv file: HS codes and positions are views over the block
+        (lists of HS codes are only built for the slices asked for), and dictionary
+        look-ups become binary searches.
+        """
+        try:
+            block = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # Before Python 3.13, attaching registers the block with the resource tracker,
+            # which would remove it when this process exits; unregister it right away
+            block = shared_memory.SharedMemory(name=name)
+            resource_tracker.unregister(block._name, 'shared_memory')
+        n, m, length = np.ndarray(3, dtype=np.int64, buffer=block.buf).tolist()
+        codes, labels, starts, stops = HSMap.shared_arrays(block, n, m)
 
-        if not hs_code2:
-            try:
-                return self.full_map[hs_code1]
-            except KeyError:
-                print("HS code not found!")
-                print('Previous search: ' + hs_code1, end='\n\n')
-                raise KeyError
-        else:
-            try:
-                index_1 = self.database.index(self.full_map[hs_code1][0])
-                index_2 = self.database.index(self.full_map[hs_code2][-1])
-            except KeyError:
-                print("HS code not found!")
-                print('Previous search: ' + hs_code1 + '-' + hs_code2, end='\n\n')
-                raise KeyError
-            else:
-                return self.database[index_1:index_2+1]
+        hs_map = cls.__new__(cls)
+        hs_map.version = bytes(block.buf[24:24 + length]).decode('utf-8')
+        hs_map.codes = codes
+        hs_map.database = CodeList(codes)
+        hs_map.positions = PositionIndex(codes)
+        hs_map.full_map = RangeIndex(labels, starts, stops)
+        hs_map.clause_cache = {}
+        hs_map.shared = block
+        return hs_map
 
     def get_all_hs_codes(self):
         """Return a list of all HS codes."""
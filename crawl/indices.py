@@ -0,0 +1,149 @@
+"""
+indices.py
+
+Contains standard restrictiveness indices of RoO, per (output) HS line and per FTA,
+computed with array reductions over the restriction store and VA flags, and a
+corpus-wide (FTA x HS6) panel of them.
+
+Indices per HS line (output product):
+  `has_rule`: whether a rule applies to the HS line
+  `restricted_share`: share of (six-digit) inputs restricted
+  `ctc_share`: share of inputs restricted by CTC (restrictiveness of 1)
+  `va_weighted`: sum of restrictiveness over restricted inputs, divided by the number of
+                 inputs, i.e. restricted share with VA restrictions weighted by threshold
+  `va_threshold`: lowest VA requirement imposed (NaN if none)
+  `ctc_tier`: widest level of the HS hierarchy around the output whose every HS code is
+              restricted: 3 (change of chapter), 2 (heading), 1 (subheading) or 0 (none)
+  `VA_Complement`, `VA_Alternative`: dummies of the VA requirements of the rule
+"""
+
+import hashlib
+import os
+
+import numpy as np
+import pandas as pd
+
+from store import restrictiveness
+
+## -----------------------------------------------------------------------------
+## Constants
+## -----------------------------------------------------------------------------
+
+INDICES = ['has_rule', 'restricted_share', 'ctc_share', 'va_weighted', 'va_threshold', 'ctc_tier',
+           'VA_Complement', 'VA_Alternative']
+
+# Digits of each tier of ctc_tier (from the widest)
+CTC_TIERS = [(3, 2), (2, 4), (1, 6)]
+
+## -----------------------------------------------------------------------------
+## Functions
+## -----------------------------------------------------------------------------
+
+def level_sizes(hs_map, digits):
+    """Return an integer array of the number of HS codes within the chapter (digits=2),
+    heading (4) or subheading (6) of every HS code.
+    """
+    _, starts, stops = hs_map.get_levels(digits)
+    return np.repeat(stops - starts, stops - starts)
+
+
+def line_indices(roo):
+    """Return a dictionary of arrays (over the HS positions of `roo.hs_map`) of every index
+    in INDICES.
+    """
+    hs_map = roo.hs_map
+    n = len(hs_map)
+    inputs, outputs, values = roo.restrictions.coo()
+    nonzero = values != 0
+    inputs, outputs, values = inputs[nonzero], outputs[nonzero], restrictiveness(values[nonzero])
+
+    count = np.bincount(outputs, minlength=n)
+    va = values < 1
+    thresholds = np.full(n, np.inf)
+    np.minimum.at(thresholds, outputs[va], values[va])
+
+    # Tiers: restricted inputs sharing the chapter/heading/subheading of the output
+    ctc_tier = np.zeros(n, dtype=np.int8)
+    for tier, digits in reversed(CTC_TIERS):
+        prefixes = hs_map.get_prefixes(digits)
+        within = np.bincount(outputs[prefixes[inputs] == prefixes[outputs]], minlength=n)
+        ctc_tier[(count > 0) & (within == level_sizes(hs_map, digits))] = tier
+
+    return {
+        'has_rule': roo.all_rules.rule_ids >= 0,
+        'restricted_share': count / n,
+        'ctc_share': np.bincount(outputs[~va], minlength=n) / n,
+        'va_weighted': np.bincount(outputs, weights=values, minlength=n) / n,
+        'va_threshold': np.where(np.isinf(thresholds), np.nan, thresholds),
+        'ctc_tier': ctc_tier,
+        'VA_Complement': roo.va_flags[:, 0].astype(np.int8),
+        'VA_Alternative': roo.va_flags[:, 1].astype(np.int8)
+    }
+
+
+def line_table(roo):
+    """Return a DataFrame of every index in INDICES, indexed by (output) HS code."""
+    return pd.DataFrame(line_indices(roo), index=pd.Index(roo.hs_map.codes, name='hs_code'))
+
+
+def agreement_indices(roo):
+    """Return a dictionary of indices of a whole FTA, averaged over the HS lines with a rule:
+    `hs_lines` (number of HS lines with a rule), means of `restricted_share`, `ctc_share`,
+    `va_weighted`, `va_threshold` (over HS lines with a VA requirement) and `ctc_tier`, and
+    shares of HS lines with a complement / alternative VA requirement (`cva_share`, `ava_share`).
+    """
+    indices = line_indices(roo)
+    ruled = indices['has_rule']
+    lines = int(np.count_nonzero(ruled))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = {name: float(np.mean(indices[name][ruled])) if lines else np.nan
+                 for name in ['restricted_share', 'ctc_share', 'va_weighted', 'ctc_tier']}
+        thresholds = indices['va_threshold'][ruled]
+        means['va_threshold'] = float(np.nanmean(thresholds)) if np.isfinite(thresholds).any() else np.nan
+    return {
+        'hs_lines': lines,
+        **means,
+        'cva_share': float(np.mean(indices['VA_Complement'][ruled])) if lines else np.nan,
+        'ava_share': float(np.mean(indices['VA_Alternative'][ruled])) if lines else np.nan
+    }
+
+
+def fingerprint(roo):
+    """Return a hex digest of the restrictions, VA flags and rules of a RoO, identifying
+    its indices in a cache.
+    """
+    h = hashlib.sha256()
+    h.update(roo.name.encode('utf-8'))
+    h.update(str(roo.hs_map.version).encode('utf-8'))
+    for array in [roo.restrictions.indptr, roo.restrictions.indices, roo.restrictions.data, roo.va_flags,
+                  roo.all_rules.rule_ids]:
+        h.update(np.ascontiguousarray(array).tobytes())
+    return h.hexdigest()
+
+
+def corpus_panel(roos, cache_directory=None):
+    """Return a tidy DataFrame (one row per FTA and HS line) of the indices in INDICES of
+    every FTA in `roos`, with columns `agreement`, `hs_version` and `hs_code` first.
+
+    If `cache_directory` is given, the indices of each FTA are cached there (as .npz,
+    keyed by fingerprint()), and only computed again when the FTA changed.
+    """
+    frames = []
+    for roo in roos:
+        indices = None
+        if cache_directory is not None:
+            path = os.path.join(cache_directory, 'indices_{}_{}.npz'.format(roo.name, fingerprint(roo)[:16]))
+            if os.path.exists(path):
+                with np.load(path) as data:
+                    indices = {name: data[name] for name in INDICES}
+        if indices is None:
+            indices = line_indices(roo)
+            if cache_directory is not None:
+                os.makedirs(cache_directory, exist_ok=True)
+                np.savez(path, **indices)
+        frame = pd.DataFrame(indices)
+        frame.insert(0, 'hs_code', roo.hs_map.codes)
+        frame.insert(0, 'hs_version', str(roo.hs_map.version))
+        frame.insert(0, 'agreement', roo.name)
+        frames.append(frame)
+    return pd.concat(frames, ignore_index=True)
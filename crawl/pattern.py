@@ -7,6 +7,9 @@ Contains defined constants and patterns related to Rules of Origin, as well as
 user-defined Pattern class (to capture each specific type rule).
 """
 
+import functools
+
+import numpy as np
 import regex
 
 ## -----------------------------------------------------------------------------
@@ -27,6 +30,11 @@ HS_CODE_6_NC = r'(?<!\.)\b(?:\d{2,4}\.?\d{2})\b(?!\.\w)'
 CH_NUMBER = r'(?<!\.)\b(\d\d?)\b(?!\.\d)'
 CH_NUMBER_NC = r'(?<!\.)\b(?:\d\d?)\b(?!\.\d)'
 
+# Tariff item, capturing its subheading (see RoO.build_tariff_items())
+TARIFF_ITEM = r'(?<!\.)\b(\d{4}\.\d{2})\.\w+'
+# Tariff items of every Party, e.g. 'A change to Canadian tariff item 1806.10.10, U.S. tariff item ...'
+NATIONAL_TARIFF_ITEMS = r'A change to (?:Canadian|U\.S\.|Mexican) tariff items?[\w\W]+?(?= from )'
+
 # Group of HS codes (up to tariff item); note the hyphen/en dash
 # Rename if possible?
 HSC_GROUP_8 = r'({0}(?:\-{0})?)'.format(HS_CODE_FULL)
@@ -46,6 +54,10 @@ CH_HSC_RANGE_6_NC = r'(?:{0}(?: through {0})?|{1}(?: through(?: {2})? {1})?)'.fo
 HSC_RANGE_8 = r'(?:heading|subheading|tariff item)s? {0}(?: through {0})?'.format(HS_CODE_FULL)
 HSC_RANGE_8_NC = r'(?:heading|subheading|tariff item)s? {0}(?: through {0})?'.format(HS_CODE_FULL_NC)
 
+# Entire rule of origin within a cleaned text (see RoO.parse_rules()); the first group is the rule,
+# followed by the HS codes it applies to
+RULE = r'((?:A|No|No required) change (?:[\w\W](?!provided))+? {0}[\w\W]+?(?:[^\.\s]\w|\s\d)\.(?=\s+[A-Z0-9]|\s*\Z))'.format(HSC_RANGE_8)
+
 # Multiple group of HS codes
 # Note: This works partly because in the actual patterns, '\.' is always followed by '$',
 #       thus making it always looking for the end (without stopping at the HS' dot)
@@ -192,6 +204,34 @@ categories = {
     #'CTCr': {'CTC': True, 'OTG': False, 'ECT': False, 'EXM': False, 'CVA': False, 'MUL': False},
 }
 
+## -----------------------------------------------------------------------------
+## Functions
+## -----------------------------------------------------------------------------
+
+@functools.lru_cache(maxsize=None)
+def compile_regex(raw):
+    """Compile a regex pattern once per process (on first use) and return it."""
+    return regex.compile(raw)
+
+
+def compile_all(patterns):
+    """Compile every pattern in `patterns` (dict of Pattern) and every Pattern class constant
+    now, instead of on first use.
+
+    Call it in a parent process before starting (forking) worker processes, so that every
+    worker inherits the compiled patterns instead of compiling its own.
+
+    The cache lives in process memory only: it is inherited by forked workers, not by
+    spawned ones (the default start method on Windows and macOS), which compile every
+    pattern again on first use (about 0.23s per worker); compiled regexes cannot be shared
+    across processes otherwise, since they are compiled again when unpickled.
+    """
+    for raw in (Pattern.PATTERN_RANGE, Pattern.PATTERN_SELF_ANTIEXEMPT, Pattern.PATTERN_EXEMPT_TO,
+                Pattern.PATTERN_GROUP_EXEMPT):
+        compile_regex(raw)
+    for pattern in patterns.values():
+        pattern.pattern
+
 ## -----------------------------------------------------------------------------
 ## Class Definition
 ## -----------------------------------------------------------------------------
@@ -210,10 +250,14 @@ class Pattern:
       check():
         Only classify the rule without additional processing.
     """
-    # Class variables
-    PATTERN_RANGE = regex.compile(CH_HSC_RANGE_6)
-    PATTERN_SELF_ANTIEXEMPT = regex.compile(r'any other {0} within'.format(HS_TIER))
-    PATTERN_EXEMPT_TO = regex.compile(HSC_RANGE_8)
+    __slots__ = ('name', 'raw', 'change', 'group', 'exception', 'exemption',
+                 'comp_va', 'alt_va', 'multi_1', 'multi_2', 'indices')
+
+    # Class variables (raw strings; compiled on first use through compile_regex())
+    PATTERN_RANGE = CH_HSC_RANGE_6
+    PATTERN_SELF_ANTIEXEMPT = r'any other {0} within'.format(HS_TIER)
+    PATTERN_EXEMPT_TO = HSC_RANGE_8
+    PATTERN_GROUP_EXEMPT = r'any other {0} within that group'.format(HS_TIER)
 
     def __init__(self, name, pattern, category=None):
         """Initialize an instance of Pattern.
@@ -224,7 +268,7 @@ class Pattern:
           `category`: dict containing the labels of RoO
         """
         self.name = name
-        self.pattern = regex.compile(pattern)
+        self.raw = pattern
         if category:
             self.change = category['CTC']
             self.group = category['OTG']
@@ -236,56 +280,65 @@ class Pattern:
             self.multi_2 = category['MUL2']
             self.indices = self.get_indices()
 
+    @property
+    def pattern(self):
+        """Compiled regular expression; compiled on first access."""
+        return compile_regex(self.raw)
+
     def search(self, hs_codes, rule, hs_map):
         """Return a set of (almost all) restrictions imposed by single rule of origin,
         along with a dictionary containing information which `finalize()` can handle.
 
+        Sets of HS codes are represented as bitsets, i.e. boolean arrays over the
+        positions of `hs_map` (see HSMap.get_mask()).
+
         Inputs:
           `hs_codes`: list of HS codes affected by `rule`
           `rule`: string containing the rule of origin
           `hs_map`: instance of HSMap used to decipher the rule
 
         Output:
-        (restrictions, exemptions, toHandle)
-        `restrictions`: set of unique HS codes restricted according to `rule`
-        `exemptions`: set of unique HS codes "exempted" due to Value Added rules
+        (restrictions, toHandle)
+        `restrictions`: bitset of HS codes restricted (by CTC) according to `rule`
         `toHandle`: dictionary to be handled by finalize()
         """
         # In general, beware of search(): unlike findall(), it might accidentally return None instead of ''
         match = self.pattern.search(rule)
         if match:
-            restrictions, toHandle = {}, {}
+            restrictions, toHandle = hs_map.get_mask(), {}
 
             if self.change:
                 digits = self.classify(match[self.indices['CTC']])
                 if self.group:
-                    restrictions.update(self.get_restrictions(hs_codes, digits, hs_map))
+                    restrictions |= self.get_restrictions(hs_codes, digits, hs_map)
                 else:
                     toHandle['OTG'] = digits
 
             if self.exception:
-                restrictions.update(self.get_exceptions(match[self.indices['ECT']], hs_map))
+                restrictions |= self.get_exceptions(match[self.indices['ECT']], hs_map)
 
             if self.exemption:
                 RVC_0 = Pattern.calculate_rvc(match, self.indices['RVC'])
+                toHandle['RVCs'] = Pattern.rvc_alternatives(match, self.indices['RVC'])
                 exemptions_to = self.get_exemptions_to(match[self.indices['EXM_t']], hs_map)
-                exemptions_from = self.get_exemptions_from(match[self.indices['EXM_f']], RVC_0, hs_codes, hs_map)
+                exemptions_from = self.get_exemptions_from(match[self.indices['EXM_f']], hs_codes, hs_map)
 
                 # Cancel exemption of self within specific HS code
                 # Note: Could refine the constant
-                self_antiexempt = Pattern.PATTERN_SELF_ANTIEXEMPT.search(match[self.indices['EXM_f']])
+                self_antiexempt = compile_regex(Pattern.PATTERN_SELF_ANTIEXEMPT).search(match[self.indices['EXM_f']])
                 exempt_digits = self.classify(self_antiexempt[1]) if self_antiexempt else None
 
-                toHandle['EXM'] = (exemptions_to, exemptions_from, exempt_digits)
+                toHandle['EXM'] = (exemptions_to, exemptions_from, exempt_digits, RVC_0)
 
             if self.comp_va or self.alt_va:
                 toHandle['RVC'] = Pattern.calculate_rvc(match, self.indices['RVC'])
+                toHandle['RVCs'] = Pattern.rvc_alternatives(match, self.indices['RVC'])
 
             # Distinguish between MULTI and RVC, Multi = green, exempt = yellow
             # Consider merging the handler, or make a separate handler for multi
             if self.multi_1 or self.multi_2:
                 # Handle because this must be processed after `restrictions`
-                toHandle['MUL'] = self.get_exemptions_from(match[self.indices['MUL']], 0, hs_codes, hs_map)
+                toHandle['MUL'] = self.get_exemptions_from(match[self.indices['MUL']], hs_codes, hs_map)
 
             return restrictions, toHandle
 
@@ -293,48 +346,55 @@ class Pattern:
             return None
 
     def finalize(self, hs_code, result, hs_map):
-        """Return a list of tuples containing restriction data corresponding to an output product.
+        """Return the restrictions corresponding to an output product, as a pair of arrays
+        over the positions of `hs_map` (input products):
+          `mask`: bitset of restricted HS codes
+          `values`: float32 restrictiveness (only meaningful where `mask` is set), scaling
+                    from 0 to 1, with 1 representing pure CTC and <1 representing VA
+                    requirement percentage
+
+        Restrictions, multi-clauses and exemptions are combined with bitwise operations,
+        each later one overriding the values of the earlier ones through its mask.
 
         Inputs:
           `hs_code`: string of HS code
-          `result`: string containing the rule of origin
+          `result`: output of search()
           `hs_map`: instance of HSMap used to decipher the rule
-
-        Output:
-        `restrictions`: list of tuples (HS code, restrictiveness), where HS code in the tuple
-                        represents an input product, and restrictiveness scales from 0 to 1,
-                        with 1 representing pure CTC and <1 representing VA requirement percentage
         """
         restrictions, toHandle = result
-        exemptions = {}
+        mask = restrictions
 
         if 'OTG' in toHandle:
             digits = toHandle['OTG']
-            restrictions = {**restrictions, **self.get_restrictions([hs_code], digits, hs_map)}
+            mask = mask | self.get_restrictions([hs_code], digits, hs_map)
 
-        if 'EXM' in toHandle:
-            exemptions_to, exemptions_from, exempt_digits = toHandle['EXM']
-            if hs_code in exemptions_to:
-                exemptions = exemptions_from.copy()
-                if exempt_digits:
-                    for hs_code_ in hs_map.get_hs_codes(hs_code[:exempt_digits]):
-                        del exemptions[hs_code_]
+        values = mask.astype(np.float32)
 
         if 'MUL' in toHandle:
-            restrictions = {**restrictions, **toHandle['MUL']}
+            values[toHandle['MUL']] = 0
+            mask = mask | toHandle['MUL']
 
         # Ordering: pure VA should be last
         # Mutually exclusive with exemptions
 
         ## Not included to match Conconi et al.'s approach
         # if self.comp_va:
-        #    complement = set(hs_map.get_all_hs_codes()) - set(restrictions)
-        #    restrictions = {**restrictions, **{hs_code_: toHandle['RVC'] for hs_code_ in complement}}
+        #    values[~mask] = toHandle['RVC']
+        #    mask = np.ones_like(mask)
 
         if self.alt_va:
-            restrictions = {**restrictions, **{hs_code_: toHandle['RVC'] for hs_code_ in restrictions}}
+            values[mask] = toHandle['RVC']
 
-        return {**restrictions, **exemptions}
+        if 'EXM' in toHandle:
+            exemptions_to, exemptions_from, exempt_digits, RVC_0 = toHandle['EXM']
+            if exemptions_to[hs_map.positions[hs_code]]:
+                exemptions = exemptions_from
+                if exempt_digits:
+                    exemptions = exemptions & ~hs_map.get_mask(hs_code[:exempt_digits])
+                values[exemptions] = RVC_0
+                mask = mask | exemptions
+
+        return mask, values
 
     def get_indices(self):
         """Return indices corresponding to each particular type of regex group."""
@@ -359,9 +419,13 @@ class Pattern:
         indices['RVC'] = len(indices) + 1
         return indices
 
-    def check(self, rule):
-        """Check if `rule` belongs to this type of RoO (Pattern)."""
-        if self.pattern.search(rule):
+    def check(self, rule, concurrent=None):
+        """Check if `rule` belongs to this type of RoO (Pattern).
+
+        If `concurrent` is True, the GIL is released while matching, so that several
+        threads can check rules simultaneously.
+        """
+        if self.pattern.search(rule, concurrent=concurrent):
             return True
         return False
 
@@ -379,63 +443,86 @@ class Pattern:
         return digits
 
     @staticmethod
-    def calculate_rvc(match, index):
-        "From 3 (max) possible RVC values, return the lowest one."""
+    def rvc_alternatives(match, index):
+        """Return the list of (up to 3) RVC percentages of a rule, e.g. build-down and build-up."""
         RVCs = []
         for i in range(index, len(match.groups()) + 1):
             if match[i]:
                 RVCs.append(int(match[i]))
-        return min(RVCs) / 100
+        return RVCs
+
+    @staticmethod
+    def calculate_rvc(match, index):
+        "From 3 (max) possible RVC values, return the lowest one."""
+        return min(Pattern.rvc_alternatives(match, index)) / 100
 
     @staticmethod
     def get_restrictions(hs_codes, digits, hs_map):
-        """Handler function for 'CTC' label."""
-        restrictions = {}
-        unique_levels = set([hs_code[:digits] for hs_code in hs_codes])
-        for unique_hs in unique_levels:
-            restrictions.update({hs_code: 1.0 for hs_code in hs_map.get_hs_codes(unique_hs)})
+        """Handler function for 'CTC' label; return a bitset of all HS codes sharing the
+        first `digits` digits with any of `hs_codes`.
+        """
+        restrictions = hs_map.get_mask()
+        for unique_hs in set([hs_code[:digits] for hs_code in hs_codes]):
+            start, stop = hs_map.get_positions(unique_hs)
+            restrictions[start:stop] = True
         return restrictions
 
+    @staticmethod
+    def resolve_clause(clause, hs_map):
+        """Return a (read-only) bitset of all HS codes referred to within `clause` (as
+        chapters, headings, subheadings, or ranges of them), e.g. 'heading 52.04 through 52.12'.
+
+        Memoized per HSMap (keyed by whitespace-normalized clause), hence shared across
+        rules and FTAs using the same HSMap; clauses repeat a lot across rules.
+        """
+        clause = ' '.join(clause.split())
+        key = (Pattern.PATTERN_RANGE, clause)
+        if key not in hs_map.clause_cache:
+            hs_codes = hs_map.get_mask()
+            for ch_1, ch_2, hs_code1, hs_code2 in compile_regex(Pattern.PATTERN_RANGE).findall(clause):
+                if ch_1:
+                    ch_1, ch_2 = ch_1.zfill(2), ch_2.zfill(2) if ch_2 else ch_2
+                    start, stop = hs_map.get_positions(ch_1, ch_2)
+                else:
+                    start, stop = hs_map.get_positions(hs_code1, hs_code2)
+                hs_codes[start:stop] = True
+            hs_codes.flags.writeable = False
+            hs_map.clause_cache[key] = hs_codes
+        return hs_map.clause_cache[key]
+
     @staticmethod
     def get_exceptions(clause, hs_map):
         """Handler function for 'ECT' label."""
-        exceptions = {}
-        for ch_1, ch_2, hs_code1, hs_code2 in Pattern.PATTERN_RANGE.findall(clause):
-            if ch_1:
-                ch_1, ch_2 = ch_1.zfill(2), ch_2.zfill(2) if ch_2 else ch_2
-                exceptions.update({hs_code: 1.0 for hs_code in hs_map.get_hs_codes(ch_1, ch_2)})
-            else:
-                exceptions.update({hs_code: 1.0 for hs_code in hs_map.get_hs_codes(hs_code1, hs_code2)})
-        return exceptions
+        return Pattern.resolve_clause(clause, hs_map)
 
     @staticmethod
     def get_exemptions_to(phrase, hs_map):
-        hs_code1, hs_code2 = Pattern.PATTERN_EXEMPT_TO.findall(phrase)[0]
-        return set(hs_map.get_hs_codes(hs_code1, hs_code2))
+        """Return a (read-only) bitset of HS codes (output) to which exemptions apply;
+        memoized per HSMap, like resolve_clause().
+        """
+        phrase = ' '.join(phrase.split())
+        key = (Pattern.PATTERN_EXEMPT_TO, phrase)
+        if key not in hs_map.clause_cache:
+            hs_code1, hs_code2 = compile_regex(Pattern.PATTERN_EXEMPT_TO).findall(phrase)[0]
+            exemptions_to = hs_map.get_mask(hs_code1, hs_code2)
+            exemptions_to.flags.writeable = False
+            hs_map.clause_cache[key] = exemptions_to
+        return hs_map.clause_cache[key]
 
     @staticmethod
-    def get_exemptions_from(clause, RVC_0, hs_codes, hs_map):
-        """Handler function for 'EXM' label."""
-        exemptions = {}
-        for ch_1, ch_2, hs_code1, hs_code2 in Pattern.PATTERN_RANGE.findall(clause):
-            if ch_1:
-                ch_1, ch_2 = ch_1.zfill(2), ch_2.zfill(2) if ch_2 else ch_2
-                exemptions.update({hs_code: RVC_0 for hs_code in hs_map.get_hs_codes(ch_1, ch_2)})
-            else:
-                exemptions.update({hs_code: RVC_0 for hs_code in hs_map.get_hs_codes(hs_code1, hs_code2)})
+    def get_exemptions_from(clause, hs_codes, hs_map):
+        """Handler function for 'EXM' label; return a bitset of exempted HS codes (input)."""
+        exemptions = Pattern.resolve_clause(clause, hs_map)
 
         # Inside the group, but self
-        group_exempt = regex.compile(r'any other {0} within that group'.format(HS_TIER))
-        if group_exempt.search(clause):
+        if compile_regex(Pattern.PATTERN_GROUP_EXEMPT).search(clause):
             # Assumption, {0} always subheading
-            unique_levels = set([hs_code[:6] for hs_code in hs_codes])
-            for unique_hs in unique_levels:
-                exemptions.update({hs_code: RVC_0 for hs_code in hs_map.get_hs_codes(unique_hs)})
+            exemptions = exemptions | Pattern.get_restrictions(hs_codes, 6, hs_map)
 
         ## IGNORE THIS CASE FOR A WHILE
         # # Rare case, example: "from any subheading outside that group within heading 29.21"
         # anti_exempt = regex.compile(r'any subheading outside that group')
         # if anti_exempt.search(clause):
-        #     exemptions -= Pattern.get_restrictions(hs_codes, 6, hs_map)
+        #     exemptions = exemptions & ~Pattern.get_restrictions(hs_codes, 6, hs_map)
 
         return exemptions
@@ -0,0 +1,127 @@
+"""
+plots.py
+
+Contains plotting functions of RoO restrictions, drawing onto a given matplotlib
+Axes, and a batch renderer writing the standard figures of many FTAs to files.
+
+The batch renderer only uses matplotlib.figure.Figure (never pyplot), so it works
+headless and does not touch the current global figure.
+"""
+
+import os
+
+import numpy as np
+from matplotlib.figure import Figure
+
+## -----------------------------------------------------------------------------
+## Constants
+## -----------------------------------------------------------------------------
+
+FIGSIZE = (15.5, 7.75)
+NUM_CHAPTERS = 98
+
+## -----------------------------------------------------------------------------
+## Functions
+## -----------------------------------------------------------------------------
+
+def chapter_counts(roo):
+    """Return an integer array (indexed by HS chapter number) counting restricted
+    (input, output) pairs by chapter of the input product.
+    """
+    counts = roo.restriction_counts(digits=2)
+    restrictions_by_chapter = np.zeros(NUM_CHAPTERS, dtype=np.int64)
+    restrictions_by_chapter[counts.index.astype(int)] = counts.values
+    return restrictions_by_chapter
+
+
+def scatter_points(roo):
+    """Return arrays (x, y) with one point per restricted input product: its HS chapter
+    divided by 10 (x) and the number of outputs it is restricted for (y).
+    """
+    counts = roo.restriction_counts(digits=6)
+    has_rows = np.diff(roo.restrictions.indptr) > 0
+    return roo.hs_map.get_prefixes(2)[has_rows] / 10, counts.values[has_rows]
+
+
+def reduce_points(x, y, max_points=None):
+    """Reduce the density of a scatter: merge identical points, then (if there are
+    still more than `max_points`) keep an evenly spaced subset of them.
+
+    Output: (x, y, weights), where weights count the original points merged into each.
+    """
+    points, weights = np.unique(np.column_stack([x, y]), axis=0, return_counts=True)
+    if max_points is not None and len(points) > max_points:
+        keep = np.linspace(0, len(points) - 1, max_points).round().astype(np.int64)
+        points, weights = points[keep], weights[keep]
+    return points[:, 0], points[:, 1], weights
+
+
+def plot_chapter_restrictions(roo, ax):
+    """Make a line plot of cumulative roo1 (y-axis) vs HS chapter (x-axis) onto `ax`."""
+    ax.plot(chapter_counts(roo), label=roo.name)
+    ax.set_xlabel('HS Chapter')
+    ax.set_ylabel('Total Restrictiveness Index')
+
+
+def scatter_plot(roo, ax, max_points=None):
+    """Make a scatter plot of roo_1 (y-axis) vs HS chapter (x-axis) onto `ax`.
+
+    If `max_points` is given, identical points are merged (and the rest subsampled), with
+    marker area growing with the number of merged points.
+    """
+    x, y = scatter_points(roo)
+    if max_points is None:
+        ax.scatter(x, y, label=roo.name)
+    else:
+        x, y, weights = reduce_points(x, y, max_points)
+        ax.scatter(x, y, s=20 * np.sqrt(weights), label=roo.name)
+    ax.set_xlabel('HS Chapter (first digit)')
+    ax.set_ylabel('Restrictiveness Index')
+
+
+def render_figures(roos, directory='figures', filetype='png', max_points=2000, overlay=True, dpi=100):
+    """Write the standard figures of every FTA in `roos` to files, and return their paths.
+
+    For each FTA: '<name>_chapters' (see plot_chapter_restrictions()) and '<name>_scatter'
+    (see scatter_plot()); if `overlay` is True, also 'overlay_chapters' and
+    'overlay_scatter' with every FTA drawn onto the same axes.
+
+    Inputs:
+      `roos`: list of instances of RoO
+      `directory`: string of output directory (created if missing)
+      `filetype`: any file type supported by matplotlib (png, pdf, svg, ...)
+      `max_points`: maximum number of points of a scatter (None to draw all of them)
+    """
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+
+    def save(figure, name):
+        path = os.path.join(directory, name + '.' + filetype)
+        figure.savefig(path, dpi=dpi)
+        paths.append(path)
+
+    for roo in roos:
+        figure = Figure(figsize=FIGSIZE)
+        plot_chapter_restrictions(roo, figure.subplots())
+        save(figure, roo.name + '_chapters')
+
+        figure = Figure(figsize=FIGSIZE)
+        scatter_plot(roo, figure.subplots(), max_points)
+        save(figure, roo.name + '_scatter')
+
+    if overlay:
+        figure = Figure(figsize=FIGSIZE)
+        ax = figure.subplots()
+        for roo in roos:
+            plot_chapter_restrictions(roo, ax)
+        ax.legend()
+        save(figure, 'overlay_chapters')
+
+        figure = Figure(figsize=FIGSIZE)
+        ax = figure.subplots()
+        for roo in roos:
+            scatter_plot(roo, ax, max_points)
+        ax.legend()
+        save(figure, 'overlay_scatter')
+
+    return paths
@@ -4,19 +4,26 @@ Author: Dean Fanggohans
 Last modified: 18:30 EST, January 19, 2020
 """
 
-import matplotlib.pyplot as plt
 import numpy as np
-import pandas as pd
 import regex
 
 from collections import Counter
-from pattern import Pattern, raw_patterns, categories, HSC_RANGE_8, HSC_GROUP_8, HSC_GROUP_8_NC
+from concurrent.futures import ThreadPoolExecutor
+from pattern import Pattern, raw_patterns, categories, RULE, TARIFF_ITEM, NATIONAL_TARIFF_ITEMS, HSC_GROUP_8, HSC_GROUP_8_NC
+from store import RuleMap, VAMap, TariffOverlay, RestrictionStore, Rollup, restrictiveness, last_occurrences
 import pprint
 
+# Note: pandas, matplotlib and the modules depending on them (dataset, plots, bom, indices, sweeps) are
+#       imported inside the methods using them, to keep importing this module fast.
+
 ## -----------------------------------------------------------------------------
 ## Globals
 ## -----------------------------------------------------------------------------
 
+# Number of rows per chunk when streaming the data set (see RoO.dataset_chunks())
+DATASET_CHUNKSIZE = 100000
+
+# Patterns are only compiled on first use (see Pattern.pattern)
 search_patterns = {}
 for name, category in categories.items():
     search_patterns[name] = Pattern(name, raw_patterns[name], category)
@@ -33,14 +40,29 @@ class RoO:
         Create a line plot of cumulative roo_1 (y-axis) vs HS chapter (x-axis).
       scatter_plot():
         Create a scatter plot of roo_1 (y-axis) vs HS chapter (x-axis).
+      query_restrictiveness():
+        Return aggregated restrictions of a chapter, heading or subheading (cached rollups).
+      restrictiveness_table():
+        Return aggregated restrictions of every chapter, heading or subheading.
+      restrictiveness_indices():
+        Return standard restrictiveness indices of every HS line.
+      restriction_counts():
+        Return the number of restrictions by HS chapter, heading or subheading of the input.
       restrictions_table():
         Return a list of all HS codes under given (possibly range of) two- to six-digit HS code(s).
+      build_tariff_items():
+        Return the rules of tariff items (beyond six digits) as an overlay over their subheadings.
       get_restrictions():
         Return a list of all restricted outputs given a certain input.
+      evaluate_boms():
+        Return whether each of many bills of materials meets the rules of origin.
+      rvc_sweep():
+        Return the FTA under alternative RVC thresholds, without building it again.
       summarize():
         Print a summary of the FTA (including statistics and debugging functionality).
     """
-    def __init__(self, name, raw_text, hs_map, structured=False, patterns=search_patterns):
+    def __init__(self, name, raw_text, hs_map, structured=False, patterns=search_patterns, workers=None,
+                 build=True, invalid='raise'):
         """Initialize an instance of RoO.
 
         Inputs:
@@ -50,21 +72,99 @@ class RoO:
           `hs_map`: instance of HSMap used throughout the rules
           `structured`:
           `pattern_types`: dict of reference used to classify and process rules of origin
+          `workers`: number of threads used to classify the rules (see classify_rules())
+          `build`: if False, only parse the rules, leaving the classification and restrictions
+                   empty (e.g. to build a subset of the rules; see shards.py)
+          `invalid`: what to do with rules referring to HS codes missing from `hs_map`:
+                     'raise' (stop at the first one with KeyError), 'skip' (leave them out) or
+                     'quarantine' (leave them out, but keep them in `self.quarantined`, mapping
+                     (range of) HS codes to a list of rules); with
+                     'skip' or 'quarantine', every unknown HS code is first reported at once in
+                     `self.invalid_codes` (see validate.validate_rules(); unstructured text only)
         """
         self.name = name
         self.hs_map = hs_map
+        self.invalid_codes = None
+        self.quarantined = {} if invalid == 'quarantine' else None
+        self.tariff_rules = {}
+        if invalid not in ('raise', 'skip', 'quarantine'):
+            print('Option not recognized! Available options: raise, skip, quarantine')
+            raise ValueError
         if structured:
             self.structure = self.parse_structure(raw_text)
             self.unique_rules, self.all_rules = self.expand_rules()
-        else:
+        elif invalid == 'raise':
             self.unique_rules, self.all_rules = self.parse_rules(raw_text)
+        else:
+            import validate
+
+            self.invalid_codes = validate.validate_rules(raw_text, hs_map)
+            skip = set(self.invalid_codes['rule'][self.invalid_codes['source'] == 'rule'].tolist())
+            self.unique_rules, self.all_rules = self.parse_rules(raw_text, skip)
             # self.structure = self.build_structure()
-        self.va_requirements = {hs_code: [0, 0] for hs_code in self.all_rules}
-        self.restrictions = self.build_restrictions(patterns)
+        # Columns: VA_Complement, VA_Alternative; one row per HS position
+        self.va_flags = np.zeros((len(hs_map), 2), dtype=np.uint8)
+        self.rvc = None
+        if build:
+            self.classified = self.classify_rules(patterns, workers)
+            self.restrictions = self.build_restrictions(patterns, skip_invalid=invalid != 'raise')
+            self.tariff_items = self.build_tariff_items(patterns, skip_invalid=invalid != 'raise')
+        else:
+            self.classified = {'hs_code_range': [], 'rule': [], 'types': [], 'hs_count': []}
+            self.restrictions = RestrictionStore.from_coo(hs_map, [], [], [])
+            self.tariff_items = TariffOverlay.from_rows(hs_map, {})
+        self._classification = None
+
+    @classmethod
+    def assemble(cls, name, hs_map, unique_rules, all_rules, classified, va_flags, restrictions, rvc=None,
+                 tariff_rules=None, tariff_items=None):
+        """Return an instance of RoO from its already computed attributes (e.g. merged from
+        shards; see shards.py), without parsing any text; the raw RVC alternatives `rvc`
+        (see build_restrictions()) and tariff item rules are left empty if not given.
+        """
+        roo = cls.__new__(cls)
+        roo.name = name
+        roo.hs_map = hs_map
+        roo.unique_rules = unique_rules
+        roo.all_rules = all_rules
+        roo.va_flags = va_flags
+        roo.classified = classified
+        roo.restrictions = restrictions
+        roo._classification = None
+        roo.invalid_codes = None
+        roo.quarantined = None
+        roo.rvc = rvc
+        roo.tariff_rules = {} if tariff_rules is None else tariff_rules
+        roo.tariff_items = TariffOverlay.from_rows(hs_map, {}) if tariff_items is None else tariff_items
+        return roo
 
     def __len__(self):
         return len(self.all_rules)
 
+    @property
+    def classification(self):
+        """DataFrame recording the classification of every unique rule (see classify_rules()),
+        created on first access.
+        """
+        if self._classification is None:
+            self._classification = RoO.classification_frame(self.classified)
+        return self._classification
+
+    @property
+    def restrictions(self):
+        """RestrictionStore of the FTA; reassigning it clears the cached rollups."""
+        return self._restrictions
+
+    @restrictions.setter
+    def restrictions(self, restrictions):
+        self._restrictions = restrictions
+        self._rollups = {}
+
+    @property
+    def va_requirements(self):
+        """Mapping from (output) HS code to a pair of flags (VA_Complement, VA_Alternative)."""
+        return VAMap(self.all_rules, self.va_flags)
+
     def parse_structure(self, raw_text):
         """Given a complete text of Specific Rules of Origin, return a dictionary representing
         the complete hierarchical structure of RoO (from sections to chapters).
@@ -99,154 +199,399 @@ class RoO:
     def expand_rules(self):
         """Return a dictionary mapping (range of) HS codes to a rule of origin, both
         represented as strings; essentially storing the rules without stuctures.
+        Also return a RuleMap of the rule imposed on every HS code.
         """
-        unique_rules, all_rules = {}, {}
+        unique_rules, rules_at = {}, {}
         # UPDATE: WILL NOT ALLOW TARIFF ITEM RULES -> instead of directly compiling HS_RANGE, use a modified version
         pattern_range = regex.compile(HSC_GROUP_8)
         for section in self.structure:
             for chapter in self.structure[section]:
                 for hs_code_range, rule in self.structure[section][chapter].items():
-                    # Ignore tariff item
+                    # Tariff item rules are kept apart (see build_tariff_items())
                     if len(hs_code_range.split('-')[0].replace('.', '')) > 6:
+                        self.tariff_rules[hs_code_range.replace('.', '')] = rule
                         continue
                     unique_rules[hs_code_range] = rule
 
                     # I use findall instead of search since it returns '' instead of None
                     result = pattern_range.findall(hs_code_range)
-                    hs_codes = self.hs_map.get_hs_codes(result[0][1], result[0][2])
-                    for hs_code in hs_codes:
-                        all_rules[hs_code] = rule
+                    start, stop = self.hs_map.get_positions(result[0][1], result[0][2])
+                    for position in range(start, stop):
+                        rules_at[position] = [rule]
 
-        return unique_rules, all_rules
+        return unique_rules, RuleMap.from_positions(self.hs_map, rules_at)
 
-    def parse_rules(self, raw_text):
+    def parse_rules(self, raw_text, skip=()):
         """Given a complete text of Specific Rules of Origin, return a dictionary
-        mapping (range of) HS codes to a rule of origin, both represented as strings.
+        mapping (range of) HS codes to a rule of origin, both represented as strings,
+        and a RuleMap of the (joined) rules imposed on every HS code.
 
         Sort of like parse_roo() combined with expand_rules(), but without having to
         rely on RoO hierarchical structure.
 
+        Tariff item rules (more than six digits) are put into `self.tariff_rules` instead,
+        mapping dot-free tariff item to rule.
+
         Inputs:
           `raw_text`: string containing the entire text of RoO
+          `skip`: indices (in order of appearance) of rules to leave out (see validate.py);
+                  put into `self.quarantined` if it is kept
         """
         # Clean whitespaces; replace en dash with hyphen
         # Code below assumes no multiple adjacent whitespaces; see previous code to rollback
         roo_text = regex.sub(r'\s?[–\-]\s?', '-', regex.sub(r'\s+', ' ', raw_text))
-        unique_rules, all_rules = {}, {}
+        unique_rules, rules_at, tariff_rules = {}, {}, {}
 
         # Capture all rules simultanously
-        pattern_rule_v2 = regex.compile(r'((?:A|No|No required) change (?:[\w\W](?!provided))+? {0}[\w\W]+?(?:[^\.\s]\w|\s\d)\.(?=\s+[A-Z0-9]|\s*\Z))'.format(HSC_RANGE_8))
-        for match in pattern_rule_v2.findall(roo_text):
+        pattern_rule_v2 = regex.compile(RULE)
+        for index, match in enumerate(pattern_rule_v2.findall(roo_text)):
             hs_code1 = match[1].replace('.', '')
             hs_code2 = match[2].replace('.', '')
 
-            # Ignore tariff item
+            hs_code_range = hs_code1 + '-' + hs_code2 if hs_code2 else hs_code1
+            # Tariff item rules are kept apart (see build_tariff_items())
             if len(hs_code1) > 6 or len(hs_code2) > 6:
+                tariff_rules.setdefault(hs_code_range, []).append(match[0])
+                continue
+            if index in skip:
+                if self.quarantined is not None:
+                    self.quarantined.setdefault(hs_code_range, []).append(match[0])
                 continue
-
-            hs_code_range = hs_code1 + '-' + hs_code2 if hs_code2 else hs_code1
             unique_rules.setdefault(hs_code_range, []).append(match[0])
 
-            hs_codes = self.hs_map.get_hs_codes(hs_code1, hs_code2)
-            for hs_code in hs_codes:
-                all_rules.setdefault(hs_code, []).append(match[0])
+            start, stop = self.hs_map.get_positions(hs_code1, hs_code2)
+            for position in range(start, stop):
+                rules_at.setdefault(position, []).append(match[0])
+
+        self.tariff_rules = {k: ' '.join(v) for k, v in tariff_rules.items()}
+        return {k: ' '.join(v) for k, v in unique_rules.items()}, RuleMap.from_positions(self.hs_map, rules_at)
+
+    def classify_rules(self, patterns, workers=None, hs_code_ranges=None):
+        """Return a dictionary recording the classification of every unique rule, as lists
+        (in the order of `self.unique_rules`) of:
+          `hs_code_range`: string of (range of) HS codes
+          `rule`: string containing the rule of origin
+          `types`: tuple of names of every pattern matching the rule
+          `hs_count`: number of six-digit HS codes covered by the rule
+
+        This is the only place where rules are matched against every pattern;
+        build_restrictions(), summarize() and generate_report() all reuse it.
+
+        If `workers` is given, rules are matched by a pool of that many threads, with the
+        GIL released during matching (regex's `concurrent` mode); results are collected in
+        the original order, so the classification is the same as a serial one.
+
+        If `hs_code_ranges` is given, only these keys of `self.unique_rules` are classified.
+        """
+        def match_types(rule):
+            return tuple(name for name, pattern in patterns.items() if pattern.check(rule, concurrent))
+
+        if hs_code_ranges is None:
+            hs_code_ranges = list(self.unique_rules)
+        rules = [self.unique_rules[hs_code_range] for hs_code_range in hs_code_ranges]
+        concurrent = bool(workers)
+        if workers:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                types = list(executor.map(match_types, rules))
+        else:
+            types = [match_types(rule) for rule in rules]
+
+        pattern_range = regex.compile(HSC_GROUP_8)
+        hs_count = []
+        for hs_code_range in hs_code_ranges:
+            result = pattern_range.findall(hs_code_range)
+            start, stop = self.hs_map.get_positions(result[0][1], result[0][2])
+            hs_count.append(stop - start)
 
-        return {k: ' '.join(v) for k, v in unique_rules.items()}, {k: ' '.join(v) for k, v in all_rules.items()}
+        return {'hs_code_range': list(hs_code_ranges), 'rule': rules, 'types': types, 'hs_count': hs_count}
 
-    def build_restrictions(self, patterns):
-        """Return a dictionary mapping each (output) HS code to a list of tuples
-        (hs_code, restrictiveness), where:
-          `hs_code`: string of HS code representing input product
-          `restrictiveness`: float (0, 1] representing CTC (value of 1) or
-                             VA requirement percentage (value of less than 1)
+    @staticmethod
+    def classification_frame(classified):
+        """Return a DataFrame (indexed by (range of) HS codes) of a classification given by
+        classify_rules(), adding the columns:
+          `type`: name of the first matching pattern (None if uncaptured)
+          `uncaptured`, `duplicate`: bool flags (no matching pattern / more than one)
+        """
+        import pandas as pd
+
+        classification = pd.DataFrame({key: classified[key] for key in ['rule', 'types', 'hs_count']},
+                                      index=pd.Index(classified['hs_code_range'], name='hs_code_range'))
+        num_types = classification['types'].str.len()
+        classification['type'] = classification['types'].str[0].where(num_types > 0, None)
+        classification['uncaptured'] = num_types == 0
+        classification['duplicate'] = num_types > 1
+        return classification
+
+    def build_restrictions(self, patterns, skip_invalid=False):
+        """Return a RestrictionStore, i.e. a sparse matrix mapping each (input) HS code
+        to the (output) HS codes it is restricted for, along with the restrictiveness:
+        float (0, 1] representing CTC (value of 1) or VA requirement percentage
+        (value of less than 1).
+
+        Rules are classified according to `self.classified` (see classify_rules()); see
+        restriction_triplets() for `skip_invalid`.
+
+        Also keeps the raw RVC alternatives of every rule in `self.rvc` (see sweeps.py), so
+        that VA thresholds can be changed without building again:
+          `alternatives`: (rules x 3) int8 array of RVC percentages (-1 where none)
+          `entry_rules`: index of the rule imposing each stored pair (order of the store)
+          `output_rules`: index of the last rule with an RVC setting the VA flags of each HS
+                          position (-1 if none)
+        """
+        n_rules = len(self.classified['rule'])
+        rvc = {'alternatives': np.full((n_rules, 3), -1, dtype=np.int8),
+               'output_rules': np.full(len(self.hs_map), -1, dtype=np.int32)}
+        rules, inputs, outputs, values = self.restriction_triplets(patterns, self.classified, skip_invalid, rvc)
+        _, last = last_occurrences(len(self.hs_map), inputs, outputs)
+        rvc['entry_rules'] = rules[last].astype(np.int32)
+        self.rvc = rvc
+        return RestrictionStore.from_coo(self.hs_map, inputs, outputs, values)
+
+    def build_tariff_items(self, patterns, skip_invalid=False):
+        """Return a TariffOverlay of the rules of `self.tariff_rules`, each resolved against
+        the subheading it belongs to (e.g. 1806.10 for tariff item 1806.10.aa), as if it were
+        the rule of that subheading; national tariff lines are never enumerated. Tariff items
+        referred to within the rule are likewise resolved to their subheadings, the finest
+        level of input products; tariff items listed per Party (NAFTA) become the tariff item
+        of the rule.
+
+        Rules matching no pattern are kept without restrictions. If `skip_invalid` is True,
+        a rule referring to an HS code missing from the HSMap (including its subheading) is
+        left out (and put into `self.quarantined` if it is kept) instead of raising KeyError.
+        """
+        rows = {}
+        pattern_item, pattern_national = regex.compile(TARIFF_ITEM), regex.compile(NATIONAL_TARIFF_ITEMS)
+        for key, rule in self.tariff_rules.items():
+            parent = key[:6]
+            resolved = pattern_national.sub('A change to tariff item {}.{}'.format(parent[:4], parent[4:]), rule)
+            resolved = pattern_item.sub(r'\1', resolved)
+            types = tuple(name for name, pattern in patterns.items() if pattern.check(resolved))
+            try:
+                if parent not in self.hs_map.positions:
+                    print('Subheading of tariff item not found:', key)
+                    raise KeyError(parent)
+                if types:
+                    pattern = patterns[types[0]]
+                    mask, values = pattern.finalize(parent, pattern.search([parent], resolved, self.hs_map), self.hs_map)
+            except KeyError:
+                if not skip_invalid:
+                    raise
+                if self.quarantined is not None:
+                    self.quarantined.setdefault(key, []).append(rule)
+                continue
+            if types:
+                restricted = np.flatnonzero(mask)
+                rows[key] = (rule, types, restricted, values[restricted], self.va_types(types[0]))
+            else:
+                rows[key] = (rule, types, np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32), (False, False))
+        return TariffOverlay.from_rows(self.hs_map, rows)
+
+    def restriction_triplets(self, patterns, classified, skip_invalid=False, rvc=None):
+        """Return arrays (rules, inputs, outputs, values) of every restriction imposed by the
+        rules of `classified` (see classify_rules()), in the order they are imposed, where
+        `rules` is the index (within `classified`) of the rule imposing it; also sets the
+        VA flags of the output products.
+
+        A later triplet overrides an earlier one with the same (input, output) pair (see
+        RestrictionStore.from_coo()).
 
-        Side note: Order of output-input can be exchanged, or even better, use
-                   numpy array then transpose.
+        If `skip_invalid` is True, a rule referring to an HS code missing from the HSMap
+        imposes no restriction (and is put into `self.quarantined` if it is kept) instead
+        of raising KeyError.
+
+        If `rvc` is given (see build_restrictions()), its `alternatives` and `output_rules`
+        are filled along the way.
         """
-        restrictions = {}
+        rules, inputs, outputs, values = [], [], [], []
+        positions = self.hs_map.positions
         pattern_range = regex.compile(HSC_GROUP_8)
-        for hs_code_range, rule in self.unique_rules.items():
+        for index, (hs_code_range, rule, types) in enumerate(zip(classified['hs_code_range'], classified['rule'],
+                                                                 classified['types'])):
+            if not types:
+                continue
+            name = types[0]
             # Get HS codes
             result = pattern_range.findall(hs_code_range)
-            hs_codes = self.hs_map.get_hs_codes(result[0][1], result[0][2])
+            start, stop = self.hs_map.get_positions(result[0][1], result[0][2])
+            hs_codes = self.hs_map.database[start:stop]
 
-            # Classify the rules
-            for name, pattern in patterns.items():
+            # Assuming a rule only belongs to one type (i.e. the first matching one)
+            pattern = patterns[name]
+            try:
                 result = pattern.search(hs_codes, rule, self.hs_map)
-                if result:
-                    for hs_final in hs_codes:
-                        # Added code below to classify va_c or va_a
-                        self.classify_va(hs_final, name)
-                        all_restrictions = pattern.finalize(hs_final, result, self.hs_map)
-                        for hs_intermediate, restrictiveness in all_restrictions.items():
-                            restrictions.setdefault(hs_intermediate, {}).update({hs_final: restrictiveness})
-                    # Assuming a rule only belongs to one type
-                    break
-
-        return restrictions
-
-    def plot_chapter_restrictions(self):
-        """Make a line plot of cumulative roo1 (y-axis) vs HS chapter (x-axis)."""
-        freq = Counter()
-        for hs_code, restrictions in self.restrictions.items():
-            for restrictiveness in restrictions.values():
-                if restrictiveness == 0:
-                    continue
-                freq[hs_code[:2]] += 1
-
-        restrictions_by_chapter = [0 for i in range(98)]
-        for key, value in freq.items():
-            restrictions_by_chapter[int(key)] = value
-
-        plt.plot(restrictions_by_chapter, label=self.name)
-        plt.xlabel('HS Chapter')
-        plt.ylabel('Total Restrictiveness Index')
-
-    def scatter_plot(self):
-        """Make a scatter plot of roo_1 (y-axis) vs HS chapter (x-axis)."""
-        chapters = []
-        restrictiveness_index = []
-        for hs_code, restrictions in self.restrictions.items():
-            count = 0
-            for restrictiveness in restrictions.values():
-                if restrictiveness == 0:
-                    continue
-                count += 1
-            chapters.append(int(hs_code[:2])/10)
-            restrictiveness_index.append(count)
-
-        plt.scatter(chapters, restrictiveness_index, label=self.name)
-        plt.xlabel('HS Chapter (first digit)')
-        plt.ylabel('Restrictiveness Index')
-
-    def restrictions_table(self, VA=False):
-        """Return a DataFrame representing the final data set."""
-        data = {'VAAR_dummy': [], 'output_str': [], 'input_str': [], 'VA_Percentage': []}
+                finalized = [pattern.finalize(hs_final, result, self.hs_map) for hs_final in hs_codes]
+            except KeyError:
+                if not skip_invalid:
+                    raise
+                if self.quarantined is not None:
+                    self.quarantined.setdefault(hs_code_range, []).append(rule)
+                continue
+            # Added code below to classify va_c or va_a
+            self.classify_va(slice(start, stop), name)
+            if rvc is not None and 'RVCs' in result[1]:
+                RVCs = result[1]['RVCs']
+                rvc['alternatives'][index, :len(RVCs)] = RVCs
+                if name.endswith('+RVC') or '_or_' in name:
+                    rvc['output_rules'][start:stop] = index
+            for hs_final, (mask, all_values) in zip(hs_codes, finalized):
+                restricted = np.flatnonzero(mask)
+                rules.append(np.full(len(restricted), index, dtype=np.int32))
+                inputs.append(restricted.astype(np.int32))
+                outputs.append(np.full(len(restricted), positions[hs_final], dtype=np.int32))
+                values.append(all_values[restricted])
+
+        if not inputs:
+            return (np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32),
+                    np.empty(0, dtype=np.float32))
+        return np.concatenate(rules), np.concatenate(inputs), np.concatenate(outputs), np.concatenate(values)
+
+    def plot_chapter_restrictions(self, ax=None):
+        """Make a line plot of cumulative roo1 (y-axis) vs HS chapter (x-axis), onto `ax`
+        if given (otherwise onto the current figure).
+        """
+        import matplotlib.pyplot as plt
+        import plots
+
+        plots.plot_chapter_restrictions(self, plt.gca() if ax is None else ax)
+
+    def scatter_plot(self, ax=None, max_points=None):
+        """Make a scatter plot of roo_1 (y-axis) vs HS chapter (x-axis), onto `ax` if given
+        (otherwise onto the current figure); see plots.scatter_plot() for `max_points`.
+        """
+        import matplotlib.pyplot as plt
+        import plots
+
+        plots.scatter_plot(self, plt.gca() if ax is None else ax, max_points)
+
+    def get_rollup(self, side='input'):
+        """Return the (cached) Rollup of restrictions by HS code of the input or output
+        product; computed once, until `self.restrictions` changes.
+        """
+        if side not in self._rollups:
+            self._rollups[side] = Rollup(self.hs_map, self.restrictions, self.va_flags, side)
+        return self._rollups[side]
+
+    def query_restrictiveness(self, hs_code, side='input'):
+        """Return a dictionary of aggregated restrictions (number of HS codes, number of
+        restricted pairs, mean restrictiveness, CTC/VA shares, CVA/AVA shares) of a chapter,
+        heading or subheading of the input or output product.
+
+        Input:
+          `hs_code`: string of two- to six-digit HS code, e.g. '87', '87.03' or '8703.21'
+          `side`: 'input' or 'output'
+        """
+        return self.get_rollup(side).query(hs_code)
+
+    def restrictiveness_table(self, digits=2, side='input'):
+        """Return a DataFrame of aggregated restrictions (see query_restrictiveness()) of
+        every HS chapter (digits=2), heading (4) or subheading (6) of the input or output
+        product, indexed by HS code prefix.
+        """
+        return self.get_rollup(side).table(digits)
+
+    def restrictiveness_indices(self):
+        """Return a DataFrame of standard restrictiveness indices (restricted share, CTC share,
+        VA-weighted share, VA threshold, CTC tier, CVA/AVA dummies) of every (output) HS line,
+        indexed by HS code; see indices.py. Computed once, until `self.restrictions` changes.
+        """
+        import indices
+
+        if 'indices' not in self._rollups:
+            self._rollups['indices'] = indices.line_table(self)
+        return self._rollups['indices']
+
+    def agreement_indices(self):
+        """Return a dictionary of restrictiveness indices of the whole FTA, averaged over the
+        HS lines with a rule; see indices.agreement_indices().
+        """
+        import indices
+
+        return indices.agreement_indices(self)
+
+    def restriction_counts(self, digits=6):
+        """Return a Series counting restricted (input, output) pairs by HS chapter (digits=2),
+        heading (4) or subheading (6) of the input product, indexed by HS code prefix.
+        """
+        return self.restrictiveness_table(digits, 'input')['count']
+
+    def restrictions_table(self, VA=False, tariff_items=False):
+        """Return a DataFrame representing the final data set.
+
+        If `tariff_items` is True, the restrictions of tariff item rules (see
+        build_tariff_items()) are appended, with the tariff item (e.g. '18061010') as
+        output; the rows of its subheading still hold for the other tariff items.
+        """
+        import pandas as pd
+
+        inputs, outputs, values = self.restrictions.coo()
+        nonzero = values != 0
+        inputs, outputs, values = inputs[nonzero], outputs[nonzero], values[nonzero]
+        output_str = self.hs_map.codes[outputs].astype(object)
+        va_flags = self.va_flags[outputs]
+        if tariff_items:
+            items, item_inputs, item_values = self.tariff_items.coo()
+            nonzero = item_values != 0
+            items, item_inputs, item_values = items[nonzero], item_inputs[nonzero], item_values[nonzero]
+            inputs, values = np.concatenate([inputs, item_inputs]), np.concatenate([values, item_values])
+            output_str = np.concatenate([output_str, self.tariff_items.keys[items].astype(object)])
+            va_flags = np.concatenate([va_flags, self.tariff_items.va_flags[items]])
+        data = {
+            'VAAR_dummy': np.ones(len(values), dtype=np.int64),
+            'output_str': output_str,
+            'input_str': self.hs_map.codes[inputs].astype(object),
+            'VA_Percentage': restrictiveness(values)
+        }
         if VA:
-            data.update({'VA_Complement': [], 'VA_Alternative': []})
-        for hs_intermediate, restrictions in self.restrictions.items():
-            for hs_final, restrictiveness in restrictions.items():
-                if restrictiveness == 0:
-                    continue
-                data['VAAR_dummy'].append(1)
-                data['output_str'].append(hs_final)
-                data['input_str'].append(hs_intermediate)
-                data['VA_Percentage'].append(restrictiveness)
-                if VA:
-                    data['VA_Complement'].append(self.va_requirements[hs_final][0])
-                    data['VA_Alternative'].append(self.va_requirements[hs_final][1])
+            data.update({'VA_Complement': va_flags[:, 0].astype(np.int64),
+                         'VA_Alternative': va_flags[:, 1].astype(np.int64)})
         return pd.DataFrame.from_dict(data)
 
-    def classify_va(self, hs_code, pattern_name):
+    def dataset_chunks(self, VA=False, chunksize=DATASET_CHUNKSIZE):
+        """Yield the final data set (see restrictions_table()), sorted by output then input,
+        in chunks of at most `chunksize` rows; always yield at least one (possibly empty) chunk.
+
+        Each chunk is a dictionary of numpy arrays, with HS code columns ('output_str',
+        'input_str') given as positions of `self.hs_map` rather than strings.
+        """
+        inputs, outputs, values = self.restrictions.coo()
+        nonzero = values != 0
+        inputs, outputs, values = inputs[nonzero], outputs[nonzero], values[nonzero]
+        order = np.lexsort((inputs, outputs))
+        for start in range(0, max(len(order), 1), chunksize):
+            rows = order[start:start + chunksize]
+            chunk = {
+                'VAAR_dummy': np.ones(len(rows), dtype=np.int8),
+                'output_str': outputs[rows],
+                'input_str': inputs[rows],
+                'VA_Percentage': restrictiveness(values[rows])
+            }
+            if VA:
+                chunk.update({'VA_Complement': self.va_flags[outputs[rows], 0].astype(np.int8),
+                              'VA_Alternative': self.va_flags[outputs[rows], 1].astype(np.int8)})
+            yield chunk
+
+    def classify_va(self, positions, pattern_name):
         """Helper function to classify whether there is a complement VA requirement
         or alternative VA requirement within a rule.
+
+        Inputs:
+          `positions`: HS position(s) of output products (integer, slice or array)
+          `pattern_name`: string representing the type of RoO
         """
+        complement, alternative = self.va_types(pattern_name)
+        if complement:
+            self.va_flags[positions, 0] = 1
+        if alternative:
+            self.va_flags[positions, 1] = 1
+
+    @staticmethod
+    def va_types(pattern_name):
+        """Return whether a type of RoO has a (complement, alternative) VA requirement."""
         # Complementary
-        if pattern_name.endswith('+RVC') and '_or_' not in pattern_name:
-            self.va_requirements[hs_code][0] = 1
+        complement = pattern_name.endswith('+RVC') and '_or_' not in pattern_name
         # Alternative
-        if '_or_' in pattern_name:
-            self.va_requirements[hs_code][1] = 1
+        alternative = '_or_' in pattern_name
+        return complement, alternative
 
     def get_restrictions(self, hs_intermediate):
         """Return a list of restricted HS codes of final product (output) given
@@ -256,11 +601,31 @@ class RoO:
           `hs_intermediate`: string of HS code, representing an input product
         """
         if hs_intermediate in self.restrictions:
-            return sorted([hs_final for hs_final in self.restrictions[hs_intermediate]])
+            outputs, _ = self.restrictions.row(self.hs_map.positions[hs_intermediate])
+            return self.hs_map.codes[outputs].tolist()
         else:
             print('This HS Code does not have any rules imposed.')
 
-    def summarize(self, type_='', patterns=search_patterns, only=None,
+    def evaluate_boms(self, outputs, materials):
+        """Return a DataFrame telling, for each bill of materials (output HS code and its
+        non-originating materials), whether it meets the rules of origin, which materials
+        violate a CTC restriction and whether a VA alternative or complement applies; see
+        bom.evaluate_boms().
+        """
+        import bom
+
+        return bom.evaluate_boms(self, outputs, materials)
+
+    def rvc_sweep(self, scenarios, names=None):
+        """Return a dictionary mapping scenario name to a RoO with the restrictions and VA
+        flags under alternative RVC thresholds (e.g. {'shift': -10} or {'combine': 'max'});
+        see sweeps.py.
+        """
+        import sweeps
+
+        return sweeps.scenario_roos(self, scenarios, names)
+
+    def summarize(self, type_='', patterns=None, only=None,
                   remaining=False, duplicates=True, unaffected=False,
                   countRules=False, simple=False):
         """Print a summary of the FTA, which could include statistics of each type of rules,
@@ -268,34 +633,28 @@ class RoO:
 
         Can also be used as a tool for debugging (i.e. detecting duplicate rules, uncaptured
         rules, or even looking for specific type of rules).
+
+        Uses the classification recorded during the build, unless a different set of
+        `patterns` is given.
         """
-        uncaptured = 0
-        freqHS, freqRules = Counter(), Counter()
-        pattern_range = regex.compile(HSC_GROUP_8)
-        for hs_code_range, rule in self.unique_rules.items():
-            types = []
-            for name, pattern in patterns.items():
-                if pattern.check(rule):
-                    types.append(name)
-                    if name == type_:
-                        print(rule, end='\n\n')
-            if len(types) == 0:
-                uncaptured += 1
-                if remaining:
+        classification = self.get_classification(patterns)
+        if type_ or remaining or duplicates:
+            for types, rule, uncaptured, duplicate in zip(classification['types'], classification['rule'],
+                                                          classification['uncaptured'], classification['duplicate']):
+                if type_ in types:
                     print(rule, end='\n\n')
-            elif len(types) > 1:
-                if duplicates:
-                    print(types)
+                if uncaptured and remaining:
+                    print(rule, end='\n\n')
+                elif duplicate and duplicates:
+                    print(list(types))
                     print(rule, end='\n\n')
-            else:
-                result = pattern_range.findall(hs_code_range)
-                freqHS[types[0]] += len(self.hs_map.get_hs_codes(result[0][1], result[0][2]))
-                freqRules[types[0]] += 1
 
         if unaffected:
             print('HS codes without any rules:')
             print(sorted(set(self.hs_map.get_all_hs_codes()) - set(self.all_rules)), end='\n\n')
 
+        freqHS, freqRules = self.count_types(classification)
+        uncaptured = int(classification['uncaptured'].sum())
         covered, total = sum(freqHS.values()), len(self.all_rules)
 
         if simple:
@@ -312,32 +671,20 @@ class RoO:
             print(covered, '/', total, '({:2.2%})'.format(covered / total))
             print('HSMap size:', len(self.hs_map), end='\n\n')
 
-    def generate_report(self, patterns=search_patterns):
+    def generate_report(self, patterns=None):
         """Generate a summary of the FTA, which could include statistics of each type of rules,
         total coverage of RoO, number of remaining rules, etc.
 
         Output: dictionary mapping ...
         """
-        uncaptured = 0
-        freqHS, freqRules = Counter(), Counter()
-        pattern_range = regex.compile(HSC_GROUP_8)
-        for hs_code_range, rule in self.unique_rules.items():
-            types = []
-            for name, pattern in patterns.items():
-                if pattern.check(rule):
-                    types.append(name)
-            if len(types) == 0:
-                uncaptured += 1
-            elif len(types) > 1:
-                print('There is a duplicate! Refine pattern.py first.')
-                raise ValueError
-            else:
-                result = pattern_range.findall(hs_code_range)
-                freqHS[types[0]] += len(self.hs_map.get_hs_codes(result[0][1], result[0][2]))
-                freqRules[types[0]] += 1
+        classification = self.get_classification(patterns)
+        if classification['duplicate'].any():
+            print('There is a duplicate! Refine pattern.py first.')
+            raise ValueError
 
+        freqHS, freqRules = self.count_types(classification)
         report = {
-            'uncaptured': uncaptured,
+            'uncaptured': int(classification['uncaptured'].sum()),
             'totalRules': len(self.unique_rules),
             'totalHS': len(self.all_rules),
             'HSMap_ver': self.hs_map.version,
@@ -347,20 +694,78 @@ class RoO:
 
         return report
 
-    def generate_dataset(self, filetype, filepath=None, VA=False):
+    def get_classification(self, patterns=None):
+        """Return the classification recorded during the build, or classify the rules
+        again if a different set of `patterns` is given.
+        """
+        if patterns is None:
+            return self.classification
+        return RoO.classification_frame(self.classify_rules(patterns))
+
+    @staticmethod
+    def count_types(classification):
+        """Return a pair of Counters (number of HS codes, number of rules) for each type
+        of rules, only counting rules captured by exactly one pattern.
+
+        Ties are ordered by first appearance, just like counting rule by rule.
+        """
+        unique = classification[~classification['uncaptured'] & ~classification['duplicate']]
+        grouped = unique.groupby('type', sort=False)['hs_count']
+        freqHS = Counter({name: int(count) for name, count in grouped.sum().items()})
+        freqRules = Counter({name: int(count) for name, count in grouped.size().items()})
+        return freqHS, freqRules
+
+    def generate_dataset(self, filetype, filepath=None, VA=False, memory_budget=None, tariff_items=False):
         """Generate dataset with the specified file type.
-        Available options: csv, dta, xlsx
+        Available options: csv, dta, xlsx, feather (or arrow), parquet
+
+        If `memory_budget` (bytes) is given, csv, feather and parquet files are written out
+        of core, through sorted runs spilled to temporary files (see external.py); Stata and
+        Excel files do not honor it (ValueError).
+
+        Feather (Arrow IPC) and Parquet files store HS codes dictionary-encoded; load them
+        back with dataset.load_dataset(), which memory-maps feather files.
+
+        Stata and Excel files are streamed in chunks (see dataset_chunks()); in Stata files,
+        HS codes are stored as integers with value labels holding the six-digit strings.
+
+        If `tariff_items` is True, the restrictions of tariff item rules are included, keyed
+        by tariff item (see restrictions_table()); only for csv, feather and parquet files,
+        written in memory.
         """
-        df = self.restrictions_table(VA).sort_values(by=['output_str', 'input_str']).reset_index(drop=True)
+        import dataset
+
         if filepath is None:
             filepath = self.name + '.' + filetype
 
+        if tariff_items and (memory_budget is not None or filetype in ('dta', 'xlsx')):
+            print('Tariff items are only exported to csv, feather and parquet files, without memory_budget.')
+            raise ValueError
+
+        if memory_budget is not None:
+            import external
+
+            if filetype not in external.FILETYPES:
+                print('Memory budget only honored for:', external.FILETYPES)
+                raise ValueError
+            external.export(self, filepath, filetype, VA, memory_budget)
+            return
+
+        if filetype == 'dta':
+            nobs = int(np.count_nonzero(self.restrictions.data))
+            dataset.write_dta(self.dataset_chunks(VA), filepath, self.hs_map, nobs, label=self.name)
+            return
+        elif filetype == 'xlsx':
+            dataset.write_xlsx(self.dataset_chunks(VA), filepath, self.hs_map)
+            return
+
+        df = self.restrictions_table(VA, tariff_items).sort_values(by=['output_str', 'input_str']).reset_index(drop=True)
         if filetype == 'csv':
             df.to_csv(path_or_buf=filepath, index=False)
-        elif filetype == 'dta':
-            df.to_stata(fname=filepath, write_index=False)
-        elif filetype == 'xlsx':
-            df.to_excel(excel_writer=filepath, index=False)
+        elif filetype in dataset.ARROW_TYPES:
+            dataset.write_arrow(df, filepath)
+        elif filetype == 'parquet':
+            dataset.write_parquet(df, filepath)
         else:
             print('Filetype not recognized!')
             raise ValueError
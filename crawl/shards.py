@@ -0,0 +1,260 @@
+"""
+shards.py
+
+Contains job manifests splitting the build of many FTAs into shards (one per FTA,
+optionally one per range of chapters of its rules), each writing a self-describing
+partial restriction file, and a merge step combining any set of shards into the
+same RoO (hence the same data set and report) as a single-process build.
+
+A partial file (.npz) holds the restriction triplets imposed by the rules of the
+shard, tagged with the index of the rule imposing them (so the merge can replay
+them in the original rule order), the VA flags those rules set, their
+classification and raw RVC alternatives (see RoO.build_restrictions()), the tariff
+item rules whose chapter is within the shard, built as an overlay (see
+RoO.build_tariff_items()), and the parsed rules of the whole FTA.
+
+Usage (each shard can run as a separate process, on any machine):
+  python shards.py manifest <manifest.json> --agreement <name> <text> <hs version> <hs csv>
+                            [--agreement ...] [--chapters 1-24 25-49 ...]
+  python shards.py run <manifest.json> <shard id> <output directory>
+  python shards.py merge <output directory> [--filetype csv] [--VA]
+"""
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from hsmap import HSMap
+from roo import RoO, search_patterns
+from store import RuleMap, RestrictionStore, TariffOverlay, last_occurrences
+
+## -----------------------------------------------------------------------------
+## Constants
+## -----------------------------------------------------------------------------
+
+# Bumped whenever the layout of partial files changes
+SHARD_FORMAT = 2
+
+## -----------------------------------------------------------------------------
+## Functions
+## -----------------------------------------------------------------------------
+
+def make_manifest(agreements, chapter_ranges=None):
+    """Return a job manifest (dictionary) with one shard per FTA and chapter range.
+
+    Inputs:
+      `agreements`: list of dictionaries with keys `name`, `text` (path of the text of RoO),
+                    `hs_version` and `hs_map` (path of the .csv file of the HS Nomenclature)
+      `chapter_ranges`: list of (first, last) chapters; a shard only builds the rules whose
+                        (range of) HS codes starts within its chapters; None for one shard per FTA
+    """
+    shards = []
+    for agreement in agreements:
+        for chapters in (chapter_ranges or [None]):
+            shard_id = agreement['name'] if chapters is None else '{}_{:02d}-{:02d}'.format(agreement['name'], *chapters)
+            shards.append(dict(agreement, id=shard_id, chapters=None if chapters is None else list(chapters)))
+    return {'format': SHARD_FORMAT, 'shards': shards}
+
+
+def rule_chapter(hs_code_range):
+    """Return the chapter (integer) of the first HS code of a (range of) HS codes."""
+    return int(hs_code_range[:2])
+
+
+def run_shard(shard, directory, patterns=search_patterns, workers=None):
+    """Build the rules of a shard (an entry of a job manifest) and write its partial file
+    '<shard id>.npz' into `directory`; return the path of the file.
+    """
+    with open(shard['text'], mode='r', encoding='utf-8') as f:
+        raw_text = f.read()
+    hs_map = HSMap(shard['hs_version'], shard['hs_map'])
+    roo = RoO(shard['name'], raw_text, hs_map, workers=workers, build=False)
+
+    all_ranges = list(roo.unique_rules)
+    chapters = shard['chapters']
+    indices = [i for i, hs_code_range in enumerate(all_ranges)
+               if chapters is None or chapters[0] <= rule_chapter(hs_code_range) <= chapters[1]]
+    classified = roo.classify_rules(patterns, workers, [all_ranges[i] for i in indices])
+    rvc = {'alternatives': np.full((len(indices), 3), -1, dtype=np.int8),
+           'output_rules': np.full(len(hs_map), -1, dtype=np.int32)}
+    rules, inputs, outputs, values = roo.restriction_triplets(patterns, classified, rvc=rvc)
+    global_indices = np.asarray(indices, dtype=np.int32)
+    output_rules = np.where(rvc['output_rules'] >= 0, global_indices[np.maximum(rvc['output_rules'], 0)], -1)
+
+    roo.tariff_rules = {key: rule for key, rule in roo.tariff_rules.items()
+                        if chapters is None or chapters[0] <= rule_chapter(key) <= chapters[1]}
+    tariff_items = roo.build_tariff_items(patterns)
+
+    meta = {
+        'format': SHARD_FORMAT,
+        'id': shard['id'],
+        'name': shard['name'],
+        'hs_version': str(shard['hs_version']),
+        'hs_map': os.path.abspath(shard['hs_map']),
+        'text_sha256': hashlib.sha256(raw_text.encode('utf-8')).hexdigest(),
+        'chapters': chapters,
+        'unique_rules': roo.unique_rules,
+        'rule_texts': roo.all_rules.texts,
+        'indices': indices,
+        'types': [list(types) for types in classified['types']],
+        'hs_count': classified['hs_count'],
+        'tariff_rules': roo.tariff_rules,
+        'tariff_types': [list(types) for types in tariff_items.types]
+    }
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, shard['id'] + '.npz')
+    np.savez(path, meta=np.array(json.dumps(meta)), rules=global_indices[rules],
+             inputs=inputs, outputs=outputs, values=values, va_flags=roo.va_flags,
+             rule_ids=roo.all_rules.rule_ids, rvc_alternatives=rvc['alternatives'], output_rules=output_rules,
+             tariff_keys=tariff_items.keys, tariff_indptr=tariff_items.indptr, tariff_inputs=tariff_items.inputs,
+             tariff_data=tariff_items.data, tariff_va_flags=tariff_items.va_flags)
+    return path
+
+
+def read_shard(path):
+    """Return (meta, arrays) of a partial file written by run_shard()."""
+    with np.load(path) as data:
+        arrays = {key: data[key] for key in data.files}
+    meta = json.loads(str(arrays.pop('meta')))
+    if meta['format'] != SHARD_FORMAT:
+        print('Shard format not supported:', path)
+        raise ValueError
+    return meta, arrays
+
+
+def tariff_rows(meta, arrays):
+    """Return the tariff item rules of a partial file as rows of TariffOverlay.from_rows()."""
+    keys, indptr = arrays['tariff_keys'].tolist(), arrays['tariff_indptr']
+    return {key: (meta['tariff_rules'][key], tuple(types), arrays['tariff_inputs'][indptr[i]:indptr[i + 1]],
+                  arrays['tariff_data'][indptr[i]:indptr[i + 1]], tuple(arrays['tariff_va_flags'][i].tolist()))
+            for i, (key, types) in enumerate(zip(keys, meta['tariff_types']))}
+
+
+def merge_shards(paths, hs_maps=None):
+    """Combine partial files (see run_shard()) into one RoO per FTA, identical to a
+    single-process build; return a dictionary mapping FTA name to RoO.
+
+    Every rule of an FTA must be built by exactly one of the given shards; triplets are
+    replayed in the original rule order, so overlapping rules override each other as in
+    RoO.build_restrictions().
+
+    Inputs:
+      `paths`: list of paths of partial files (in any order)
+      `hs_maps`: dictionary mapping HS version to HSMap; loaded from the files if missing
+    """
+    hs_maps = {} if hs_maps is None else dict(hs_maps)
+    groups = {}
+    for path in paths:
+        meta, arrays = read_shard(path)
+        groups.setdefault(meta['name'], []).append((meta, arrays))
+
+    roos = {}
+    for name, shards in sorted(groups.items()):
+        first = shards[0][0]
+        for meta, _ in shards:
+            if (meta['text_sha256'], meta['hs_version']) != (first['text_sha256'], first['hs_version']):
+                print('Shards of {} were built from different texts or HS versions!'.format(name))
+                raise ValueError
+        indices = np.concatenate([np.asarray(meta['indices'], dtype=np.int64) for meta, _ in shards])
+        coverage = np.bincount(indices, minlength=len(first['unique_rules']))
+        if (coverage != 1).any():
+            print('Shards of {} do not cover every rule exactly once!'.format(name))
+            print('Missing rules:', int(np.count_nonzero(coverage == 0)), '/ Duplicate rules:',
+                  int(np.count_nonzero(coverage > 1)))
+            raise ValueError
+
+        version = first['hs_version']
+        if version not in hs_maps:
+            hs_maps[version] = HSMap(version, first['hs_map'])
+        hs_map = hs_maps[version]
+
+        # Classification in the original rule order
+        all_ranges = list(first['unique_rules'])
+        types, hs_count = [None] * len(all_ranges), [None] * len(all_ranges)
+        for meta, _ in shards:
+            for i, rule_types, count in zip(meta['indices'], meta['types'], meta['hs_count']):
+                types[i], hs_count[i] = tuple(rule_types), count
+        classified = {'hs_code_range': all_ranges, 'rule': list(first['unique_rules'].values()),
+                      'types': types, 'hs_count': hs_count}
+
+        # Restrictions replayed in the original rule order (stable within a rule)
+        rules = np.concatenate([arrays['rules'] for _, arrays in shards])
+        order = np.argsort(rules, kind='stable')
+        inputs, outputs, values = [np.concatenate([arrays[key] for _, arrays in shards])[order]
+                                   for key in ['inputs', 'outputs', 'values']]
+        va_flags = np.bitwise_or.reduce([arrays['va_flags'] for _, arrays in shards])
+
+        # Raw RVC alternatives, as kept by RoO.build_restrictions(); the last rule setting
+        # the VA flags of a position is the one with the highest index
+        rvc = {'alternatives': np.full((len(all_ranges), 3), -1, dtype=np.int8),
+               'output_rules': np.maximum.reduce([arrays['output_rules'] for _, arrays in shards])}
+        for meta, arrays in shards:
+            rvc['alternatives'][meta['indices']] = arrays['rvc_alternatives']
+        _, last = last_occurrences(len(hs_map), inputs, outputs)
+        rvc['entry_rules'] = rules[order][last].astype(np.int32)
+
+        tariff_rules, rows = {}, {}
+        for meta, arrays in shards:
+            tariff_rules.update(meta['tariff_rules'])
+            rows.update(tariff_rows(meta, arrays))
+
+        all_rules = RuleMap(hs_map, shards[0][1]['rule_ids'], first['rule_texts'])
+        roos[name] = RoO.assemble(name, hs_map, first['unique_rules'], all_rules, classified, va_flags,
+                                  RestrictionStore.from_coo(hs_map, inputs, outputs, values), rvc,
+                                  tariff_rules, TariffOverlay.from_rows(hs_map, rows))
+    return roos
+
+## -----------------------------------------------------------------------------
+## Command Line
+## -----------------------------------------------------------------------------
+
+def main(argv=None):
+    """Command line entry point; see the usage in the module docstring."""
+    parser = argparse.ArgumentParser(description='Build FTAs in shards, then merge them.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    manifest = commands.add_parser('manifest', help='write a job manifest')
+    manifest.add_argument('manifest')
+    # Separate fields rather than one 'name:text:...' string, since paths may contain colons (e.g. drive letters)
+    manifest.add_argument('--agreement', action='append', nargs=4, required=True,
+                          metavar=('NAME', 'TEXT', 'HS_VERSION', 'HS_MAP'), dest='agreements')
+    manifest.add_argument('--chapters', nargs='*', help='chapter ranges, e.g. 1-24 25-49')
+
+    run = commands.add_parser('run', help='build one shard of a job manifest')
+    run.add_argument('manifest')
+    run.add_argument('shard')
+    run.add_argument('directory')
+    run.add_argument('--workers', type=int)
+
+    merge = commands.add_parser('merge', help='merge partial files, write data sets and reports')
+    merge.add_argument('directory')
+    merge.add_argument('--filetype', default='csv')
+    merge.add_argument('--VA', action='store_true')
+
+    args = parser.parse_args(argv)
+    if args.command == 'manifest':
+        agreements = [dict(zip(['name', 'text', 'hs_version', 'hs_map'], fields)) for fields in args.agreements]
+        chapter_ranges = [tuple(int(c) for c in r.split('-')) for r in args.chapters] if args.chapters else None
+        with open(args.manifest, 'w') as f:
+            json.dump(make_manifest(agreements, chapter_ranges), f, indent=2)
+    elif args.command == 'run':
+        with open(args.manifest) as f:
+            shards = {shard['id']: shard for shard in json.load(f)['shards']}
+        if args.shard not in shards:
+            print('Shard not found in manifest:', args.shard)
+            raise KeyError
+        print(run_shard(shards[args.shard], args.directory, workers=args.workers))
+    else:
+        roos = merge_shards(sorted(glob.glob(os.path.join(args.directory, '*.npz'))))
+        for name, roo in roos.items():
+            roo.generate_dataset(args.filetype, os.path.join(args.directory, name + '.' + args.filetype), args.VA)
+            with open(os.path.join(args.directory, name + '_report.json'), 'w') as f:
+                json.dump(roo.generate_report(), f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
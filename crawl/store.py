@@ -0,0 +1,355 @@
+"""
+store.py
+
+Contains compact, array-backed containers used to hold a built RoO in memory:
+rules interned to integer ids over HS positions, VA flags as uint8 arrays,
+restrictions as a sparse (input x output) matrix of float32 restrictiveness, and
+tariff-item rules as an overlay over their subheadings.
+
+Every container still behaves like the dictionary it replaces (keyed by
+six-digit HS code strings), so existing code reading RoO attributes keeps working.
+"""
+
+from collections.abc import Mapping
+
+import numpy as np
+
+## -----------------------------------------------------------------------------
+## Helper Functions
+## -----------------------------------------------------------------------------
+
+def restrictiveness(values):
+    """Convert stored float32 restrictiveness back to float64.
+
+    Restrictiveness is either 1 (CTC), 0, or a whole VA percentage, so rounding to
+    two decimals recovers the exact value parsed from the rule.
+    """
+    return np.round(np.asarray(values, dtype=np.float64), 2)
+
+
+def last_occurrences(n, inputs, outputs):
+    """Return the sorted keys (input * n + output) of distinct (input, output) pairs, along
+    with the index of the last triplet of each pair (see RestrictionStore.from_coo()).
+    """
+    keys = np.asarray(inputs, dtype=np.int64) * n + np.asarray(outputs, dtype=np.int64)
+    # np.unique keeps the first occurrence, so search the reversed keys for the last one
+    unique_keys, last = np.unique(keys[::-1], return_index=True)
+    return unique_keys, len(keys) - 1 - last
+
+## -----------------------------------------------------------------------------
+## Class Definition
+## -----------------------------------------------------------------------------
+
+class RuleMap(Mapping):
+    """Read-only mapping from six-digit HS code to the (joined) rule of origin string,
+    stored as one integer rule id per HS position.
+
+    Attributes:
+      `rule_ids`: int32 array over HS positions; -1 where no rule applies
+      `texts`: list of unique rule strings, indexed by rule id
+    """
+    __slots__ = ('hs_map', 'rule_ids', 'texts')
+
+    def __init__(self, hs_map, rule_ids, texts):
+        self.hs_map = hs_map
+        self.rule_ids = rule_ids
+        self.texts = texts
+
+    @classmethod
+    def from_positions(cls, hs_map, rules_at):
+        """Build a RuleMap from a dictionary mapping HS position to a list of rule
+        strings, joining (and interning) the rules of every position.
+        """
+        rule_ids = np.full(len(hs_map), -1, dtype=np.int32)
+        interned = {}
+        for position, rules in rules_at.items():
+            rule_ids[position] = interned.setdefault(' '.join(rules), len(interned))
+        return cls(hs_map, rule_ids, list(interned))
+
+    def __getitem__(self, hs_code):
+        rule_id = self.rule_ids[self.hs_map.positions[hs_code]]
+        if rule_id < 0:
+            raise KeyError(hs_code)
+        return self.texts[rule_id]
+
+    def __contains__(self, hs_code):
+        position = self.hs_map.positions.get(hs_code)
+        return position is not None and self.rule_ids[position] >= 0
+
+    def __iter__(self):
+        return iter(self.hs_map.codes[self.rule_ids >= 0].tolist())
+
+    def __len__(self):
+        return int(np.count_nonzero(self.rule_ids >= 0))
+
+
+class VAMap(Mapping):
+    """Read-only mapping from six-digit HS code (with a rule) to a pair of flags
+    (VA_Complement, VA_Alternative), backed by a (positions x 2) uint8 array.
+    """
+    __slots__ = ('rules', 'flags')
+
+    def __init__(self, rules, flags):
+        self.rules = rules
+        self.flags = flags
+
+    def __getitem__(self, hs_code):
+        if hs_code not in self.rules:
+            raise KeyError(hs_code)
+        complement, alternative = self.flags[self.rules.hs_map.positions[hs_code]]
+        return int(complement), int(alternative)
+
+    def __iter__(self):
+        return iter(self.rules)
+
+    def __len__(self):
+        return len(self.rules)
+
+
+class TariffOverlay(Mapping):
+    """Read-only mapping from tariff item (dot-free, e.g. '18061010') to its rule of origin,
+    overlaying the six-digit subheading (parent) it belongs to.
+
+    Only tariff items with a rule are stored, sorted, hence grouped by parent: the tariff
+    items of an HS code are a contiguous slice found by binary search, and memory grows
+    with the number of tariff-item rules rather than with national tariff lines.
+
+    Attributes:
+      `keys`: sorted array of tariff items
+      `parents`: int32 array of the HS position of the subheading of every tariff item
+      `rules`: list of rule strings, in the order of `keys`
+      `types`: list of the patterns matching each rule (tuples; see RoO.classify_rules())
+      `indptr`, `inputs`, `data`: restrictions in CSR form, with tariff items as rows and
+                                  (input) HS positions as columns
+      `va_flags`: (tariff items x 2) uint8 array of (VA_Complement, VA_Alternative)
+    """
+    __slots__ = ('hs_map', 'keys', 'parents', 'rules', 'types', 'indptr', 'inputs', 'data', 'va_flags')
+
+    def __init__(self, hs_map, keys, rules, types, indptr, inputs, data, va_flags):
+        self.hs_map = hs_map
+        self.keys = keys
+        self.parents = np.array([hs_map.positions[key[:6]] for key in keys.tolist()], dtype=np.int32)
+        self.rules = rules
+        self.types = types
+        self.indptr = indptr
+        self.inputs = inputs
+        self.data = data
+        self.va_flags = va_flags
+
+    @classmethod
+    def from_rows(cls, hs_map, rows):
+        """Build an overlay from a dictionary mapping tariff item to a tuple (rule, types,
+        restricted input positions, restrictiveness, VA flags).
+        """
+        keys = sorted(rows)
+        rules, types, inputs, values, va_flags = zip(*[rows[key] for key in keys]) if keys else ([], [], [], [], [])
+        indptr = np.zeros(len(keys) + 1, dtype=np.int64)
+        np.cumsum([len(restricted) for restricted in inputs], out=indptr[1:])
+        return cls(hs_map, np.array(keys, dtype='U16'), list(rules), list(types), indptr,
+                   np.concatenate(inputs).astype(np.int32) if keys else np.empty(0, dtype=np.int32),
+                   np.concatenate(values).astype(np.float32) if keys else np.empty(0, dtype=np.float32),
+                   np.array(va_flags, dtype=np.uint8).reshape(len(keys), 2))
+
+    def index(self, key):
+        """Return the row of a tariff item; raise KeyError if it has no rule."""
+        row = int(np.searchsorted(self.keys, key))
+        if row == len(self.keys) or self.keys[row] != key:
+            raise KeyError(key)
+        return row
+
+    def items_of(self, hs_code):
+        """Return the list of tariff items (with a rule) within a chapter, heading or
+        subheading.
+        """
+        start, stop = np.searchsorted(self.keys, [hs_code, hs_code + '\uffff'])
+        return self.keys[start:stop].tolist()
+
+    def restrictions(self, key):
+        """Return (input positions, restrictiveness) arrays of a tariff item."""
+        row = self.index(key)
+        start, stop = self.indptr[row], self.indptr[row + 1]
+        return self.inputs[start:stop], self.data[start:stop]
+
+    def coo(self):
+        """Return (tariff item rows, input positions, restrictiveness) arrays."""
+        rows = np.repeat(np.arange(len(self.keys), dtype=np.int32), np.diff(self.indptr))
+        return rows, self.inputs, self.data
+
+    def __getitem__(self, key):
+        return self.rules[self.index(key)]
+
+    def __iter__(self):
+        return iter(self.keys.tolist())
+
+    def __len__(self):
+        return len(self.keys)
+
+
+class RestrictionStore(Mapping):
+    """Sparse matrix of restrictions, with (input) HS positions as rows and (output)
+    HS positions as columns, stored in compressed sparse row (CSR) form.
+
+    Also a read-only mapping from input HS code to a dictionary {output HS code:
+    restrictiveness}, i.e. the nested dictionary it replaces.
+
+    Attributes:
+      `indptr`: int64 array; row i spans `indices[indptr[i]:indptr[i+1]]`
+      `indices`: int32 array of output positions (sorted within each row)
+      `data`: float32 array of restrictiveness
+    """
+    __slots__ = ('hs_map', 'indptr', 'indices', 'data')
+
+    def __init__(self, hs_map, indptr, indices, data):
+        self.hs_map = hs_map
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+
+    @classmethod
+    def from_coo(cls, hs_map, inputs, outputs, values):
+        """Build a store from (input, output, restrictiveness) triplets given in the
+        order they were imposed; a later triplet overrides an earlier one with the
+        same (input, output) pair.
+        """
+        n = len(hs_map)
+        keys, last = last_occurrences(n, inputs, outputs)
+        values = np.asarray(values, dtype=np.float32)[last]
+        rows = keys // n
+        indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=n), out=indptr[1:])
+        return cls(hs_map, indptr, (keys % n).astype(np.int32), values)
+
+    @property
+    def nnz(self):
+        """Number of stored (input, output) pairs."""
+        return len(self.data)
+
+    def row(self, position):
+        """Return (output positions, restrictiveness) arrays of an input HS position."""
+        start, stop = self.indptr[position], self.indptr[position + 1]
+        return self.indices[start:stop], self.data[start:stop]
+
+    def coo(self):
+        """Return (input positions, output positions, restrictiveness) arrays, sorted
+        by input then output.
+        """
+        inputs = np.repeat(np.arange(len(self.hs_map), dtype=np.int32), np.diff(self.indptr))
+        return inputs, self.indices, self.data
+
+    def lookup(self, inputs, outputs):
+        """Return the restrictiveness of many (input, output) pairs of HS positions at once,
+        as a float32 array; 0 where the pair is not restricted.
+
+        Rows are sorted and so are the outputs within each row, hence the keys
+        (input * n + output) of the stored pairs are sorted, and a single binary search
+        locates every pair.
+        """
+        n = len(self.hs_map)
+        rows, _, _ = self.coo()
+        keys = rows.astype(np.int64) * n + self.indices
+        targets = np.asarray(inputs, dtype=np.int64) * n + np.asarray(outputs, dtype=np.int64)
+        indices = np.searchsorted(keys, targets)
+        found = indices < len(keys)
+        found[found] = keys[indices[found]] == targets[found]
+        values = np.zeros(len(targets), dtype=np.float32)
+        values[found] = self.data[indices[found]]
+        return values
+
+    def __getitem__(self, hs_code):
+        position = self.hs_map.positions[hs_code]
+        outputs, values = self.row(position)
+        if not len(outputs):
+            raise KeyError(hs_code)
+        return dict(zip(self.hs_map.codes[outputs].tolist(), restrictiveness(values).tolist()))
+
+    def __contains__(self, hs_code):
+        position = self.hs_map.positions.get(hs_code)
+        return position is not None and self.indptr[position + 1] > self.indptr[position]
+
+    def __iter__(self):
+        return iter(self.hs_map.codes[np.diff(self.indptr) > 0].tolist())
+
+    def __len__(self):
+        return int(np.count_nonzero(np.diff(self.indptr)))
+
+
+class Rollup:
+    """Cumulative sums of restriction statistics along the HS hierarchy of an HSMap.
+
+    Since the database of HSMap is sorted, every chapter, heading and subheading spans a
+    contiguous range of HS positions; aggregates of any of them are then the difference
+    of two rows of the cumulative sums, i.e. an O(1) lookup.
+
+    Statistics (counted over restricted (input, output) pairs, per HS position of one side):
+      `count`: number of restricted pairs
+      `restrictiveness`: sum of restrictiveness
+      `ctc`: number of pairs restricted by CTC (restrictiveness of 1)
+      `va`: number of pairs restricted by a VA requirement (restrictiveness below 1)
+      `cva`, `ava`: number of pairs whose output has a complement / alternative VA requirement
+    """
+    __slots__ = ('hs_map', 'cumulative')
+
+    FIELDS = ['count', 'restrictiveness', 'ctc', 'va', 'cva', 'ava']
+
+    def __init__(self, hs_map, restrictions, va_flags, side='input'):
+        """Initialize an instance of Rollup.
+
+        Inputs:
+          `hs_map`: instance of HSMap
+          `restrictions`: instance of RestrictionStore
+          `va_flags`: (positions x 2) uint8 array of (VA_Complement, VA_Alternative)
+          `side`: 'input' or 'output'; which HS code of the pairs is aggregated
+        """
+        inputs, outputs, values = restrictions.coo()
+        nonzero = values != 0
+        inputs, outputs, values = inputs[nonzero], outputs[nonzero], restrictiveness(values[nonzero])
+        if side == 'input':
+            positions = inputs
+        elif side == 'output':
+            positions = outputs
+        else:
+            print('Side not recognized! Available options: input, output')
+            raise ValueError
+
+        weights = [None, values, values == 1, values < 1, va_flags[outputs, 0], va_flags[outputs, 1]]
+        stats = np.column_stack([np.bincount(positions, weights=w, minlength=len(hs_map)) for w in weights])
+        self.hs_map = hs_map
+        self.cumulative = np.vstack([np.zeros(len(Rollup.FIELDS)), np.cumsum(stats, axis=0)])
+
+    @staticmethod
+    def describe(hs_codes, totals):
+        """Return a dictionary of aggregates, given the number of HS codes and the summed
+        statistics (in the order of FIELDS).
+        """
+        count, total, ctc, va, cva, ava = totals
+        shares = {name: float(value / count) if count else np.nan for name, value in
+                  [('mean', total), ('ctc_share', ctc), ('va_share', va), ('cva_share', cva), ('ava_share', ava)]}
+        return {'hs_codes': int(hs_codes), 'count': int(count), **shares}
+
+    def query(self, hs_code):
+        """Return a dictionary of aggregates (see describe()) of a chapter, heading or
+        subheading, given as a two- to six-digit HS code (dots allowed).
+        """
+        start, stop = self.hs_map.get_positions(hs_code)
+        return Rollup.describe(stop - start, self.cumulative[stop] - self.cumulative[start])
+
+    def table(self, digits=2):
+        """Return a DataFrame of aggregates of every chapter (digits=2), heading (4) or
+        subheading (6), indexed by HS code prefix.
+        """
+        import pandas as pd
+
+        labels, starts, stops = self.hs_map.get_levels(digits)
+        totals = self.cumulative[stops] - self.cumulative[starts]
+        count = totals[:, 0]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            data = {
+                'hs_codes': stops - starts,
+                'count': count.astype(np.int64),
+                'mean': totals[:, 1] / count,
+                'ctc_share': totals[:, 2] / count,
+                'va_share': totals[:, 3] / count,
+                'cva_share': totals[:, 4] / count,
+                'ava_share': totals[:, 5] / count
+            }
+        return pd.DataFrame(data, index=pd.Index(labels, name='hs_code'))
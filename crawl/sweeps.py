@@ -0,0 +1,116 @@
+"""
+sweeps.py
+
+Contains RVC-threshold sensitivity sweeps: restrictions of an FTA recomputed under
+alternative VA requirements (e.g. every RVC lowered by 10 points, or the highest of
+the build-up/build-down alternatives instead of the lowest), without parsing or
+matching any rule again.
+
+A scenario is a dictionary with keys (all optional):
+  `shift`: percentage points added to every RVC (e.g. -10), clipped to [0, 99]
+  `combine`: 'min' (default, as Pattern.calculate_rvc()) or 'max' of the RVC alternatives
+
+Building an FTA keeps the raw RVC alternatives of every rule, and the rule imposing
+each stored (input, output) pair (see RoO.build_restrictions()). The thresholds of
+every rule under every scenario form one (scenarios x rules) array, from which the
+VA restrictions of the store are remapped with a single gather; CTC restrictions
+(1) and multi-clauses (0) are left as they are. VA flags are cleared for output
+products whose RVC drops to 0.
+"""
+
+import numpy as np
+
+from store import RestrictionStore
+
+## -----------------------------------------------------------------------------
+## Constants
+## -----------------------------------------------------------------------------
+
+COMBINATIONS = ['min', 'max']
+
+## -----------------------------------------------------------------------------
+## Functions
+## -----------------------------------------------------------------------------
+
+def rule_thresholds(alternatives, scenarios):
+    """Return a (scenarios x rules) float64 array of the RVC (fraction from 0 to 0.99) of
+    every rule under every scenario (NaN for rules without RVC).
+
+    Inputs:
+      `alternatives`: (rules x 3) integer array of RVC percentages (-1 where none)
+      `scenarios`: list of scenarios (see the module docstring)
+    """
+    RVCs = np.where(alternatives >= 0, alternatives, np.nan).astype(np.float64)
+    has_rvc = (alternatives >= 0).any(axis=1)
+    thresholds = np.full((len(scenarios), len(alternatives)), np.nan)
+    with np.errstate(invalid='ignore'):
+        lowest, highest = np.nanmin(RVCs[has_rvc], axis=1), np.nanmax(RVCs[has_rvc], axis=1)
+    for i, scenario in enumerate(scenarios):
+        combine = scenario.get('combine', 'min')
+        if combine not in COMBINATIONS:
+            print('Combination not recognized! Available options:', COMBINATIONS)
+            raise ValueError
+        RVC = lowest if combine == 'min' else highest
+        thresholds[i, has_rvc] = np.clip(RVC + scenario.get('shift', 0), 0, 99) / 100
+    return thresholds
+
+
+def sweep(roo, scenarios):
+    """Return a list (one per scenario) of pairs (values, va_flags), where `values` is the
+    restrictiveness of every pair stored in `roo.restrictions` (same order as its data)
+    and `va_flags` the (positions x 2) VA flags under that scenario.
+    """
+    rvc = roo.rvc
+    if rvc is None or len(rvc['entry_rules']) != roo.restrictions.nnz:
+        print('Raw RVC alternatives not available; build the FTA with RoO() first.')
+        raise ValueError
+    data = roo.restrictions.data
+    entry_rules = rvc['entry_rules']
+    # VA restrictions: neither CTC (1) nor multi-clause (0)
+    va = np.flatnonzero((data > 0) & (data < 1) & (entry_rules >= 0))
+    thresholds = rule_thresholds(rvc['alternatives'], scenarios)
+
+    remapped = thresholds[:, entry_rules[va]].astype(np.float32)
+    output_rules = rvc['output_rules']
+    ruled = np.flatnonzero(output_rules >= 0)
+    dropped = thresholds[:, output_rules[ruled]] <= 0
+
+    results = []
+    for i in range(len(scenarios)):
+        values = data.copy()
+        values[va] = remapped[i]
+        va_flags = roo.va_flags.copy()
+        va_flags[ruled[dropped[i]]] = 0
+        results.append((values, va_flags))
+    return results
+
+
+def scenario_roos(roo, scenarios, names=None):
+    """Return a dictionary mapping scenario name (default: 'shift{shift}_{combine}') to a
+    RoO with the restrictions and VA flags of `roo` under that scenario, supporting the
+    usual export and query methods.
+    """
+    from roo import RoO
+
+    if names is None:
+        names = ['shift{}_{}'.format(scenario.get('shift', 0), scenario.get('combine', 'min'))
+                 for scenario in scenarios]
+    store = roo.restrictions
+    result = {}
+    for name, (values, va_flags) in zip(names, sweep(roo, scenarios)):
+        restrictions = RestrictionStore(roo.hs_map, store.indptr, store.indices, values)
+        result[name] = RoO.assemble('{}_{}'.format(roo.name, name), roo.hs_map, roo.unique_rules, roo.all_rules,
+                                    roo.classified, va_flags, restrictions)
+    return result
+
+
+def sweep_indices(roo, scenarios, names=None):
+    """Return a DataFrame of the indices of the whole FTA (see indices.agreement_indices())
+    under every scenario, indexed by scenario name.
+    """
+    import pandas as pd
+    import indices
+
+    roos = scenario_roos(roo, scenarios, names)
+    return pd.DataFrame([indices.agreement_indices(scenario) for scenario in roos.values()],
+                        index=pd.Index(list(roos), name='scenario'))
@@ -0,0 +1,74 @@
+"""
+test_bom.py
+
+Checks the evaluation of bills of materials (see bom.py) against the rules of KORUS.
+
+Usage (from this directory):
+  python -m pytest test_bom.py
+"""
+
+import os
+
+import pandas as pd
+import pytest
+
+import bom
+from hsmap import HSMap
+from roo import RoO
+
+## -----------------------------------------------------------------------------
+## Constants
+## -----------------------------------------------------------------------------
+
+CRAWL_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+HS_MAP = ('2002', os.path.join(CRAWL_DIRECTORY, '..', 'hs_maps', 'H2.csv'))
+
+## -----------------------------------------------------------------------------
+## Functions
+## -----------------------------------------------------------------------------
+
+@pytest.fixture(scope='module')
+def korus():
+    with open(os.path.join(CRAWL_DIRECTORY, '..', 'clean_pta', 'KORUS.txt'), encoding='utf-8') as f:
+        return RoO('KORUS', f.read(), HSMap(*HS_MAP))
+
+
+def evaluate(roo, outputs, materials):
+    """Return the result of evaluate_boms() for BOMs given as lists of (input, share)."""
+    rows = [(i, input_str, share) for i, bom_materials in enumerate(materials) for input_str, share in bom_materials]
+    return bom.evaluate_boms(roo, outputs, pd.DataFrame(rows, columns=['bom', 'input_str', 'share']))
+
+
+def test_ctc_violation(korus):
+    # 40.06: a change from any other heading (or from 40.01 with an RVC of 30 percent)
+    result = evaluate(korus, ['400610', '400610'], [[('400690', 0.1)], [('390110', 0.1)]])
+    assert result['passed'].tolist() == [False, True]
+    assert result['violating_inputs'].tolist() == [('400690',), ()]
+
+
+def test_va_alternative(korus):
+    result = evaluate(korus, ['400610', '400610'], [[('400110', 0.8)], [('400110', 0.5)]])
+    assert result['passed'].tolist() == [False, True]
+    assert result['rvc_required'].tolist() == [0.3, 0.3]
+    assert result['VA_Alternative'].all()
+
+
+def test_va_complement(korus):
+    # 84.56: a change from any other heading, with an RVC of 60 percent
+    result = evaluate(korus, ['845610', '845610'], [[('390110', 0.5)], [('390110', 0.3)]])
+    assert result['passed'].tolist() == [False, True]
+    assert result['rvc_required'].tolist() == [0.6, 0.6]
+    assert result['VA_Complement'].all()
+
+
+def test_missing_rule(korus):
+    result = evaluate(korus, ['190300'], [[('390110', 0.1)]])
+    assert not result['has_rule'].iloc[0]
+    assert result['passed'].isna().iloc[0]
+
+
+def test_empty_batch(korus):
+    result = evaluate(korus, [], [])
+    assert len(result) == 0
+    assert list(result.columns) == ['output_str', 'has_rule', 'passed', 'violating_inputs', 'rvc', 'rvc_required',
+                                    'VA_Complement', 'VA_Alternative']
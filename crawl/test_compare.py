@@ -0,0 +1,63 @@
+"""
+test_compare.py
+
+Checks the differences between FTAs listed by compare.diff_chunks(): none between an
+FTA and itself, and the same ones whatever the size of the windows merged.
+
+Usage (from this directory):
+  python -m pytest test_compare.py
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import compare
+from hsmap import HSMap
+from roo import RoO
+
+## -----------------------------------------------------------------------------
+## Constants
+## -----------------------------------------------------------------------------
+
+CRAWL_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+HS_MAP = ('2002', os.path.join(CRAWL_DIRECTORY, '..', 'hs_maps', 'H2.csv'))
+AGREEMENTS = ['CAFTA', 'KORUS']
+
+## -----------------------------------------------------------------------------
+## Functions
+## -----------------------------------------------------------------------------
+
+@pytest.fixture(scope='module')
+def roos():
+    hs_map = HSMap(*HS_MAP)
+    result = []
+    for name in AGREEMENTS:
+        with open(os.path.join(CRAWL_DIRECTORY, '..', 'clean_pta', name + '.txt'), encoding='utf-8') as f:
+            result.append(RoO(name, f.read(), hs_map))
+    return result
+
+
+def test_same_agreement(roos):
+    chunks = list(compare.diff_chunks(roos[0], roos[0]))
+    assert len(chunks) == 1 and len(chunks[0]['change']) == 0
+    assert compare.diff_table(roos[0], roos[0]).empty
+
+
+def test_windows(roos):
+    old, new = roos
+    expected = compare.diff_table(old, new)
+    chunks = list(compare.diff_chunks(old, new, chunksize=1000))
+    assert max(len(chunk['change']) for chunk in chunks) <= 1000
+    pd.testing.assert_frame_equal(pd.concat([pd.DataFrame(chunk) for chunk in chunks], ignore_index=True), expected)
+
+    # Against a join of the full data sets
+    old_table, new_table = old.restrictions_table(), new.restrictions_table()
+    joined = old_table.merge(new_table, on=['output_str', 'input_str'], how='outer', suffixes=('_old', '_new'))
+    differ = ~np.isclose(joined['VA_Percentage_old'], joined['VA_Percentage_new'])
+    counts = expected['change'].value_counts()
+    assert counts.sum() == np.count_nonzero(differ)
+    assert counts['added'] == joined['VA_Percentage_old'].isna().sum()
+    assert counts['removed'] == joined['VA_Percentage_new'].isna().sum()
@@ -0,0 +1,58 @@
+"""
+test_cumulation.py
+
+Checks that cumulation (see cumulation.py) keeps the rules of the base FTA and only
+drops the restrictions of materials originating in the zone.
+
+Usage (from this directory):
+  python -m pytest test_cumulation.py
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import cumulation
+from hsmap import HSMap
+from roo import RoO
+
+## -----------------------------------------------------------------------------
+## Constants
+## -----------------------------------------------------------------------------
+
+CRAWL_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+HS_MAP = ('2002', os.path.join(CRAWL_DIRECTORY, '..', 'hs_maps', 'H2.csv'))
+AGREEMENTS = ['KORUS', 'CAFTA']
+
+## -----------------------------------------------------------------------------
+## Functions
+## -----------------------------------------------------------------------------
+
+@pytest.fixture(scope='module')
+def roos():
+    hs_map = HSMap(*HS_MAP)
+    result = []
+    for name in AGREEMENTS:
+        with open(os.path.join(CRAWL_DIRECTORY, '..', 'clean_pta', name + '.txt'), encoding='utf-8') as f:
+            result.append(RoO(name, f.read(), hs_map))
+    return result
+
+
+def test_cumulate(roos):
+    base, member = roos
+    originating = {'CAFTA': ['870899', '840991', '520100'], 'KORUS': ['620590']}
+    cumulated = cumulation.cumulate('zone', roos, originating)
+
+    table = base.restrictions_table(VA=True)
+    expected = table[~table['input_str'].isin(['870899', '840991', '520100', '620590'])].reset_index(drop=True)
+    pd.testing.assert_frame_equal(cumulated.restrictions_table(VA=True), expected)
+    np.testing.assert_array_equal(cumulated.va_flags, base.va_flags)
+    assert len(cumulated.rvc['entry_rules']) == cumulated.restrictions.nnz
+    assert cumulated.generate_report()['totalHS'] == base.generate_report()['totalHS']
+
+
+def test_no_originating_materials(roos):
+    cumulated = cumulation.cumulate('zone', roos, {}, base='CAFTA')
+    pd.testing.assert_frame_equal(cumulated.restrictions_table(VA=True), roos[1].restrictions_table(VA=True))
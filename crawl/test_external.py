@@ -0,0 +1,76 @@
+"""
+test_external.py
+
+Checks that the out-of-core export (see external.py) writes the same data set as the
+in-memory export, with a tiny memory budget forcing many runs and merge blocks.
+
+Usage (from this directory):
+  python -m pytest test_external.py
+"""
+
+import os
+
+import pandas as pd
+import pytest
+
+import dataset
+import external
+from hsmap import HSMap
+from roo import RoO
+
+## -----------------------------------------------------------------------------
+## Constants
+## -----------------------------------------------------------------------------
+
+CRAWL_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+HS_MAP = ('2002', os.path.join(CRAWL_DIRECTORY, '..', 'hs_maps', 'H2.csv'))
+AGREEMENTS = ['CAFTA', 'KORUS']
+
+# Small enough to spill a run every 50,000 records or so
+TINY_BUDGET = 4 * 2 ** 20
+
+## -----------------------------------------------------------------------------
+## Functions
+## -----------------------------------------------------------------------------
+
+@pytest.fixture(scope='module')
+def roos():
+    hs_map = HSMap(*HS_MAP)
+    result = []
+    for name in AGREEMENTS:
+        with open(os.path.join(CRAWL_DIRECTORY, '..', 'clean_pta', name + '.txt'), encoding='utf-8') as f:
+            result.append(RoO(name, f.read(), hs_map))
+    return result
+
+
+def test_csv(roos, tmp_path):
+    roo = roos[0]
+    roo.generate_dataset('csv', str(tmp_path / 'memory.csv'), VA=True)
+    roo.generate_dataset('csv', str(tmp_path / 'external.csv'), VA=True, memory_budget=TINY_BUDGET)
+    assert (tmp_path / 'external.csv').read_bytes() == (tmp_path / 'memory.csv').read_bytes()
+
+
+@pytest.mark.parametrize('filetype', ['feather', 'parquet'])
+def test_arrow(roos, tmp_path, filetype):
+    pytest.importorskip('pyarrow')
+    roo = roos[0]
+    roo.generate_dataset(filetype, str(tmp_path / ('memory.' + filetype)), VA=True)
+    roo.generate_dataset(filetype, str(tmp_path / ('external.' + filetype)), VA=True, memory_budget=TINY_BUDGET)
+    expected = dataset.load_dataset(str(tmp_path / ('memory.' + filetype)))
+    result = dataset.load_dataset(str(tmp_path / ('external.' + filetype)))
+    # Dictionaries hold every HS code of the HSMap, not only those in the data set
+    pd.testing.assert_frame_equal(result, expected, check_categorical=False)
+
+
+def test_corpus(roos, tmp_path):
+    nrows = external.export(roos, str(tmp_path / 'corpus.csv'), VA=True, budget=TINY_BUDGET)
+    result = dataset.load_dataset(str(tmp_path / 'corpus.csv'))
+    expected = pd.concat([roo.restrictions_table(VA=True).assign(agreement=roo.name) for roo in roos])
+    expected = expected[result.columns].sort_values(['agreement', 'output_str', 'input_str']).reset_index(drop=True)
+    assert nrows == len(expected)
+    pd.testing.assert_frame_equal(result, expected)
+
+
+def test_unsupported_budget(roos, tmp_path):
+    with pytest.raises(ValueError):
+        roos[0].generate_dataset('dta', str(tmp_path / 'external.dta'), memory_budget=TINY_BUDGET)
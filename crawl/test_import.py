@@ -0,0 +1,53 @@
+"""
+test_import.py
+
+Checks that importing roo stays fast: pandas and matplotlib are only imported by the
+methods using them, and patterns are only compiled on first use.
+
+Usage (from this directory):
+  python -m pytest test_import.py
+"""
+
+import json
+import os
+import subprocess
+import sys
+
+## -----------------------------------------------------------------------------
+## Constants
+## -----------------------------------------------------------------------------
+
+CRAWL_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+# Seconds allowed to import roo in a fresh interpreter (about 0.1 at the time of writing)
+IMPORT_BUDGET = 0.5
+
+IMPORT_SCRIPT = '''
+import json, sys, time
+start = time.perf_counter()
+import roo
+elapsed = time.perf_counter() - start
+print(json.dumps({'elapsed': elapsed, 'modules': [name for name in ('pandas', 'matplotlib') if name in sys.modules],
+                  'compiled': sys.modules['pattern'].compile_regex.cache_info().currsize}))
+'''
+
+## -----------------------------------------------------------------------------
+## Functions
+## -----------------------------------------------------------------------------
+
+def import_roo():
+    """Return the result of importing roo in a fresh interpreter (see IMPORT_SCRIPT)."""
+    output = subprocess.run([sys.executable, '-c', IMPORT_SCRIPT], cwd=CRAWL_DIRECTORY, check=True,
+                            capture_output=True, text=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def test_import_budget():
+    result = import_roo()
+    assert result['elapsed'] < IMPORT_BUDGET, 'importing roo took {:.3f}s'.format(result['elapsed'])
+
+
+def test_import_is_lazy():
+    result = import_roo()
+    assert result['modules'] == [], 'imported at module level: {}'.format(result['modules'])
+    assert result['compiled'] == 0, '{} patterns compiled at import'.format(result['compiled'])
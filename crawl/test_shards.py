@@ -0,0 +1,79 @@
+"""
+test_shards.py
+
+Checks that merging the shards of an FTA (see shards.py) gives the same RoO as a
+single-process build: data set, report, raw RVC alternatives, tariff item rules and
+BOM evaluation.
+
+Usage (from this directory):
+  python -m pytest test_shards.py
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import bom
+import shards
+from hsmap import HSMap
+from roo import RoO
+
+## -----------------------------------------------------------------------------
+## Constants
+## -----------------------------------------------------------------------------
+
+CRAWL_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+AGREEMENT = {'name': 'NAFTA', 'text': os.path.join(CRAWL_DIRECTORY, '..', 'clean_pta', 'NAFTA.txt'),
+             'hs_version': '1992', 'hs_map': os.path.join(CRAWL_DIRECTORY, '..', 'hs_maps', 'H0.csv')}
+CHAPTER_RANGES = [(1, 49), (50, 97)]
+
+## -----------------------------------------------------------------------------
+## Functions
+## -----------------------------------------------------------------------------
+
+@pytest.fixture(scope='module')
+def built(tmp_path_factory):
+    """Return (single-process RoO, RoO merged from two chapter shards)."""
+    hs_map = HSMap(AGREEMENT['hs_version'], AGREEMENT['hs_map'])
+    with open(AGREEMENT['text'], encoding='utf-8') as f:
+        single = RoO(AGREEMENT['name'], f.read(), hs_map)
+    directory = str(tmp_path_factory.mktemp('shards'))
+    paths = [shards.run_shard(shard, directory) for shard in shards.make_manifest([AGREEMENT], CHAPTER_RANGES)['shards']]
+    merged = shards.merge_shards(paths, {AGREEMENT['hs_version']: hs_map})[AGREEMENT['name']]
+    return single, merged
+
+
+def test_data_set(built):
+    single, merged = built
+    pd.testing.assert_frame_equal(merged.restrictions_table(VA=True, tariff_items=True),
+                                  single.restrictions_table(VA=True, tariff_items=True))
+    assert merged.generate_report() == single.generate_report()
+
+
+def test_rvc(built):
+    single, merged = built
+    for key in ['alternatives', 'entry_rules', 'output_rules']:
+        np.testing.assert_array_equal(merged.rvc[key], single.rvc[key])
+
+
+def test_tariff_items(built):
+    single, merged = built
+    assert len(single.tariff_items)
+    assert merged.tariff_rules == single.tariff_rules
+    assert list(merged.tariff_items) == list(single.tariff_items)
+    assert merged.tariff_items.rules == single.tariff_items.rules
+    assert merged.tariff_items.types == single.tariff_items.types
+    for key in ['keys', 'indptr', 'inputs', 'data', 'va_flags']:
+        np.testing.assert_array_equal(getattr(merged.tariff_items, key), getattr(single.tariff_items, key))
+
+
+def test_boms(built):
+    single, merged = built
+    outputs = ['870321', '840710', '010111', '620520']
+    materials = {'bom': [0, 1, 2, 3, 3], 'input_str': ['870899', '840991', '010119', '520100', '620590'],
+                 'share': [0.45, 0.6, 0.1, 0.2, 0.1]}
+    expected = bom.evaluate_boms(single, outputs, materials)
+    assert expected['rvc_required'].iloc[:2].tolist() == [0.5, 0.5]
+    pd.testing.assert_frame_equal(bom.evaluate_boms(merged, outputs, materials), expected)
@@ -0,0 +1,76 @@
+"""
+test_store.py
+
+Checks that the array-backed containers of a built FTA (see store.py) hold the same
+restrictions, rules and VA flags as the nested dictionaries they replace, rebuilt
+here from the restriction triplets of CAFTA.
+
+Usage (from this directory):
+  python -m pytest test_store.py
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from hsmap import HSMap
+from roo import RoO, search_patterns
+
+## -----------------------------------------------------------------------------
+## Constants
+## -----------------------------------------------------------------------------
+
+CRAWL_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+HS_MAP = ('2002', os.path.join(CRAWL_DIRECTORY, '..', 'hs_maps', 'H2.csv'))
+
+## -----------------------------------------------------------------------------
+## Functions
+## -----------------------------------------------------------------------------
+
+@pytest.fixture(scope='module')
+def cafta():
+    with open(os.path.join(CRAWL_DIRECTORY, '..', 'clean_pta', 'CAFTA.txt'), encoding='utf-8') as f:
+        return RoO('CAFTA', f.read(), HSMap(*HS_MAP))
+
+
+@pytest.fixture(scope='module')
+def nested(cafta):
+    """Return the restrictions of CAFTA as a nested dictionary {input: {output: value}}."""
+    codes = cafta.hs_map.codes.tolist()
+    _, inputs, outputs, values = cafta.restriction_triplets(search_patterns, cafta.classified)
+    result = {}
+    for input_position, output_position, value in zip(inputs.tolist(), outputs.tolist(), values.tolist()):
+        result.setdefault(codes[input_position], {})[codes[output_position]] = round(value, 2)
+    return result
+
+
+def test_restrictions(cafta, nested):
+    store = cafta.restrictions
+    assert set(store) == set(nested)
+    for input_str, row in nested.items():
+        assert store[input_str] == row
+
+
+def test_restrictions_table(cafta, nested):
+    rows = [(output_str, input_str, value) for input_str, row in nested.items()
+            for output_str, value in row.items() if value != 0]
+    expected = pd.DataFrame(rows, columns=['output_str', 'input_str', 'VA_Percentage'])
+    expected = expected.sort_values(['output_str', 'input_str']).reset_index(drop=True)
+    table = cafta.restrictions_table(VA=True).sort_values(['output_str', 'input_str']).reset_index(drop=True)
+    pd.testing.assert_frame_equal(table[expected.columns], expected)
+    assert (table['VAAR_dummy'] == 1).all()
+
+    flags = cafta.va_flags[cafta.hs_map.lookup(table['output_str'])]
+    np.testing.assert_array_equal(table[['VA_Complement', 'VA_Alternative']].to_numpy(), flags)
+
+
+def test_rules(cafta):
+    hs_map = cafta.hs_map
+    for hs_code_range, rule in cafta.unique_rules.items():
+        start, stop = hs_map.get_positions(*hs_code_range.split('-'))
+        for hs_code in hs_map.database[start:stop]:
+            assert rule in cafta.all_rules[hs_code]
+    ruled = {hs_code for hs_code in hs_map.database if hs_code in cafta.all_rules}
+    assert len(ruled) == np.count_nonzero(cafta.all_rules.rule_ids >= 0)
@@ -0,0 +1,39 @@
+"""
+test_validate.py
+
+Checks the pre-pass validating the HS codes referred to by the rules of an FTA (see
+validate.py).
+
+Usage (from this directory):
+  python -m pytest test_validate.py
+"""
+
+import os
+
+import validate
+from hsmap import HSMap
+
+## -----------------------------------------------------------------------------
+## Constants
+## -----------------------------------------------------------------------------
+
+CRAWL_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+HS_MAP = ('2012', os.path.join(CRAWL_DIRECTORY, '..', 'hs_maps', 'H4.csv'))
+
+## -----------------------------------------------------------------------------
+## Functions
+## -----------------------------------------------------------------------------
+
+def test_numbers_are_not_hs_codes():
+    text = ('8607.21 A change to subheading 8607.21 from any other subheading, until January 1, 2023 or three '
+            'years after entry into force, whichever is later. 8703.21 A change to subheading 8703.21 from '
+            'headings 8701, 8702 or 9999, provided that there is a regional value content of not less than 75 '
+            'percent.')
+    report = validate.validate_rules(text, HSMap(*HS_MAP))
+    assert report['hs_code'].tolist() == ['9999']
+
+
+def test_usmca():
+    with open(os.path.join(CRAWL_DIRECTORY, '..', 'clean_pta', 'USMCA.txt'), encoding='utf-8') as f:
+        report = validate.validate_rules(f.read(), HSMap(*HS_MAP))
+    assert '2023' not in report['hs_code'].tolist()
@@ -0,0 +1,226 @@
+"""
+textindex.py
+
+Contains an inverted index over the text of the rules (unique_rules) of many FTAs
+and over the descriptions of HS codes of each HS version, answering token and
+phrase queries (e.g. 'cut and sewn', 'except from chapter 72') without rebuilding
+or grepping anything.
+
+Texts are normalized (lowercase, one kind of dash) and split into tokens, where HS
+codes stay whole ('52.04'). Every occurrence of a token is a posting (document,
+position); postings are stored sorted by token, so the postings of a token are a
+contiguous slice, and a phrase is found by intersecting the postings of its tokens
+shifted by their offsets within the phrase.
+
+The index can be saved to (and loaded from) a single .npz file; every source (FTA
+or HS version) records a digest of its texts, so adding it again is skipped unless
+its texts changed.
+"""
+
+import csv
+import hashlib
+import json
+
+import numpy as np
+import regex
+
+## -----------------------------------------------------------------------------
+## Constants
+## -----------------------------------------------------------------------------
+
+TOKEN = r'[^\W\d_]+|\d+(?:\.\d+)*'
+DASHES = r'[–—]'
+
+# Kinds of documents
+RULE = 'rule'
+DESCRIPTION = 'description'
+
+## -----------------------------------------------------------------------------
+## Functions
+## -----------------------------------------------------------------------------
+
+def tokenize(text):
+    """Return the list of normalized tokens of `text`."""
+    return regex.findall(TOKEN, regex.sub(DASHES, '-', text.lower()))
+
+
+def digest(texts):
+    """Return a hex digest of a list of strings."""
+    return hashlib.sha256('\0'.join(texts).encode('utf-8')).hexdigest()
+
+
+def read_descriptions(filename):
+    """Return a dictionary mapping every HS code (chapter, heading and subheading) of an
+    HS Nomenclature .csv file (see HSMap) to its description.
+    """
+    with open(filename, newline='', encoding='utf-8') as f:
+        return {row['Code']: row['Description'] for row in csv.DictReader(f)
+                if row['Code'].isdigit() and not row['Code'].startswith('99')}
+
+## -----------------------------------------------------------------------------
+## Class Definition
+## -----------------------------------------------------------------------------
+
+class TextIndex:
+    """Represent an inverted index over rules of origin and HS descriptions.
+
+    Every document is a tuple (kind, source, hs_code_range, pattern), where `kind` is
+    'rule' (source: FTA name; pattern: first matching pattern, or None) or 'description'
+    (source: HS version; hs_code_range: HS code; pattern: None).
+
+    Methods:
+      add_agreement():
+        Index the unique rules of a built FTA.
+      add_descriptions():
+        Index the HS code descriptions of an HS version.
+      search():
+        Return the documents containing a phrase.
+      search_tokens():
+        Return the documents containing all given tokens (in any order).
+      save(), load():
+        Write the index to, or read it from, an .npz file.
+    """
+    def __init__(self):
+        self.documents = []
+        self.texts = []
+        self.digests = {}
+        self.tokens = []
+        self.postings = None
+
+    def remove_source(self, kind, source):
+        """Remove the documents of a source (FTA or HS version) from the index."""
+        keep = [i for i, document in enumerate(self.documents) if document[:2] != (kind, source)]
+        self.documents = [self.documents[i] for i in keep]
+        self.texts = [self.texts[i] for i in keep]
+        self.tokens = [self.tokens[i] for i in keep]
+        self.digests.pop('{}:{}'.format(kind, source), None)
+        self.postings = None
+
+    def add_source(self, kind, source, documents, texts):
+        """Index `texts` as documents (hs_code_range, pattern) of a source, replacing the
+        previous ones; skipped if the texts did not change. Return True if (re)indexed.
+        """
+        key = '{}:{}'.format(kind, source)
+        text_digest = digest(texts)
+        if self.digests.get(key) == text_digest:
+            return False
+        self.remove_source(kind, source)
+        self.documents += [(kind, source, hs_code_range, pattern) for hs_code_range, pattern in documents]
+        self.texts += texts
+        self.tokens += [tokenize(text) for text in texts]
+        self.digests[key] = text_digest
+        return True
+
+    def add_agreement(self, roo):
+        """Index the unique rules of `roo` (an instance of RoO), along with the pattern each
+        of them was classified as.
+        """
+        classified = roo.classified
+        patterns = [types[0] if types else None for types in classified['types']]
+        return self.add_source(RULE, roo.name, list(zip(classified['hs_code_range'], patterns)),
+                               list(classified['rule']))
+
+    def add_descriptions(self, version, filename):
+        """Index the descriptions of the HS codes of an HS Nomenclature .csv file."""
+        descriptions = read_descriptions(filename)
+        return self.add_source(DESCRIPTION, str(version), [(hs_code, None) for hs_code in descriptions],
+                               list(descriptions.values()))
+
+    def compile(self):
+        """Build the postings from the tokens of every document (done on first query)."""
+        self.tokens = [tokenize(text) if tokens is None else tokens for tokens, text in zip(self.tokens, self.texts)]
+        vocabulary, token_ids = {}, []
+        for tokens in self.tokens:
+            token_ids.append(np.array([vocabulary.setdefault(token, len(vocabulary)) for token in tokens],
+                                      dtype=np.int64))
+        lengths = np.array([len(ids) for ids in token_ids], dtype=np.int64)
+        ids = np.concatenate(token_ids) if token_ids else np.empty(0, dtype=np.int64)
+        documents = np.repeat(np.arange(len(lengths), dtype=np.int64), lengths)
+        positions = np.arange(len(ids), dtype=np.int64) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+
+        order = np.lexsort((positions, documents, ids))
+        ids = ids[order]
+        bounds = np.searchsorted(ids, np.arange(len(vocabulary) + 1))
+        self.postings = {
+            'vocabulary': vocabulary,
+            'starts': bounds[:-1],
+            'stops': bounds[1:],
+            # Key of a posting: document * stride + position
+            'stride': int(lengths.max()) + 1 if len(lengths) else 1,
+            'documents': documents[order],
+            'positions': positions[order]
+        }
+
+    def occurrences(self, token):
+        """Return a sorted array of keys (document * stride + position) of a token."""
+        if self.postings is None:
+            self.compile()
+        postings = self.postings
+        token_id = postings['vocabulary'].get(token)
+        if token_id is None:
+            return np.empty(0, dtype=np.int64)
+        span = slice(postings['starts'][token_id], postings['stops'][token_id])
+        return postings['documents'][span] * postings['stride'] + postings['positions'][span]
+
+    def hits(self, documents, kind=None, source=None):
+        """Return the documents (tuples; see TextIndex) of an array of document ids."""
+        hits = [self.documents[i] for i in documents.tolist()]
+        return [hit for hit in hits if (kind is None or hit[0] == kind) and (source is None or hit[1] == source)]
+
+    def search(self, phrase, kind=None, source=None):
+        """Return a list of documents (see TextIndex) containing `phrase` (a sequence of
+        tokens, e.g. 'except from chapter 72'), optionally only of a given kind ('rule' or
+        'description') or source (FTA name or HS version).
+        """
+        tokens = tokenize(phrase)
+        if not tokens:
+            return []
+        # Keys of each token, shifted to the start of the phrase; intersect the rarest first
+        candidates = sorted((self.occurrences(token) - offset for offset, token in enumerate(tokens)), key=len)
+        keys = candidates[0]
+        for shifted in candidates[1:]:
+            keys = keys[np.isin(keys, shifted, assume_unique=True)]
+        return self.hits(np.unique(keys // self.postings['stride']), kind, source)
+
+    def search_tokens(self, query, kind=None, source=None):
+        """Return a list of documents (see TextIndex) containing every token of `query`, in
+        any order and position.
+        """
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+        documents = None
+        for token in tokens:
+            found = np.unique(self.occurrences(token) // self.postings['stride'])
+            documents = found if documents is None else np.intersect1d(documents, found, assume_unique=True)
+        return self.hits(documents, kind, source)
+
+    def text(self, hit):
+        """Return the text of a document (see TextIndex)."""
+        return self.texts[self.documents.index(tuple(hit))]
+
+    def save(self, filepath):
+        """Write the index (documents, texts and postings) to an .npz file."""
+        if self.postings is None:
+            self.compile()
+        postings = self.postings
+        meta = {'documents': self.documents, 'texts': self.texts, 'digests': self.digests,
+                'vocabulary': list(postings['vocabulary']), 'stride': postings['stride']}
+        np.savez(filepath, meta=np.array(json.dumps(meta)), starts=postings['starts'], stops=postings['stops'],
+                 documents=postings['documents'], positions=postings['positions'])
+
+    @classmethod
+    def load(cls, filepath):
+        """Return a TextIndex read from an .npz file written by save()."""
+        with np.load(filepath) as data:
+            meta = json.loads(str(data['meta']))
+            index = cls()
+            index.documents = [tuple(document) for document in meta['documents']]
+            index.texts = meta['texts']
+            index.digests = meta['digests']
+            index.postings = {'vocabulary': {token: i for i, token in enumerate(meta['vocabulary'])},
+                              'stride': meta['stride'],
+                              **{key: data[key] for key in ['starts', 'stops', 'documents', 'positions']}}
+        # Tokens are only needed to recompile after adding documents (see compile())
+        index.tokens = [None] * len(index.texts)
+        return index
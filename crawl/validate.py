@@ -0,0 +1,135 @@
+"""
+validate.py
+
+Contains a pre-pass validating every HS code referred to by the rules of an FTA
+against an HSMap, before anything is built.
+
+Building stops at the first unknown HS code (HSMap.get_positions() raises
+KeyError), hence a typo or a wrong HSMap version costs one whole build per error.
+The pre-pass instead extracts every HS code (and range) referred to by the rules,
+i.e. the HS codes a rule applies to and those within its clauses, checks all of
+them at once, and reports every unknown one with its position in the source text.
+Tariff items (beyond six digits) are checked by the subheading they belong to, as
+they are resolved when built (see RoO.build_tariff_items()).
+"""
+
+import numpy as np
+import pandas as pd
+import regex
+
+from pattern import Pattern, RULE, HS_TIER_NC, TARIFF_ITEM, NATIONAL_TARIFF_ITEMS, compile_regex
+
+## -----------------------------------------------------------------------------
+## Constants
+## -----------------------------------------------------------------------------
+
+# Cleaning applied to the text before capturing rules (see RoO.parse_rules()), in order
+CLEANING = [(r'\s+', ' '), (r'\s?[–\-]\s?', '-')]
+
+# Numbers followed by this are percentages (VA requirements), not chapters
+PERCENT = r'\s?per\s?cent'
+
+# HS codes without dots (e.g. 8703) are only HS codes after a tier, possibly within a list
+# (e.g. 'headings 8701, 8702 or 8703', 'heading 8707 from 8708'); otherwise they are other
+# numbers (e.g. the year 2023)
+TIER_CONTEXT = r'{0} (?:[\d.]+(?:,|, or|, and| or| and| through| from)? )*$'.format(HS_TIER_NC)
+
+## -----------------------------------------------------------------------------
+## Functions
+## -----------------------------------------------------------------------------
+
+def clean_text(raw_text):
+    """Return the text cleaned as in RoO.parse_rules(), along with an integer array
+    mapping every character of it to its position in `raw_text`.
+    """
+    text, offsets = raw_text, np.arange(len(raw_text) + 1)
+    for raw, replacement in CLEANING:
+        pieces, piece_offsets, last = [], [], 0
+        for match in regex.finditer(raw, text):
+            pieces += [text[last:match.start()], replacement]
+            piece_offsets += [offsets[last:match.start()], np.full(len(replacement), offsets[match.start()])]
+            last = match.end()
+        pieces.append(text[last:])
+        piece_offsets.append(offsets[last:])
+        text, offsets = ''.join(pieces), np.concatenate(piece_offsets)
+    return text, offsets
+
+
+def references(text):
+    """Yield (rule index, hs_code_range, source, HS codes, start) of every HS code (or range
+    of them) referred to within the rules captured from a cleaned `text`: first the HS codes
+    the rule applies to (source 'rule'; the subheading of a tariff item rule), then those
+    within its clauses (source 'clause'; chapters padded to two digits, tariff items cut to
+    their subheadings, numbers without dots only after a tier; see TIER_CONTEXT).
+    """
+    pattern_range, pattern_tier = compile_regex(Pattern.PATTERN_RANGE), compile_regex(TIER_CONTEXT)
+    pattern_item, pattern_national = compile_regex(TARIFF_ITEM), compile_regex(NATIONAL_TARIFF_ITEMS)
+    for index, match in enumerate(regex.finditer(RULE, text)):
+        hs_code1, hs_code2 = match[2].replace('.', ''), match[3].replace('.', '') if match[3] else ''
+        hs_code_range = hs_code1 + '-' + hs_code2 if hs_code2 else hs_code1
+        rule, offset = match[1], match.start(1)
+        header = range(match.start(2), match.end(3) if match[3] else match.end(2))
+        # Tariff item rules are built as a rule of their subheading (see RoO.build_tariff_items())
+        if len(hs_code1) > 6 or len(hs_code2) > 6:
+            yield index, hs_code_range, 'rule', [hs_code1[:6]], match.start(2)
+            national = pattern_national.search(rule)
+            if national:
+                header = range(min(header.start, offset + national.start()), max(header.stop, offset + national.end()))
+        else:
+            yield index, hs_code_range, 'rule', [code for code in (hs_code1, hs_code2) if code], match.start(2)
+
+        for reference in pattern_range.finditer(rule):
+            if offset + reference.start() in header or regex.match(PERCENT, rule[reference.end():]):
+                continue
+            ch_1, ch_2, hs_code1, hs_code2 = reference.groups()
+            if hs_code1 and '.' not in hs_code1 and not pattern_tier.search(rule[:reference.start()][-400:]):
+                continue
+            if ch_1:
+                codes = [ch.zfill(2) for ch in (ch_1, ch_2) if ch]
+            else:
+                codes = [code.replace('.', '') for code in (hs_code1, hs_code2) if code]
+            yield index, hs_code_range, 'clause', codes, offset + reference.start()
+        for reference in pattern_item.finditer(rule):
+            if offset + reference.start() not in header:
+                yield index, hs_code_range, 'clause', [reference[1].replace('.', '')], offset + reference.start()
+
+
+def validate_rules(raw_text, hs_map):
+    """Return a DataFrame of every HS code referred to by the rules in `raw_text` but
+    missing from `hs_map` (empty if all of them are found), with columns:
+      `rule`: index of the rule (in order of appearance in the text)
+      `hs_code_range`: (range of) HS codes the rule applies to
+      `source`: 'rule' if the rule applies to the unknown HS code (hence the rule cannot be
+                parsed at all; for a tariff item rule, its subheading), or 'clause' if it is referred to within a clause (the rule
+                fails to build only if that clause is actually resolved)
+      `hs_code`: unknown HS code (without dots)
+      `line`, `column`: position of the reference in `raw_text` (from 1)
+      `context`: text of the reference
+
+    All HS codes are checked in one membership test against every chapter, heading
+    and subheading of `hs_map`.
+    """
+    text, offsets = clean_text(raw_text)
+    rows = []
+    for index, hs_code_range, source, codes, start in references(text):
+        for code in codes:
+            rows.append((index, hs_code_range, source, code, start))
+
+    columns = ['rule', 'hs_code_range', 'source', 'hs_code', 'line', 'column', 'context']
+    if not rows:
+        return pd.DataFrame(columns=columns)
+    rules, hs_code_ranges, sources, codes, starts = map(np.array, zip(*rows))
+    missing = ~np.isin(codes, np.array(list(hs_map.full_map)))
+
+    line_starts = np.r_[0, np.flatnonzero(np.frombuffer(raw_text.encode('utf-32-le'), dtype=np.uint32) == ord('\n')) + 1]
+    positions = offsets[starts[missing]]
+    lines = np.searchsorted(line_starts, positions, side='right')
+    return pd.DataFrame({
+        'rule': rules[missing],
+        'hs_code_range': hs_code_ranges[missing],
+        'source': sources[missing],
+        'hs_code': codes[missing],
+        'line': lines,
+        'column': positions - line_starts[lines - 1] + 1,
+        'context': [text[start:start + 40] for start in starts[missing]]
+    }, columns=columns)
@@ -0,0 +1,132 @@
+"""
+versions.py
+
+Contains a detector of the version of HS Nomenclature used by the text of an FTA,
+so that the right HSMap can be chosen automatically.
+
+Every chapter, heading and subheading of the six versions (H0 to H5) is recorded
+once in a membership index, mapping HS code to a bitmask of the versions it exists
+in. HS codes referred to by a text (e.g. 'heading 52.04') are then looked up all at
+once, and the version containing most of them wins; ties go to the latest version,
+since a text written under a later version can still refer only to codes existing
+in earlier ones, but not the other way around.
+
+The index is built from the .csv files once, then cached next to them.
+"""
+
+import csv
+import functools
+import os
+
+import numpy as np
+
+from hsmap import HSMap
+from pattern import HS_CODE_6, compile_regex
+
+## -----------------------------------------------------------------------------
+## Constants
+## -----------------------------------------------------------------------------
+
+# Version of HS Nomenclature and its .csv file (see HSMap)
+VERSIONS = [('1992', 'H0'), ('1996', 'H1'), ('2002', 'H2'), ('2007', 'H3'), ('2012', 'H4'), ('2017', 'H5')]
+
+HS_MAPS_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'hs_maps')
+INDEX_FILENAME = 'versions_index.npz'
+
+# HS codes referred to by a text, e.g. 'heading 52.04' or 'subheadings 8703.21'
+REFERENCE = r'(?:heading|subheading)s? {0}'.format(HS_CODE_6)
+
+## -----------------------------------------------------------------------------
+## Functions
+## -----------------------------------------------------------------------------
+
+def build_index(directory=HS_MAPS_DIRECTORY):
+    """Return arrays (codes, masks) of every HS code (chapter, heading and subheading) of
+    every version in VERSIONS, sorted by code, where bit i of masks is set if the code
+    exists in the i-th version.
+    """
+    masks = {}
+    for bit, (_, filename) in enumerate(VERSIONS):
+        # Same HS codes as HSMap: leaves (excluding chapter 99) and their prefixes
+        with open(os.path.join(directory, filename + '.csv'), newline='', encoding='utf-8') as f:
+            for row in csv.DictReader(f):
+                hs_code = row['Code']
+                if row['isLeaf'] == '1' and not hs_code.startswith('99'):
+                    for prefix in (hs_code[:2], hs_code[:4], hs_code):
+                        masks[prefix] = masks.get(prefix, 0) | (1 << bit)
+    codes = np.array(sorted(masks))
+    return codes, np.array([masks[hs_code] for hs_code in codes], dtype=np.uint8)
+
+
+@functools.lru_cache(maxsize=None)
+def load_index(directory=HS_MAPS_DIRECTORY):
+    """Return the membership index (see build_index()) of the .csv files in `directory`,
+    read from its cache file, or built (and cached) if missing or older than the files.
+    """
+    path = os.path.join(directory, INDEX_FILENAME)
+    sources = [os.path.join(directory, filename + '.csv') for _, filename in VERSIONS]
+    if os.path.exists(path) and os.path.getmtime(path) >= max(os.path.getmtime(p) for p in sources):
+        with np.load(path) as data:
+            return data['codes'], data['masks']
+    codes, masks = build_index(directory)
+    try:
+        np.savez(path, codes=codes, masks=masks)
+    except OSError:
+        # Read-only directory; the index is then rebuilt once per process
+        pass
+    return codes, masks
+
+
+def referenced_codes(raw_text, sample=None):
+    """Return an array of (dot-free) headings and subheadings referred to by `raw_text`; if
+    `sample` is given, at most that many of them, evenly spaced throughout the text.
+    """
+    hs_codes = np.array([hs_code.replace('.', '') for hs_code in compile_regex(REFERENCE).findall(raw_text)],
+                        dtype='U6')
+    if sample is not None and len(hs_codes) > sample:
+        hs_codes = hs_codes[np.linspace(0, len(hs_codes) - 1, sample).round().astype(np.int64)]
+    return hs_codes
+
+
+def score_versions(raw_text, directory=HS_MAPS_DIRECTORY, sample=None):
+    """Return a dictionary mapping each version in VERSIONS to the share of HS codes
+    referred to by `raw_text` (see referenced_codes()) existing in that version.
+    """
+    codes, masks = load_index(directory)
+    hs_codes = referenced_codes(raw_text, sample)
+    if not len(hs_codes):
+        return {version: 0.0 for version, _ in VERSIONS}
+    positions = np.minimum(np.searchsorted(codes, hs_codes), len(codes) - 1)
+    found = np.where(codes[positions] == hs_codes, masks[positions], 0)
+    bits = np.unpackbits(found[:, None], axis=1, bitorder='little')[:, :len(VERSIONS)]
+    return {version: float(share) for (version, _), share in zip(VERSIONS, bits.mean(axis=0))}
+
+
+def detect_version(raw_text, directory=HS_MAPS_DIRECTORY, sample=None):
+    """Return the version (e.g. '1992') of HS Nomenclature best fitting the HS codes referred
+    to by `raw_text`, i.e. the latest version with the highest score (see score_versions()).
+    """
+    scores = score_versions(raw_text, directory, sample)
+    if not any(scores.values()):
+        print('No HS code found in the text!')
+        raise ValueError
+    best = max(scores.values())
+    return [version for version, score in scores.items() if score == best][-1]
+
+
+def detect_hs_map(raw_text, hs_maps=None, directory=HS_MAPS_DIRECTORY, sample=None):
+    """Return the HSMap of the version detected from `raw_text` (see detect_version()).
+
+    Inputs:
+      `hs_maps`: dictionary mapping version (string, e.g. '1992', or integer, e.g. 1992,
+                 as in app.py) to HSMap, reused (and filled, with keys of the same type)
+                 across calls so that every version is only read once in a batch run
+    """
+    version = detect_version(raw_text, directory, sample)
+    if hs_maps is None:
+        hs_maps = {}
+    keys = {str(key): key for key in hs_maps}
+    if version not in keys:
+        keys[version] = int(version) if hs_maps and all(isinstance(key, int) for key in hs_maps) else version
+        hs_maps[keys[version]] = HSMap(version, os.path.join(directory, dict(VERSIONS)[version] + '.csv'))
+    return hs_maps[keys[version]]
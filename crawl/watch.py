@@ -0,0 +1,175 @@
+"""
+watch.py
+
+Contains a watch mode for the edit-run loop of pattern and treaty-text development:
+a long-running process keeping HS maps, compiled patterns and built FTAs in memory,
+which rebuilds only what changed whenever a watched file is saved, then prints the
+summary (see RoO.summarize()) and optionally writes the data set again.
+
+Watched files (polled by modification time; no dependency needed):
+  `pattern.py`: reloaded (along with the modules importing names from it: validate.py,
+                versions.py and roo.py), then every FTA is rebuilt; regexes left
+                unchanged are not compiled again (the regex module caches them)
+  `../clean_pta/*.txt`, `../JPN/**/*.txt`: the changed FTA alone is parsed and built
+                again, with the HSMap of the version detected from its text (see
+                versions.py); maps are read once and kept
+
+Tables (.csv, e.g. JPN/RoO Table) have no parser yet, hence are not watched. Since a
+change to pattern.py rebuilds every FTA, restrict the watch to the FTAs being worked
+on with --only to keep rebuilds within a second.
+
+Usage:
+  python watch.py [--only NAFTA USMCA ...] [--filetype csv] [--VA] [--output <directory>] [--remaining]
+                  [--interval 0.2]
+"""
+
+import argparse
+import glob
+import importlib
+import os
+import time
+import traceback
+
+import pandas  # noqa: F401 (imported once, up front, to keep rebuilds fast)
+
+import pattern
+import validate
+import versions
+import roo
+
+## -----------------------------------------------------------------------------
+## Constants
+## -----------------------------------------------------------------------------
+
+CRAWL_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+PATTERN_FILE = os.path.join(CRAWL_DIRECTORY, 'pattern.py')
+TEXT_GLOBS = [os.path.join(CRAWL_DIRECTORY, '..', 'clean_pta', '*.txt'),
+              os.path.join(CRAWL_DIRECTORY, '..', 'JPN', '**', '*.txt')]
+
+DEFAULT_INTERVAL = 0.2
+
+## -----------------------------------------------------------------------------
+## Class Definition
+## -----------------------------------------------------------------------------
+
+class Watcher:
+    """Represent the state kept warm between rebuilds.
+
+    Attributes:
+      `hs_maps`: dictionary mapping HS version to HSMap (see versions.detect_hs_map())
+      `roos`: dictionary mapping text file path to its built RoO (or None if it failed)
+      `mtimes`: dictionary mapping watched file path to its last modification time
+    """
+    def __init__(self, names=None, filetype=None, VA=False, output_directory=None, remaining=False):
+        self.names = set(names) if names else None
+        self.filetype = filetype
+        self.VA = VA
+        self.output_directory = output_directory
+        self.remaining = remaining
+        self.hs_maps = {}
+        self.roos = {}
+        self.mtimes = {}
+
+    @staticmethod
+    def name(path):
+        """Return the name of the FTA of a text file (its file name without extension)."""
+        return os.path.splitext(os.path.basename(path))[0]
+
+    def watched_files(self):
+        """Return the sorted list of watched text files (only those of `self.names`, if given)."""
+        paths = {os.path.normpath(path) for pattern_glob in TEXT_GLOBS
+                 for path in glob.glob(pattern_glob, recursive=True)}
+        return sorted(path for path in paths if self.names is None or self.name(path) in self.names)
+
+    def scan(self):
+        """Return (whether pattern.py changed, list of changed or new text files, list of
+        removed text files) since the last scan, and record the new modification times.
+        """
+        mtimes = {path: os.stat(path).st_mtime_ns for path in self.watched_files() + [PATTERN_FILE]}
+        changed = [path for path, mtime in mtimes.items() if self.mtimes.get(path) != mtime]
+        removed = [path for path in self.mtimes if path not in mtimes]
+        self.mtimes = mtimes
+        return PATTERN_FILE in changed, [path for path in changed if path != PATTERN_FILE], removed
+
+    def reload_patterns(self):
+        """Reload pattern.py, then every module binding its names at import (validate.py,
+        versions.py, roo.py, in that order); return False if any of them fails to load.
+        """
+        global pattern, validate, versions, roo
+        try:
+            pattern = importlib.reload(pattern)
+            validate = importlib.reload(validate)
+            versions = importlib.reload(versions)
+            roo = importlib.reload(roo)
+        except Exception:
+            traceback.print_exc()
+            return False
+        return True
+
+    def build(self, path):
+        """Build (again) the FTA of a text file, print its summary and write its data set."""
+        name = self.name(path)
+        start = time.perf_counter()
+        try:
+            with open(path, encoding='utf-8') as f:
+                raw_text = f.read()
+            built = roo.RoO(name, raw_text, versions.detect_hs_map(raw_text, self.hs_maps), patterns=roo.search_patterns,
+                            invalid='quarantine')
+        except Exception:
+            traceback.print_exc()
+            self.roos[path] = None
+            return
+        self.roos[path] = built
+        print('== {} (HS {}; built in {:.2f}s)'.format(name, built.hs_map.version, time.perf_counter() - start))
+        if built.invalid_codes is not None and len(built.invalid_codes):
+            print('Unknown HS codes:')
+            print(built.invalid_codes.to_string(index=False))
+        built.summarize(remaining=self.remaining)
+        if self.filetype:
+            directory = self.output_directory or os.getcwd()
+            built.generate_dataset(self.filetype, os.path.join(directory, name + '.' + self.filetype), self.VA)
+
+    def step(self):
+        """Scan the watched files once and rebuild what changed; return the number of FTAs
+        built.
+        """
+        patterns_changed, changed, removed = self.scan()
+        for path in removed:
+            self.roos.pop(path, None)
+        if patterns_changed and self.roos and not self.reload_patterns():
+            return 0
+        paths = sorted(set(changed) | (set(self.roos) if patterns_changed else set()))
+        for path in paths:
+            self.build(path)
+        return len(paths)
+
+    def run(self, interval=DEFAULT_INTERVAL):
+        """Build every FTA, then rebuild whatever changes until interrupted (Ctrl+C)."""
+        self.step()
+        print('Watching {} files; press Ctrl+C to stop.'.format(len(self.mtimes)))
+        try:
+            while True:
+                time.sleep(interval)
+                self.step()
+        except KeyboardInterrupt:
+            pass
+
+## -----------------------------------------------------------------------------
+## Functions
+## -----------------------------------------------------------------------------
+
+def main(argv=None):
+    """Command line entry point; see the usage in the module docstring."""
+    parser = argparse.ArgumentParser(description='Rebuild FTAs whenever patterns or texts change.')
+    parser.add_argument('--only', nargs='*', help='names of the FTAs to watch (default: all)')
+    parser.add_argument('--filetype', help='also write the data set of every rebuilt FTA (e.g. csv)')
+    parser.add_argument('--VA', action='store_true')
+    parser.add_argument('--output', help='directory of the data sets (default: current directory)')
+    parser.add_argument('--remaining', action='store_true', help='also print uncaptured rules')
+    parser.add_argument('--interval', type=float, default=DEFAULT_INTERVAL, help='seconds between scans')
+    args = parser.parse_args(argv)
+    Watcher(args.only, args.filetype, args.VA, args.output, args.remaining).run(args.interval)
+
+
+if __name__ == '__main__':
+    main()